@@ -3,4 +3,4 @@ This package contains the portions of the library used only when
 implementing an OpenID consumer.
 """
 
-__all__ = ['consumer', 'discover']
+__all__ = ['consumer', 'discover', 'discoverycache', 'failurecache']
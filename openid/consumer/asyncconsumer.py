@@ -0,0 +1,440 @@
+# -*- test-case-name: openid.test.test_asyncconsumer -*-
+"""OpenID support for Relying Parties in asyncio applications.
+
+This module has the same interface as L{openid.consumer.consumer},
+except that the methods of C{L{AsyncConsumer}} that do network or
+store I/O are coroutines::
+
+    consumer = AsyncConsumer(session, store)
+    auth_request = await consumer.begin(user_url)
+    ...
+    response = await consumer.complete(query, current_url)
+
+Fetching is done with L{fetchAsync<openid.fetchers.fetchAsync>},
+discovery with
+L{discoverAsync<openid.consumer.discover.discoverAsync>}, and the store
+should implement
+C{L{AsyncOpenIDStore<openid.store.asyncinterface.AsyncOpenIDStore>}}.
+A blocking C{L{OpenIDStore<openid.store.interface.OpenIDStore>}} may
+be given instead, in which case it is used through a
+C{L{SyncToAsyncStore<openid.store.asyncinterface.SyncToAsyncStore>}}.
+
+The responses are the same C{L{SuccessResponse}},
+C{L{FailureResponse}}, C{L{CancelResponse}} and
+C{L{SetupNeededResponse}} objects as the blocking consumer returns.
+"""
+
+import inspect
+import logging
+
+from openid import fetchers
+from openid.consumer.consumer import Consumer, GenericConsumer, \
+     ProtocolError, ServerError, SetupNeededError, SetupNeededResponse, \
+     FailureResponse, SuccessResponse, _httpResponseToMessage
+from openid.consumer.discover import discoverAsync, DiscoveryFailure, \
+     OpenIDServiceEndpoint
+from openid.message import Message, OPENID_NS, OPENID2_NS, no_default
+from openid.store.asyncinterface import SyncToAsyncStore
+from openid.yadis.manager import Discovery
+
+__all__ = [
+    'AsyncConsumer',
+    'AsyncGenericConsumer',
+]
+
+logger = logging.getLogger(__name__)
+
+
+async def makeKVPostAsync(request_message, server_url):
+    """Like L{makeKVPost<openid.consumer.consumer.makeKVPost>}, for use
+    in asyncio code.
+
+    @raises openid.fetchers.HTTPFetchingError: if an error is
+        encountered in making the HTTP post.
+
+    @rtype: L{openid.message.Message}
+    """
+    resp = await fetchers.fetchAsync(server_url,
+                                     body=request_message.toURLEncoded())
+    return _httpResponseToMessage(resp, server_url)
+
+
+class AsyncConsumer(Consumer):
+    """An OpenID consumer implementation for asyncio code that performs
+    discovery and does session management.  See
+    C{L{Consumer<openid.consumer.consumer.Consumer>}}, whose methods
+    this has, except that C{L{begin}}, C{L{beginWithoutDiscovery}} and
+    C{L{complete}} are coroutines.
+    """
+
+    _discover = staticmethod(discoverAsync)
+
+    def __init__(self, session, store, consumer_class=None,
+                 discovery_cache=None):
+        """Initialize an AsyncConsumer instance.
+
+        @param session: See L{the session instance variable<openid.consumer.consumer.Consumer.session>}
+
+        @param store: an object that implements the interface in
+            C{L{openid.store.asyncinterface.AsyncOpenIDStore}}, or a
+            blocking C{L{openid.store.interface.OpenIDStore}}.
+
+        @param consumer_class: The class of the protocol implementation
+            to use.  It defaults to C{L{AsyncGenericConsumer}}.
+
+        @param discovery_cache: A cache of discovery results, or None to
+            always do discovery.
+        @type discovery_cache:
+            C{L{openid.consumer.discoverycache.DiscoveryCache}}
+        """
+        if consumer_class is None:
+            consumer_class = AsyncGenericConsumer
+        Consumer.__init__(self, session, store, consumer_class,
+                          discovery_cache)
+
+    def _useDiscoveryCache(self, discovery_cache):
+        self._discover = discovery_cache.discoverAsync
+        self.consumer._discover = discovery_cache.discoverAsync
+
+    async def begin(self, user_url, anonymous=False):
+        """Start the OpenID authentication process.  See
+        L{Consumer.begin<openid.consumer.consumer.Consumer.begin>}.
+
+        @returntype: L{AuthRequest<openid.consumer.consumer.AuthRequest>}
+
+        @raises openid.consumer.discover.DiscoveryFailure: when I fail to
+            find an OpenID server for this URL.
+        """
+        disco = Discovery(self.session, user_url, self.session_key_prefix)
+        try:
+            service = await disco.getNextServiceAsync(self._discover)
+        except fetchers.HTTPFetchingError as why:
+            raise DiscoveryFailure('Error fetching XRDS document: %s' %
+                                   (why.why, ), None)
+
+        if service is None:
+            raise DiscoveryFailure('No usable OpenID services found for %s' %
+                                   (user_url, ), None)
+        else:
+            return await self.beginWithoutDiscovery(service, anonymous)
+
+    async def beginWithoutDiscovery(self, service, anonymous=False):
+        """Start OpenID verification without doing OpenID server
+        discovery.  See
+        L{Consumer.beginWithoutDiscovery<openid.consumer.consumer.Consumer.beginWithoutDiscovery>}.
+
+        @rtype: L{AuthRequest<openid.consumer.consumer.AuthRequest>}
+        """
+        auth_req = await self.consumer.begin(service)
+        self.session[self._token_key] = auth_req.endpoint
+
+        try:
+            auth_req.setAnonymous(anonymous)
+        except ValueError as why:
+            raise ProtocolError(str(why))
+
+        return auth_req
+
+    async def complete(self, query, current_url):
+        """Called to interpret the server's response to an OpenID
+        request.  See
+        L{Consumer.complete<openid.consumer.consumer.Consumer.complete>}.
+
+        @returns: a subclass of Response.
+        """
+        endpoint = self.session.get(self._token_key)
+
+        message = Message.fromPostArgs(query)
+        response = await self.consumer.complete(message, endpoint,
+                                                current_url)
+
+        try:
+            del self.session[self._token_key]
+        except KeyError:
+            pass
+
+        if (response.status in ['success', 'cancel'] and
+                response.identity_url is not None):
+
+            disco = Discovery(self.session, response.identity_url,
+                              self.session_key_prefix)
+            # This is OK to do even if we did not do discovery in
+            # the first place.
+            disco.cleanup(force=True)
+
+        return response
+
+
+class AsyncGenericConsumer(GenericConsumer):
+    """The common logic for OpenID consumers, for asyncio code.  See
+    C{L{GenericConsumer<openid.consumer.consumer.GenericConsumer>}};
+    C{L{begin}} and C{L{complete}} are coroutines here.
+    """
+
+    _discover = staticmethod(discoverAsync)
+    _makeKVPost = staticmethod(makeKVPostAsync)
+
+    def __init__(self, store):
+        # Stores are duck-typed, so tell blocking ones by their methods
+        if (store is not None and
+                not inspect.iscoroutinefunction(store.useNonce)):
+            store = SyncToAsyncStore(store)
+        GenericConsumer.__init__(self, store)
+
+    async def begin(self, service_endpoint):
+        """Create an AuthRequest object for the specified
+        service_endpoint. This method will create an association if
+        necessary."""
+        if self.store is None:
+            assoc = None
+        else:
+            assoc = await self._getAssociation(service_endpoint)
+
+        return self._createAuthRequest(service_endpoint, assoc)
+
+    async def complete(self, message, endpoint, return_to):
+        """Process the OpenID message, using the specified endpoint
+        and return_to URL as context. This method will handle any
+        OpenID message that is sent to the return_to URL.
+        """
+        mode = message.getArg(OPENID_NS, 'mode', '<No mode set>')
+
+        modeMethod = getattr(self, '_complete_' + mode, self._completeInvalid)
+
+        response = modeMethod(message, endpoint, return_to)
+        if inspect.isawaitable(response):
+            response = await response
+        return response
+
+    async def _complete_id_res(self, message, endpoint, return_to):
+        try:
+            self._checkSetupNeeded(message)
+        except SetupNeededError as why:
+            return SetupNeededResponse(endpoint, why.user_setup_url)
+        else:
+            try:
+                return await self._doIdRes(message, endpoint, return_to)
+            except (ProtocolError, DiscoveryFailure) as why:
+                return FailureResponse(endpoint, why)
+
+    async def _doIdRes(self, message, endpoint, return_to):
+        """Handle id_res responses that are not cancellations of
+        immediate mode requests.
+
+        @returntype: L{Response}
+        """
+        # Checks for presence of appropriate fields (and checks
+        # signed list fields)
+        self._idResCheckForFields(message)
+
+        if not self._checkReturnTo(message, return_to):
+            raise ProtocolError(
+                "return_to does not match return URL. Expected %r, got %r" %
+                (return_to, message.getArg(OPENID_NS, 'return_to')))
+
+        # Verify discovery information:
+        endpoint = await self._verifyDiscoveryResults(message, endpoint)
+        logger.info("Received id_res response from %s using association %s" %
+                    (endpoint.server_url,
+                     message.getArg(OPENID_NS, 'assoc_handle')))
+
+        await self._idResCheckSignature(message, endpoint.server_url)
+
+        # Will raise a ProtocolError if the nonce is bad
+        await self._idResCheckNonce(message, endpoint)
+
+        signed_list_str = message.getArg(OPENID_NS, 'signed', no_default)
+        signed_list = signed_list_str.split(',')
+        signed_fields = ["openid." + s for s in signed_list]
+        return SuccessResponse(endpoint, message, signed_fields)
+
+    async def _idResCheckNonce(self, message, endpoint):
+        server_url, timestamp, salt = self._idResGetNonce(message, endpoint)
+        if (self.store is not None and
+                not await self.store.useNonce(server_url, timestamp, salt)):
+            raise ProtocolError('Nonce already used or out of range')
+
+    async def _idResCheckSignature(self, message, server_url):
+        assoc_handle = message.getArg(OPENID_NS, 'assoc_handle')
+        if self.store is None:
+            assoc = None
+        else:
+            assoc = await self.store.getAssociation(server_url, assoc_handle)
+
+        if assoc:
+            if assoc.expiresIn <= 0:
+                raise ProtocolError('Association with %s expired' %
+                                    (server_url, ))
+
+            if not assoc.checkMessageSignature(message):
+                raise ProtocolError('Bad signature')
+
+        else:
+            # It's not an association we know about.  Stateless mode is our
+            # only possible path for recovery.
+            if not await self._checkAuth(message, server_url):
+                raise ProtocolError('Server denied check_authentication')
+
+    async def _verifyDiscoveryResults(self, resp_msg, endpoint=None):
+        """
+        Extract the information from an OpenID assertion message and
+        verify it against the original
+
+        @returns: the verified endpoint
+        """
+        if resp_msg.getOpenIDNamespace() == OPENID2_NS:
+            to_match = self._getOpenID2ToMatch(resp_msg)
+            if to_match.claimed_id is None:
+                return OpenIDServiceEndpoint.fromOPEndpointURL(
+                    to_match.server_url)
+
+            if not self._checkDiscoveredEndpointOpenID2(endpoint, to_match):
+                endpoint = await self._discoverAndVerify(
+                    to_match.claimed_id, [to_match])
+
+            return self._withClaimedID(endpoint, to_match.claimed_id)
+        else:
+            to_match_endpoints = self._getOpenID1ToMatch(resp_msg, endpoint)
+            if (endpoint is not None and
+                    self._checkDiscoveredEndpointOpenID1(
+                        endpoint, *to_match_endpoints)):
+                return endpoint
+
+            return await self._discoverAndVerify(
+                to_match_endpoints[0].claimed_id, to_match_endpoints)
+
+    async def _discoverAndVerify(self, claimed_id, to_match_endpoints):
+        """Perform discovery and verify the discovery results, returning
+        the matching endpoint.
+
+        @raises DiscoveryFailure: when discovery fails.
+        """
+        logger.info('Performing discovery on %s' % (claimed_id, ))
+        _, services = await self._discover(claimed_id)
+        return self._verifyDiscoveredServices(claimed_id, services,
+                                              to_match_endpoints)
+
+    async def _checkAuth(self, message, server_url):
+        """Make a check_authentication request to verify this message.
+
+        @returns: True if the request is valid.
+        @rtype: bool
+        """
+        logger.info('Using OpenID check_authentication')
+        request = self._createCheckAuthRequest(message)
+        if request is None:
+            return False
+        try:
+            response = await self._makeKVPost(request, server_url)
+        except (fetchers.HTTPFetchingError, ServerError) as e:
+            e0 = e.args[0]
+            logger.exception('check_authentication failed: %s' % e0)
+            return False
+        else:
+            return await self._processCheckAuthResponse(response, server_url)
+
+    async def _processCheckAuthResponse(self, response, server_url):
+        """Process the response message from a check_authentication
+        request, invalidating associations if requested.
+        """
+        is_valid = response.getArg(OPENID_NS, 'is_valid', 'false')
+
+        invalidate_handle = response.getArg(OPENID_NS, 'invalidate_handle')
+        if invalidate_handle is not None:
+            logger.info('Received "invalidate_handle" from server %s' %
+                        (server_url, ))
+            if self.store is None:
+                logger.error('Unexpectedly got invalidate_handle without '
+                             'a store!')
+            else:
+                await self.store.removeAssociation(server_url,
+                                                   invalidate_handle)
+
+        if is_valid == 'true':
+            return True
+        else:
+            logger.error('Server responds that checkAuth call is not valid')
+            return False
+
+    async def _getAssociation(self, endpoint):
+        """Get an association for the endpoint's server_url, from the
+        store or by negotiating a new one with the server.
+
+        @returns: A valid association for the endpoint's server_url or None
+        @rtype: openid.association.Association or NoneType
+        """
+        assoc = await self.store.getAssociation(endpoint.server_url)
+
+        if assoc is None or assoc.expiresIn <= 0:
+            assoc = await self._negotiateAssociation(endpoint)
+            if assoc is not None:
+                await self.store.storeAssociation(endpoint.server_url, assoc)
+
+        return assoc
+
+    async def _negotiateAssociation(self, endpoint):
+        """Make association requests to the server, attempting to
+        create a new association.
+
+        @returns: a new association object
+
+        @rtype: L{openid.association.Association}
+        """
+        # Get our preferred session/association type from the negotiatior.
+        assoc_type, session_type = self.negotiator.getAllowedType()
+
+        try:
+            return await self._requestAssociation(endpoint, assoc_type,
+                                                  session_type)
+        except ServerError as why:
+            supportedTypes = self._extractSupportedAssociationType(
+                why, endpoint, assoc_type)
+            if supportedTypes is None:
+                return None
+
+        assoc_type, session_type = supportedTypes
+        # Attempt to create an association from the assoc_type
+        # and session_type that the server told us it
+        # supported.
+        try:
+            return await self._requestAssociation(endpoint, assoc_type,
+                                                  session_type)
+        except ServerError as why:
+            # Do not keep trying, since it rejected the
+            # association type that it told us to use.
+            logger.error('Server %s refused its suggested association '
+                         'type: session_type=%s, assoc_type=%s' %
+                         (endpoint.server_url, session_type, assoc_type))
+            return None
+
+    async def _requestAssociation(self, endpoint, assoc_type, session_type):
+        """Make and process one association request to this endpoint's
+        OP endpoint URL.
+
+        @returns: An association object or None if the association
+            processing failed.
+
+        @raises ServerError: when the remote OpenID server returns an error.
+        """
+        assoc_session, args = self._createAssociateRequest(
+            endpoint, assoc_type, session_type)
+
+        try:
+            response = await self._makeKVPost(args, endpoint.server_url)
+        except fetchers.HTTPFetchingError as why:
+            logger.exception('openid.associate request failed: %s' % (why, ))
+            return None
+
+        try:
+            assoc = self._extractAssociation(response, assoc_session)
+        except KeyError as why:
+            logger.exception(
+                'Missing required parameter in response from %s: %s' %
+                (endpoint.server_url, why))
+            return None
+        except ProtocolError as why:
+            logger.exception('Protocol error parsing response from %s: %s' %
+                             (endpoint.server_url, why))
+            return None
+        else:
+            return assoc
@@ -286,7 +286,8 @@ class Consumer(object):
 
     _discover = staticmethod(discover)
 
-    def __init__(self, session, store, consumer_class=None):
+    def __init__(self, session, store, consumer_class=None,
+                 discovery_cache=None):
         """Initialize a Consumer instance.
 
         You should create a new instance of the Consumer object with
@@ -301,6 +302,14 @@ class Consumer(object):
 
         @type store: C{L{openid.store.interface.OpenIDStore}}
 
+        @param discovery_cache: A cache of discovery results to use
+            when beginning and completing authentication, shared
+            between the Consumer instances, or None to always do
+            discovery.
+
+        @type discovery_cache:
+            C{L{openid.consumer.discoverycache.DiscoveryCache}}
+
         @see: L{openid.store.interface}
         @see: L{openid.store}
         """
@@ -309,6 +318,12 @@ class Consumer(object):
             consumer_class = GenericConsumer
         self.consumer = consumer_class(store)
         self._token_key = self.session_key_prefix + self._token
+        if discovery_cache is not None:
+            self._useDiscoveryCache(discovery_cache)
+
+    def _useDiscoveryCache(self, discovery_cache):
+        self._discover = discovery_cache.discover
+        self.consumer._discover = discovery_cache.discover
 
     def begin(self, user_url, anonymous=False):
         """Start the OpenID authentication process. See steps 1-2 in
@@ -610,6 +625,11 @@ class GenericConsumer(object):
         else:
             assoc = self._getAssociation(service_endpoint)
 
+        return self._createAuthRequest(service_endpoint, assoc)
+
+    def _createAuthRequest(self, service_endpoint, assoc):
+        """Create the AuthRequest for the endpoint once we have what
+        association we are going to use with it, if any."""
         request = AuthRequest(service_endpoint, assoc)
         request.return_to_args[self.openid1_nonce_query_arg_name] = mkNonce()
 
@@ -765,6 +785,19 @@ class GenericConsumer(object):
         return message.getArg(BARE_NS, self.openid1_nonce_query_arg_name)
 
     def _idResCheckNonce(self, message, endpoint):
+        server_url, timestamp, salt = self._idResGetNonce(message, endpoint)
+        if (self.store is not None and
+                not self.store.useNonce(server_url, timestamp, salt)):
+            raise ProtocolError('Nonce already used or out of range')
+
+    def _idResGetNonce(self, message, endpoint):
+        """Extract the nonce from a response.
+
+        @returns: The server URL to check the nonce against, and the
+            nonce's timestamp and salt.
+
+        @raises ProtocolError: if the nonce is missing or malformed.
+        """
         if message.isOpenID1():
             # This indicates that the nonce was generated by the consumer
             nonce = self._idResGetNonceOpenID1(message, endpoint)
@@ -781,9 +814,7 @@ class GenericConsumer(object):
         except ValueError as why:
             raise ProtocolError('Malformed nonce: %s' % (why, ))
 
-        if (self.store is not None and
-                not self.store.useNonce(server_url, timestamp, salt)):
-            raise ProtocolError('Nonce already used or out of range')
+        return server_url, timestamp, salt
 
     def _idResCheckSignature(self, message, server_url):
         assoc_handle = message.getArg(OPENID_NS, 'assoc_handle')
@@ -904,6 +935,25 @@ class GenericConsumer(object):
             return self._verifyDiscoveryResultsOpenID1(resp_msg, endpoint)
 
     def _verifyDiscoveryResultsOpenID2(self, resp_msg, endpoint):
+        to_match = self._getOpenID2ToMatch(resp_msg)
+
+        # This is a response without identifiers, so there's really no
+        # checking that we can do, so return an endpoint that's for
+        # the specified `openid.op_endpoint'
+        if to_match.claimed_id is None:
+            return OpenIDServiceEndpoint.fromOPEndpointURL(to_match.server_url)
+
+        if not self._checkDiscoveredEndpointOpenID2(endpoint, to_match):
+            endpoint = self._discoverAndVerify(to_match.claimed_id, [to_match])
+
+        return self._withClaimedID(endpoint, to_match.claimed_id)
+
+    def _getOpenID2ToMatch(self, resp_msg):
+        """Make an endpoint out of the information in an OpenID 2
+        assertion, to compare with discovered endpoints.
+
+        @raises ProtocolError: if the identifiers are inconsistent.
+        """
         to_match = OpenIDServiceEndpoint()
         to_match.type_uris = [OPENID_2_0_TYPE]
         to_match.claimed_id = resp_msg.getArg(OPENID2_NS, 'claimed_id')
@@ -923,46 +973,68 @@ class GenericConsumer(object):
             raise ProtocolError(
                 'openid.claimed_id is present without openid.identity')
 
-        # This is a response without identifiers, so there's really no
-        # checking that we can do, so return an endpoint that's for
-        # the specified `openid.op_endpoint'
-        elif to_match.claimed_id is None:
-            return OpenIDServiceEndpoint.fromOPEndpointURL(to_match.server_url)
+        return to_match
 
+    def _checkDiscoveredEndpointOpenID2(self, endpoint, to_match):
+        """Return whether the endpoint discovered when the request was
+        made can be used for an OpenID 2 assertion, or discovery has
+        to be done again.
+        """
         # The claimed ID doesn't match, so we have to do discovery
         # again. This covers not using sessions, OP identifier
         # endpoints and responses that didn't match the original
         # request.
         if not endpoint:
             logger.info('No pre-discovered information supplied.')
-            endpoint = self._discoverAndVerify(to_match.claimed_id, [to_match])
+            return False
         elif endpoint.isOPIdentifier():
             logger.info(
                 'Pre-discovered information based on OP-ID; need to rediscover.'
             )
-            endpoint = self._discoverAndVerify(to_match.claimed_id, [to_match])
+            return False
+
+        # The claimed ID matches, so we use the endpoint that we
+        # discovered in initiation. This should be the most common
+        # case.
+        try:
+            self._verifyDiscoverySingle(endpoint, to_match)
+        except ProtocolError as e:
+            logger.exception(
+                "Error attempting to use stored discovery information: " +
+                str(e))
+            logger.info("Attempting discovery to verify endpoint")
+            return False
         else:
-            # The claimed ID matches, so we use the endpoint that we
-            # discovered in initiation. This should be the most common
-            # case.
-            try:
-                self._verifyDiscoverySingle(endpoint, to_match)
-            except ProtocolError as e:
-                logger.exception(
-                    "Error attempting to use stored discovery information: " +
-                    str(e))
-                logger.info("Attempting discovery to verify endpoint")
-                endpoint = self._discoverAndVerify(to_match.claimed_id,
-                                                   [to_match])
+            return True
 
+    def _withClaimedID(self, endpoint, claimed_id):
         # The endpoint we return should have the claimed ID from the
         # message we just verified, fragment and all.
-        if endpoint.claimed_id != to_match.claimed_id:
+        if endpoint.claimed_id != claimed_id:
             endpoint = copy.copy(endpoint)
-            endpoint.claimed_id = to_match.claimed_id
+            endpoint.claimed_id = claimed_id
         return endpoint
 
     def _verifyDiscoveryResultsOpenID1(self, resp_msg, endpoint):
+        to_match_endpoints = self._getOpenID1ToMatch(resp_msg, endpoint)
+
+        if (endpoint is not None and
+                self._checkDiscoveredEndpointOpenID1(endpoint,
+                                                     *to_match_endpoints)):
+            return endpoint
+
+        # Endpoint is either bad (failed verification) or None
+        return self._discoverAndVerify(to_match_endpoints[0].claimed_id,
+                                       to_match_endpoints)
+
+    def _getOpenID1ToMatch(self, resp_msg, endpoint):
+        """Make endpoints out of the information in an OpenID 1
+        assertion, to compare with discovered endpoints.
+
+        @returns: An OpenID 1.1 endpoint and an OpenID 1.0 endpoint.
+
+        @raises ProtocolError: if the identity is missing.
+        """
         claimed_id = resp_msg.getArg(BARE_NS,
                                      self.openid1_return_to_identifier_name)
 
@@ -987,22 +1059,27 @@ class GenericConsumer(object):
         to_match_1_0 = copy.copy(to_match)
         to_match_1_0.type_uris = [OPENID_1_0_TYPE]
 
-        if endpoint is not None:
-            try:
-                try:
-                    self._verifyDiscoverySingle(endpoint, to_match)
-                except TypeURIMismatch:
-                    self._verifyDiscoverySingle(endpoint, to_match_1_0)
-            except ProtocolError as e:
-                logger.exception(
-                    "Error attempting to use stored discovery information: " +
-                    str(e))
-                logger.info("Attempting discovery to verify endpoint")
-            else:
-                return endpoint
+        return [to_match, to_match_1_0]
 
-        # Endpoint is either bad (failed verification) or None
-        return self._discoverAndVerify(claimed_id, [to_match, to_match_1_0])
+    def _checkDiscoveredEndpointOpenID1(self, endpoint, to_match,
+                                        to_match_1_0):
+        """Return whether the endpoint discovered when the request was
+        made can be used for an OpenID 1 assertion, or discovery has
+        to be done again.
+        """
+        try:
+            try:
+                self._verifyDiscoverySingle(endpoint, to_match)
+            except TypeURIMismatch:
+                self._verifyDiscoverySingle(endpoint, to_match_1_0)
+        except ProtocolError as e:
+            logger.exception(
+                "Error attempting to use stored discovery information: " +
+                str(e))
+            logger.info("Attempting discovery to verify endpoint")
+            return False
+        else:
+            return True
 
     def _verifyDiscoverySingle(self, endpoint, to_match):
         """Verify that the given endpoint matches the information
@@ -1069,15 +1146,15 @@ class GenericConsumer(object):
         """
         logger.info('Performing discovery on %s' % (claimed_id, ))
         _, services = self._discover(claimed_id)
-        if not services:
-            raise DiscoveryFailure('No OpenID information found at %s' %
-                                   (claimed_id, ), None)
         return self._verifyDiscoveredServices(claimed_id, services,
                                               to_match_endpoints)
 
     def _verifyDiscoveredServices(self, claimed_id, services,
                                   to_match_endpoints):
         """See @L{_discoverAndVerify}"""
+        if not services:
+            raise DiscoveryFailure('No OpenID information found at %s' %
+                                   (claimed_id, ), None)
 
         # Search the services resulting from discovery to find one
         # that matches the information from the assertion
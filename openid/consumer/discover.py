@@ -11,18 +11,30 @@ __all__ = [
     'OPENID_IDP_2_0_TYPE',
     'OpenIDServiceEndpoint',
     'discover',
+    'discoverAsync',
+    'discoverWithExpiry',
+    'discoverWithExpiryAsync',
+    'getFailureCache',
+    'setFailureCache',
 ]
 
+import asyncio
+import calendar
+import contextlib
+import copy
+import threading
 import urllib.parse
 import logging
 
 from openid import fetchers, urinorm
 
 from openid import yadis
-from openid.yadis.etxrd import nsTag, XRDSError, XRD_NS_2_0
+from openid.yadis.etxrd import nsTag, XRDSError, XRD_NS_2_0, parseXRDS, \
+     iterServices, getYadisXRD, getXRDExpiration
 from openid.yadis.services import applyFilter as extractServices
 from openid.yadis.discover import discover as yadisDiscover
-from openid.yadis.discover import DiscoveryFailure
+from openid.yadis.discover import discoverAsync as yadisDiscoverAsync
+from openid.yadis.discover import DiscoveryFailure, getResponseExpires
 from openid.yadis import xrires, filters
 from openid.yadis import xri
 
@@ -376,43 +388,128 @@ def discoverYadis(uri):
 
     @raises DiscoveryFailure: when discovery fails.
     """
+    return _discoverYadis(uri)[:2]
+
+
+def _discoverYadis(uri):
+    """Like L{discoverYadis}, but also return when the result expires.
+
+    @return: (claimed_id, services, expires)
+    """
     # Might raise a yadis.discover.DiscoveryFailure if no document
     # came back for that URI at all.  I don't think falling back
     # to OpenID 1.0 discovery on the same URL will help, so don't
     # bother to catch it.
     response = yadisDiscover(uri)
+    result = _servicesFromYadis(response)
+    if result is None:
+        # if we got the Yadis content-type or followed the Yadis
+        # header, re-fetch the document without following the Yadis
+        # header, with no Accept header.
+        return _discoverNoYadis(uri)
+    return result
+
+
+async def discoverYadisAsync(uri):
+    """Like L{discoverYadis}, for use in asyncio code."""
+    return (await _discoverYadisAsync(uri))[:2]
+
+
+async def _discoverYadisAsync(uri):
+    response = await yadisDiscoverAsync(uri)
+    result = _servicesFromYadis(response)
+    if result is None:
+        return await _discoverNoYadisAsync(uri)
+    return result
 
+
+def _servicesFromYadis(response):
+    """Extract the OpenID services from the result of Yadis discovery.
+
+    @return: (claimed_id, services, expires), or None if discovery
+        should be done again without Yadis
+    """
     yadis_url = response.normalized_uri
     body = response.response_text
+    expires = response.expires
+    flt = filters.mkFilter(OpenIDServiceEndpoint)
+    openid_services = []
     try:
-        openid_services = OpenIDServiceEndpoint.fromXRDS(yadis_url, body)
+        xrds_tree = parseXRDS(body)
+        for service_element in iterServices(xrds_tree):
+            openid_services.extend(
+                flt.getServiceEndpoints(yadis_url, service_element))
     except XRDSError:
         # Does not parse as a Yadis XRDS file
         openid_services = []
+    else:
+        expires = _earliest(expires, _getXRDSExpires(xrds_tree))
 
     if not openid_services:
         # Either not an XRDS or there are no OpenID services.
 
         if response.isXRDS():
-            # if we got the Yadis content-type or followed the Yadis
-            # header, re-fetch the document without following the Yadis
-            # header, with no Accept header.
-            return discoverNoYadis(uri)
+            return None
 
         # Try to parse the response as HTML.
         # <link rel="...">
         openid_services = OpenIDServiceEndpoint.fromHTML(yadis_url, body)
 
-    return (yadis_url, getOPOrUserServices(openid_services))
+    return (yadis_url, getOPOrUserServices(openid_services), expires)
+
+
+def _getXRDSExpires(xrds_tree):
+    """Return when the Yadis XRD of an XRDS document expires, as a
+    time.time() value, or None if it does not say."""
+    try:
+        expiration = getXRDExpiration(getYadisXRD(xrds_tree))
+    except (XRDSError, ValueError):
+        return None
+
+    if expiration is None:
+        return None
+    return calendar.timegm(expiration.timetuple())
+
+
+def _earliest(*times):
+    """Return the earliest of some expiration times, ignoring those
+    that are None."""
+    times = [t for t in times if t is not None]
+    if not times:
+        return None
+    return min(times)
 
 
 def discoverXRI(iname):
-    endpoints = []
     iname = normalizeXRI(iname)
     try:
         canonicalID, services = xrires.ProxyResolver().query(
             iname, OpenIDServiceEndpoint.openid_type_uris)
+    except XRDSError:
+        logger.exception('xrds error on ' + iname)
+        return iname, []
+    return _servicesFromXRI(iname, canonicalID, services)
+
+
+async def discoverXRIAsync(iname):
+    """Like L{discoverXRI}, for use in asyncio code."""
+    iname = normalizeXRI(iname)
+    try:
+        canonicalID, services = await xrires.ProxyResolver().queryAsync(
+            iname, OpenIDServiceEndpoint.openid_type_uris)
+    except XRDSError:
+        logger.exception('xrds error on ' + iname)
+        return iname, []
+    return _servicesFromXRI(iname, canonicalID, services)
+
 
+def _servicesFromXRI(iname, canonicalID, services):
+    """Extract the OpenID services from the result of XRI resolution.
+
+    @return: (iname, services)
+    """
+    endpoints = []
+    try:
         if canonicalID is None:
             raise XRDSError('No CanonicalID found for XRI %r' % (iname, ))
 
@@ -434,7 +531,28 @@ def discoverXRI(iname):
 
 
 def discoverNoYadis(uri):
+    return _discoverNoYadis(uri)[:2]
+
+
+def _discoverNoYadis(uri):
     http_resp = fetchers.fetch(uri)
+    return _servicesFromHTML(http_resp)
+
+
+async def discoverNoYadisAsync(uri):
+    return (await _discoverNoYadisAsync(uri))[:2]
+
+
+async def _discoverNoYadisAsync(uri):
+    http_resp = await fetchers.fetchAsync(uri)
+    return _servicesFromHTML(http_resp)
+
+
+def _servicesFromHTML(http_resp):
+    """Extract the OpenID services from an HTML page.
+
+    @return: (claimed_id, services, expires)
+    """
     if http_resp.status not in (200, 206):
         raise DiscoveryFailure(
             'HTTP Response status from identity URL host is not 200. '
@@ -443,10 +561,10 @@ def discoverNoYadis(uri):
     claimed_id = http_resp.final_url
     openid_services = OpenIDServiceEndpoint.fromHTML(claimed_id,
                                                      http_resp.body)
-    return claimed_id, openid_services
+    return claimed_id, openid_services, getResponseExpires(http_resp)
 
 
-def discoverURI(uri):
+def _normalizeHTTPURI(uri):
     parsed = urllib.parse.urlparse(uri)
     if parsed[0] and parsed[1]:
         if parsed[0] not in ['http', 'https']:
@@ -454,14 +572,281 @@ def discoverURI(uri):
     else:
         uri = 'http://' + uri
 
-    uri = normalizeURL(uri)
-    claimed_id, openid_services = discoverYadis(uri)
+    return normalizeURL(uri)
+
+
+def discoverURI(uri):
+    return _discoverURI(uri)[:2]
+
+
+def _discoverURI(uri):
+    uri = _normalizeHTTPURI(uri)
+    claimed_id, openid_services, expires = _discoverYadis(uri)
     claimed_id = normalizeURL(claimed_id)
-    return claimed_id, openid_services
+    return claimed_id, openid_services, expires
 
 
-def discover(identifier):
+async def discoverURIAsync(uri):
+    return (await _discoverURIAsync(uri))[:2]
+
+
+async def _discoverURIAsync(uri):
+    uri = _normalizeHTTPURI(uri)
+    claimed_id, openid_services, expires = await _discoverYadisAsync(uri)
+    claimed_id = normalizeURL(claimed_id)
+    return claimed_id, openid_services, expires
+
+
+# The DiscoveryFailureCache that discovery checks hosts with, or None.
+# Do not access this variable outside of this module.
+_failure_cache = None
+
+
+def getFailureCache():
+    """Return the failure cache that discovery uses, or None if it
+    does not use one.
+
+    @rtype: L{DiscoveryFailureCache<openid.consumer.failurecache.DiscoveryFailureCache>}
+    """
+    return _failure_cache
+
+
+def setFailureCache(failure_cache):
+    """Make discovery fail fast on hosts that have failed recently,
+    according to a failure cache, or stop doing so if it is None.
+
+    @type failure_cache: L{DiscoveryFailureCache<openid.consumer.failurecache.DiscoveryFailureCache>}
+    """
+    global _failure_cache
+    _failure_cache = failure_cache
+
+
+def _identifierHost(identifier):
+    """Return the host that discovery on the identifier depends on: the
+    XRI proxy resolver's for XRIs."""
+    if xri.identifierScheme(identifier) == "XRI":
+        url = xrires.DEFAULT_PROXY
+    else:
+        url = _normalizeHTTPURI(identifier)
+    return urllib.parse.urlsplit(url).hostname
+
+
+@contextlib.contextmanager
+def _trackFailures(identifier):
+    """Fail fast if the failure cache says the identifier's host is
+    failing, and record how discovery on it goes.
+
+    @raises HostBackedOff: if the host is failing.
+    """
+    failure_cache = _failure_cache
+    if failure_cache is None:
+        yield
+        return
+
+    host = _identifierHost(identifier)
+    failure_cache.check(host)
+    try:
+        yield
+    except Exception as why:
+        if failure_cache.isHostFailure(why):
+            failure_cache.recordFailure(host, why)
+        raise
+    else:
+        failure_cache.recordSuccess(host)
+
+
+def _identifierKey(identifier):
+    """Return the normalized XRI or URL that discovery on the identifier
+    is done for.
+
+    @raises DiscoveryFailure: When the identifier is not a usable URL.
+    """
     if xri.identifierScheme(identifier) == "XRI":
-        return discoverXRI(identifier)
+        return normalizeXRI(identifier)
     else:
-        return discoverURI(identifier)
+        return _normalizeHTTPURI(identifier)
+
+
+def _copyResult(result):
+    """Copy the endpoints of a discovery result, since the consumer
+    keeps them in its session."""
+    claimed_id, services = result[:2]
+    services = [copy.copy(service) for service in services]
+    return (claimed_id, services) + tuple(result[2:])
+
+
+def _copyException(exception):
+    """Copy the exception a discovery failed with, for a caller that
+    waited on it to raise.  Raising one exception object in several
+    callers would tangle their tracebacks together."""
+    try:
+        copied = copy.copy(exception)
+    except Exception:
+        # Exceptions whose constructors take other arguments than
+        # they keep in args can not be copied the usual way
+        cls = type(exception)
+        copied = cls.__new__(cls, *exception.args)
+        copied.args = exception.args
+        copied.__dict__.update(exception.__dict__)
+    return copied
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.exception = None
+
+
+class _SingleFlight(object):
+    """I make concurrent discoveries of the same identifier share one
+    set of fetches.
+
+    The first caller for a key does the discovery, and the callers that
+    come while it is in flight wait for its result or exception instead
+    of doing their own.  Threads coalesce with threads, and coroutines
+    with the coroutines on the same event loop.  Each caller gets its
+    own copies of the endpoints, and the callers that waited get their
+    own copies of the exception, chained to the original.
+    """
+
+    def __init__(self):
+        # key -> _Call
+        self._calls = {}
+        # (event loop, key) -> asyncio.Task
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leading = call is None
+            if leading:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if leading:
+            try:
+                call.result = func(*args)
+            except BaseException as why:
+                call.exception = why
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result
+
+        call.done.wait()
+        if call.exception is not None:
+            raise _copyException(call.exception) from call.exception
+        return _copyResult(call.result)
+
+    async def callAsync(self, key, func, *args):
+        loop = asyncio.get_running_loop()
+        task_key = (loop, key)
+        task = self._tasks.get(task_key)
+        leading = task is None
+        if leading:
+            # The discovery runs in its own task, so that cancelling
+            # the caller that started it does not cancel it for the
+            # callers waiting on it
+            task = loop.create_task(func(*args))
+            self._tasks[task_key] = task
+            task.add_done_callback(
+                lambda task: self._tasks.pop(task_key, None))
+
+        try:
+            result = await asyncio.shield(task)
+        except BaseException as why:
+            # Only an exception from the discovery itself is shared;
+            # this caller being cancelled is its own
+            if leading or not task.done() or task.cancelled():
+                raise
+            raise _copyException(why) from why
+        return _copyResult(result)
+
+
+# The discoveries that are in flight.
+_in_flight = _SingleFlight()
+
+
+def _flightKey(kind, identifier):
+    try:
+        return (kind, _identifierKey(identifier))
+    except DiscoveryFailure:
+        # Let discovery itself report the failure
+        return (kind, identifier)
+
+
+def discover(identifier):
+    return _in_flight.call(_flightKey('discover', identifier), _discover,
+                           identifier)
+
+
+def _discover(identifier):
+    with _trackFailures(identifier):
+        if xri.identifierScheme(identifier) == "XRI":
+            return discoverXRI(identifier)
+        else:
+            return discoverURI(identifier)
+
+
+async def discoverAsync(identifier):
+    """Like L{discover}, for use in asyncio code.
+
+    @return: (claimed_id, services)
+    @rtype: (str, list(OpenIDServiceEndpoint))
+
+    @raises DiscoveryFailure: when discovery fails.
+    """
+    return await _in_flight.callAsync(_flightKey('discover', identifier),
+                                      _discoverAsync, identifier)
+
+
+async def _discoverAsync(identifier):
+    with _trackFailures(identifier):
+        if xri.identifierScheme(identifier) == "XRI":
+            return await discoverXRIAsync(identifier)
+        else:
+            return await discoverURIAsync(identifier)
+
+
+def discoverWithExpiry(identifier):
+    """Like L{discover}, but also return when the result should be
+    discovered again, for caching it.  That is the earliest of the
+    C{Expires} of the Yadis XRD and the expiration times given by the
+    HTTP caching headers of the documents fetched, or None if none of
+    them say.  XRI resolution results do not say.
+
+    @return: (claimed_id, services, expires)
+    @rtype: (str, list(OpenIDServiceEndpoint), float or NoneType)
+
+    @raises DiscoveryFailure: when discovery fails.
+    """
+    return _in_flight.call(_flightKey('expiry', identifier),
+                           _discoverWithExpiry, identifier)
+
+
+def _discoverWithExpiry(identifier):
+    with _trackFailures(identifier):
+        if xri.identifierScheme(identifier) == "XRI":
+            return discoverXRI(identifier) + (None, )
+        else:
+            return _discoverURI(identifier)
+
+
+async def discoverWithExpiryAsync(identifier):
+    """Like L{discoverWithExpiry}, for use in asyncio code."""
+    return await _in_flight.callAsync(_flightKey('expiry', identifier),
+                                      _discoverWithExpiryAsync, identifier)
+
+
+async def _discoverWithExpiryAsync(identifier):
+    with _trackFailures(identifier):
+        if xri.identifierScheme(identifier) == "XRI":
+            return (await discoverXRIAsync(identifier)) + (None, )
+        else:
+            return await _discoverURIAsync(identifier)
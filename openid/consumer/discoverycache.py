@@ -0,0 +1,221 @@
+# -*- test-case-name: openid.test.test_discoverycache -*-
+"""Caches of OpenID discovery results.
+
+C{L{Consumer.begin<openid.consumer.consumer.Consumer.begin>}} does
+discovery on every login, and C{complete} may do it again to verify
+the assertion.  With a discovery cache, repeat logins with the same
+identifier skip those HTTP round trips::
+
+    cache = discoverycache.MemoryDiscoveryCache()
+    consumer = Consumer(session, store, discovery_cache=cache)
+
+Results are kept until the Yadis XRD or the HTTP caching headers of
+the discovered documents say they expire, or for
+C{L{default_ttl<DiscoveryCache.default_ttl>}} seconds if they do not
+say.  C{L{RedisDiscoveryCache}} shares the results between processes.
+"""
+
+__all__ = [
+    'DiscoveryCache',
+    'MemoryDiscoveryCache',
+    'RedisDiscoveryCache',
+]
+
+import asyncio
+import collections
+import copy
+import functools
+import pickle
+import threading
+import time
+
+from openid.consumer.discover import discoverWithExpiry, \
+     discoverWithExpiryAsync, _identifierKey
+
+
+class DiscoveryCache(object):
+    """The interface for discovery caches, and the logic they share.
+    Subclasses implement L{get} and L{set}.  L{discoverAsync} uses
+    L{getAsync} and L{setAsync}, which call them in an executor unless
+    a subclass that does not block overrides them.
+
+    @ivar default_ttl: The number of seconds to keep a result whose
+        documents do not say when they expire.
+
+    @ivar max_ttl: The longest number of seconds to keep any result.
+
+    @ivar executor: The C{concurrent.futures} executor to call L{get}
+        and L{set} in from L{discoverAsync}, or C{None} for the event
+        loop's default one.
+    """
+
+    def __init__(self, default_ttl=300, max_ttl=24 * 60 * 60,
+                 executor=None):
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.executor = executor
+
+    def key(self, identifier):
+        """Return the key to cache discovery on an identifier under:
+        its normalized XRI or URL.
+
+        @raises DiscoveryFailure: When the identifier is not a usable
+            URL.
+        """
+        return _identifierKey(identifier)
+
+    def get(self, key):
+        """Return the cached result of discovery, or None.
+
+        @returns: (claimed_id, services) or None
+        @returntype: (str, list(OpenIDServiceEndpoint)) or NoneType
+        """
+        raise NotImplementedError
+
+    def set(self, key, claimed_id, services, ttl):
+        """Cache the result of discovery for C{ttl} seconds."""
+        raise NotImplementedError
+
+    async def getAsync(self, key):
+        """Like L{get}, without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.get, key)
+
+    async def setAsync(self, key, claimed_id, services, ttl):
+        """Like L{set}, without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor,
+            functools.partial(self.set, key, claimed_id, services, ttl))
+
+    def discover(self, identifier):
+        """Like L{discover<openid.consumer.discover.discover>}, but
+        using the cache.
+
+        @return: (claimed_id, services)
+        @rtype: (str, list(OpenIDServiceEndpoint))
+
+        @raises DiscoveryFailure: when discovery fails.
+        """
+        key = self.key(identifier)
+        result = self.get(key)
+        if result is None:
+            claimed_id, services, expires = discoverWithExpiry(identifier)
+            ttl = self._ttl(expires)
+            # Finding no services is not cached, in case the user is
+            # setting their identifier up
+            if services and ttl > 0:
+                self.set(key, claimed_id, services, ttl)
+            result = claimed_id, services
+        return result
+
+    async def discoverAsync(self, identifier):
+        """Like L{discoverAsync<openid.consumer.discover.discoverAsync>},
+        but using the cache."""
+        key = self.key(identifier)
+        result = await self.getAsync(key)
+        if result is None:
+            claimed_id, services, expires = \
+                await discoverWithExpiryAsync(identifier)
+            ttl = self._ttl(expires)
+            if services and ttl > 0:
+                await self.setAsync(key, claimed_id, services, ttl)
+            result = claimed_id, services
+        return result
+
+    def _ttl(self, expires):
+        """The number of seconds to keep a result that expires at
+        C{expires}, or C{None} if its documents do not say."""
+        if expires is None:
+            ttl = self.default_ttl
+        else:
+            ttl = expires - time.time()
+        return min(ttl, self.max_ttl)
+
+
+class MemoryDiscoveryCache(DiscoveryCache):
+    """A discovery cache in memory, holding the C{max_entries} most
+    recently used results.  It is safe to share between threads.
+    """
+
+    def __init__(self, max_entries=1000, **kwargs):
+        """
+        @param max_entries: The largest number of results to keep.
+        @type max_entries: int
+
+        @param kwargs: See L{DiscoveryCache}.
+        """
+        DiscoveryCache.__init__(self, **kwargs)
+        self.max_entries = max_entries
+        # key -> (time to evict, claimed_id, services)
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                evict_at, claimed_id, services = self._cache[key]
+            except KeyError:
+                return None
+
+            if evict_at <= time.time():
+                del self._cache[key]
+                return None
+
+            self._cache.move_to_end(key)
+
+        # The consumer keeps the endpoints in its session, so hand out
+        # copies
+        return claimed_id, [copy.copy(service) for service in services]
+
+    def set(self, key, claimed_id, services, ttl):
+        services = [copy.copy(service) for service in services]
+        with self._lock:
+            self._cache[key] = (time.time() + ttl, claimed_id, services)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    # Nothing here blocks, so there is no need for an executor
+
+    async def getAsync(self, key):
+        return self.get(key)
+
+    async def setAsync(self, key, claimed_id, services, ttl):
+        self.set(key, claimed_id, services, ttl)
+
+
+class RedisDiscoveryCache(DiscoveryCache):
+    """A discovery cache kept in a key-value server that speaks the
+    Redis protocol, so that it is shared by all of the processes using
+    it.  Each result is a pickled key with a native expiration time.
+
+    Any client object with the C{redis-py} interface for C{GET} and
+    C{SET} will do.  Only give this cache a server that no untrusted
+    party can write to, since results are unpickled.
+    """
+
+    def __init__(self, client, prefix='openid:discovery:', **kwargs):
+        """
+        @param client: The client to use to talk to the server,
+            such as a C{redis.Redis} instance.
+
+        @param prefix: A string to start the names of all of the keys
+            the cache uses with.
+        @type prefix: str
+
+        @param kwargs: See L{DiscoveryCache}.
+        """
+        DiscoveryCache.__init__(self, **kwargs)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, claimed_id, services, ttl):
+        value = pickle.dumps((claimed_id, services))
+        self.client.set(self.prefix + key, value, ex=max(int(ttl), 1))
@@ -0,0 +1,138 @@
+# -*- test-case-name: openid.test.test_failurecache -*-
+"""A per-host cache of discovery failures.
+
+When an identity host is down, every attempt to discover an identifier
+on it waits for the fetch to time out.  With a failure cache, discovery
+on a host that has just failed raises C{L{HostBackedOff}} at once
+instead, for a backoff window that doubles with each further failure::
+
+    from openid.consumer import discover, failurecache
+    discover.setFailureCache(failurecache.DiscoveryFailureCache())
+
+A successful discovery on the host clears its failures.
+"""
+
+__all__ = [
+    'DiscoveryFailureCache',
+    'HostBackedOff',
+]
+
+import collections
+import threading
+import time
+
+from openid import fetchers
+from openid.yadis.discover import DiscoveryFailure
+
+
+class HostBackedOff(DiscoveryFailure):
+    """Raised instead of doing discovery on a host that has failed
+    recently.
+
+    @ivar host: The host that failed.
+    @ivar retry_at: When discovery on the host will be tried again, as
+        a time.time() value.
+    """
+
+    def __init__(self, host, failures, retry_at):
+        DiscoveryFailure.__init__(
+            self, 'Discovery on %s failed %d times; not trying it again for '
+            '%d seconds' % (host, failures, retry_at - time.time()), None)
+        self.host = host
+        self.retry_at = retry_at
+
+
+class _HostFailures(object):
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0
+        self.last_error = None
+
+
+class DiscoveryFailureCache(object):
+    """I remember which hosts discovery has failed on, and for how long
+    to fail fast on them.
+
+    After the first failure on a host, discovery on it is not tried for
+    C{base_delay} seconds; each further failure multiplies the delay by
+    C{factor}, up to C{max_delay}.  It is safe to share between threads.
+
+    @ivar max_hosts: The largest number of failing hosts to remember.
+        The least recently failed are forgotten first.
+    """
+
+    def __init__(self, base_delay=1, max_delay=300, factor=2,
+                 max_hosts=10000):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.max_hosts = max_hosts
+        # host -> _HostFailures, least recently failed first
+        self._hosts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def isHostFailure(self, exception):
+        """Does this exception from discovery mean that the host is
+        failing, rather than that this identifier is unusable?
+
+        Fetching and network errors, responses that never came, and
+        server errors count.  Other HTTP errors, such as 404 for a
+        mistyped identifier, do not, so that one user's mistake cannot
+        make a whole OP unavailable.
+        """
+        if isinstance(exception, (fetchers.HTTPFetchingError, OSError)):
+            return True
+
+        if isinstance(exception, DiscoveryFailure):
+            response = exception.http_response
+            return (response is None or response.status is None or
+                    response.status >= 500)
+
+        return False
+
+    def check(self, host):
+        """Fail fast if discovery on the host is backed off.
+
+        @raises HostBackedOff: if it is.
+        """
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None or entry.retry_at <= time.time():
+                return
+            failures, retry_at = entry.failures, entry.retry_at
+        raise HostBackedOff(host, failures, retry_at)
+
+    def recordFailure(self, host, exception):
+        with self._lock:
+            entry = self._hosts.pop(host, None)
+            if entry is None:
+                entry = _HostFailures()
+            entry.failures += 1
+            # Bound the exponent so that the delay stays a small number
+            exponent = min(entry.failures - 1, 64)
+            delay = min(self.base_delay * self.factor**exponent,
+                        self.max_delay)
+            entry.retry_at = time.time() + delay
+            entry.last_error = str(exception)
+            self._hosts[host] = entry
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+
+    def recordSuccess(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def getState(self):
+        """Report the hosts that have failed since they last succeeded.
+
+        @returns: a dictionary from each host to a dictionary with its
+            number of C{failures}, the time discovery on it is
+            C{retry_at}, and its C{last_error}.
+        @returntype: {str: dict}
+        """
+        with self._lock:
+            return dict((host, {
+                'failures': entry.failures,
+                'retry_at': entry.retry_at,
+                'last_error': entry.last_error,
+            }) for (host, entry) in self._hosts.items())
@@ -4,10 +4,23 @@ This module contains the HTTP fetcher interface and several implementations.
 """
 
 __all__ = [
-    'fetch', 'getDefaultFetcher', 'setDefaultFetcher', 'HTTPResponse',
-    'HTTPFetcher', 'createHTTPFetcher', 'HTTPFetchingError', 'HTTPError'
+    'fetch', 'fetchAsync', 'fetchStream', 'getDefaultFetcher',
+    'setDefaultFetcher', 'getDefaultAsyncFetcher', 'setDefaultAsyncFetcher',
+    'HTTPResponse', 'HTTPStreamResponse', 'HTTPFetcher', 'AsyncHTTPFetcher',
+    'CachingFetcher', 'AsyncCachingFetcher', 'HTTPCache', 'createHTTPFetcher',
+    'createAsyncHTTPFetcher', 'HTTPFetchingError', 'HTTPError'
 ]
 
+import asyncio
+import collections
+import email.utils
+import functools
+import hashlib
+import json
+import os
+import ssl
+import tempfile
+import threading
 import urllib.request
 import urllib.error
 import urllib.parse
@@ -49,6 +62,34 @@ def fetch(url, body=None, headers=None):
     return fetcher.fetch(url, body, headers)
 
 
+def fetchStream(url, headers=None):
+    """Invoke the fetchStream method on the default fetcher, or its
+    fetch method if it does not have one.
+
+    @return: a L{HTTPStreamResponse} to read the body from, if the
+        default fetcher can stream it, or else an L{HTTPResponse}
+    @rtype: L{HTTPResponse}
+
+    @raises Exception: any exceptions that may be raised by the default fetcher
+    """
+    fetcher = getDefaultFetcher()
+    fetch_stream = getattr(fetcher, 'fetchStream', None)
+    if fetch_stream is None:
+        return fetcher.fetch(url, None, headers)
+    return fetch_stream(url, headers)
+
+
+async def fetchAsync(url, body=None, headers=None):
+    """Like L{fetch}, but for asyncio code: invoke the fetch method on
+    the default asynchronous fetcher.
+
+    @raises Exception: any exceptions that may be raised by the default
+        asynchronous fetcher
+    """
+    fetcher = getDefaultAsyncFetcher()
+    return await fetcher.fetch(url, body, headers)
+
+
 def createHTTPFetcher():
     """Create a default HTTP fetcher instance
 
@@ -61,6 +102,12 @@ def createHTTPFetcher():
     return fetcher
 
 
+def createAsyncHTTPFetcher():
+    """Create a default asynchronous HTTP fetcher instance, which
+    keeps connections alive and reuses them."""
+    return AsyncioHTTPFetcher()
+
+
 # Contains the currently set HTTP fetcher. If it is set to None, the
 # library will call createHTTPFetcher() to set it. Do not access this
 # variable outside of this module.
@@ -103,6 +150,45 @@ def setDefaultFetcher(fetcher, wrap_exceptions=True):
         _default_fetcher = ExceptionWrappingFetcher(fetcher)
 
 
+# Like _default_fetcher, for the asynchronous HTTP fetcher.
+_default_async_fetcher = None
+
+
+def getDefaultAsyncFetcher():
+    """Return the default asynchronous fetcher instance, used by
+    L{fetchAsync}.  If no fetcher has been set, it will create a
+    default one.
+
+    @return: the default asynchronous fetcher
+    @rtype: AsyncHTTPFetcher
+    """
+    global _default_async_fetcher
+
+    if _default_async_fetcher is None:
+        setDefaultAsyncFetcher(createAsyncHTTPFetcher())
+
+    return _default_async_fetcher
+
+
+def setDefaultAsyncFetcher(fetcher, wrap_exceptions=True):
+    """Set the default asynchronous fetcher.  To use a blocking
+    L{HTTPFetcher} from asyncio code, wrap it in an L{ExecutorFetcher}.
+
+    @param fetcher: The fetcher to use as the default asynchronous
+        HTTP fetcher
+    @type fetcher: AsyncHTTPFetcher
+
+    @param wrap_exceptions: Whether to wrap exceptions thrown by the
+        fetcher with HTTPFetchingError; see L{setDefaultFetcher}.
+    @type wrap_exceptions: bool
+    """
+    global _default_async_fetcher
+    if fetcher is None or not wrap_exceptions:
+        _default_async_fetcher = fetcher
+    else:
+        _default_async_fetcher = AsyncExceptionWrappingFetcher(fetcher)
+
+
 def usingCurl():
     """Whether the currently set HTTP fetcher is a Curl HTTP fetcher."""
     fetcher = getDefaultFetcher()
@@ -129,6 +215,42 @@ class HTTPResponse(object):
                                           self.final_url)
 
 
+class HTTPStreamResponse(HTTPResponse):
+    """An HTTP response whose body has not been read yet, so that it
+    can be read as far as it is needed.  Its C{body} is None.  Close
+    it when done with it, to release the connection.
+    """
+
+    def __init__(self, final_url, status, headers, stream):
+        """
+        @param stream: The body, with C{read(size)} and C{close()}
+            methods like a binary file's.
+        """
+        HTTPResponse.__init__(self, final_url, status, headers)
+        self.stream = stream
+
+    def read(self, size=-1):
+        """Read up to C{size} bytes of the body, or the rest of it if
+        C{size} is negative.
+
+        @returntype: bytes
+        """
+        # http.client responses only take a negative size from
+        # Python 3.8 on
+        if size is None or size < 0:
+            return self.stream.read()
+        return self.stream.read(size)
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class HTTPFetcher(object):
     """
     This class is the interface for openid HTTP fetchers.  This
@@ -158,6 +280,41 @@ class HTTPFetcher(object):
         """
         raise NotImplementedError
 
+    def fetchStream(self, url, headers=None):
+        """
+        This performs an HTTP GET like L{fetch}, but may return before
+        reading the body, so that the caller can stop reading it once
+        it has what it needs.  Fetchers that cannot do that fetch the
+        whole body, which is what this implementation does.
+
+        @return: An L{HTTPStreamResponse}, or an L{HTTPResponse} if
+            the body has been read.
+        @rtype: L{HTTPResponse}
+        """
+        return self.fetch(url, None, headers)
+
+
+class AsyncHTTPFetcher(object):
+    """
+    This class is the interface for openid HTTP fetchers used from
+    asyncio code.  It is like L{HTTPFetcher}, except that L{fetch} is
+    a coroutine.
+    """
+
+    async def fetch(self, url, body=None, headers=None):
+        """
+        This performs an HTTP POST or GET, following redirects along
+        the way.  See L{HTTPFetcher.fetch}.
+
+        @rtype: L{HTTPResponse}
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """Release any resources, such as idle connections, that this
+        fetcher is holding on to."""
+        pass
+
 
 def _allowedURL(url):
     parsed = urllib.parse.urlparse(url)
@@ -165,6 +322,60 @@ def _allowedURL(url):
     return parsed[0] in ('http', 'https')
 
 
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+def _redirect(url, location, status, method, body, headers):
+    """Work out the request to make after a redirect response.
+
+    @returns: the URL, method, body and headers to request
+    """
+    url = urllib.parse.urljoin(url, location)
+    if status not in (307, 308):
+        # Like urllib2, redirect everything else as a GET
+        method = 'GET'
+        body = None
+        headers = dict((k, v) for (k, v) in headers.items()
+                       if k.lower() != 'content-type')
+    return url, method, body, headers
+
+
+def _parseHeaderValue(header_value):
+    """
+    Parse out a complex header value (such as Content-Type, with a value
+    like "text/html; charset=utf-8") into a main value and a dictionary of
+    extra information (in this case, 'text/html' and {'charset': 'utf8'}).
+    """
+    values = header_value.split(';', 1)
+    if len(values) == 1:
+        # There's no extra info -- return the main value and an empty dict
+        return values[0], {}
+    main_value, extra_values = values[0], values[1].split(';')
+    extra_dict = {}
+    for value_string in extra_values:
+        try:
+            key, value = value_string.split('=', 1)
+            extra_dict[key.strip()] = value.strip()
+        except ValueError:
+            # Can't unpack it -- must be malformed. Ignore
+            pass
+    return main_value, extra_dict
+
+
+def _decodeBody(body, headers):
+    """Attempt to decode a response body from bytes to str, using the
+    charset of its (lower-cased) headers."""
+    _, extra_dict = _parseHeaderValue(headers.get("content-type", ""))
+    # Try to decode the response body to a string, if there's a
+    # charset known; fall back to ISO-8859-1 otherwise, since that's
+    # what's suggested in HTTP/1.1
+    charset = extra_dict.get('charset', 'latin1')
+    try:
+        return body.decode(charset)
+    except Exception:
+        return body
+
+
 class HTTPFetchingError(Exception):
     """Exception that is wrapped around all exceptions that are raised
     by the underlying fetcher when using the ExceptionWrappingFetcher
@@ -202,6 +413,89 @@ class ExceptionWrappingFetcher(HTTPFetcher):
 
             raise HTTPFetchingError(why=exc_inst)
 
+    def fetchStream(self, url, headers=None):
+        fetch_stream = getattr(self.fetcher, 'fetchStream', None)
+        if fetch_stream is None:
+            return self.fetch(url, None, headers)
+
+        response = self._wrapExceptions(fetch_stream, url, headers)
+        if isinstance(response, HTTPStreamResponse):
+            response = HTTPStreamResponse(
+                response.final_url, response.status, response.headers,
+                _ExceptionWrappingStream(self, response))
+        return response
+
+    def _wrapExceptions(self, func, *args):
+        try:
+            return func(*args)
+        except self.uncaught_exceptions:
+            raise
+        except Exception as why:
+            raise HTTPFetchingError(why=why)
+
+
+class _ExceptionWrappingStream(object):
+    """Wraps the exceptions from reading the body of a streamed
+    response like L{ExceptionWrappingFetcher} does for fetching it."""
+
+    def __init__(self, fetcher, response):
+        self.fetcher = fetcher
+        self.response = response
+
+    def read(self, size=-1):
+        return self.fetcher._wrapExceptions(self.response.read, size)
+
+    def close(self):
+        self.response.close()
+
+
+class AsyncExceptionWrappingFetcher(AsyncHTTPFetcher):
+    """Like L{ExceptionWrappingFetcher}, for an L{AsyncHTTPFetcher}.
+
+    @cvar uncaught_exceptions: Exceptions that should be exposed to the
+        user if they are raised by the fetch call
+    """
+
+    uncaught_exceptions = ExceptionWrappingFetcher.uncaught_exceptions + (
+        asyncio.CancelledError, )
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+
+    async def fetch(self, *args, **kwargs):
+        try:
+            return await self.fetcher.fetch(*args, **kwargs)
+        except self.uncaught_exceptions:
+            raise
+        except Exception as why:
+            raise HTTPFetchingError(why=why)
+
+    async def close(self):
+        await self.fetcher.close()
+
+
+class ExecutorFetcher(AsyncHTTPFetcher):
+    """An C{L{AsyncHTTPFetcher}} that runs a blocking C{L{HTTPFetcher}}
+    in an executor.
+    """
+
+    def __init__(self, fetcher, executor=None):
+        """
+        @param fetcher: The blocking fetcher to run
+        @type fetcher: L{HTTPFetcher}
+
+        @param executor: The C{concurrent.futures} executor to run it
+            in, or C{None} for the event loop's default one.
+        """
+        self.fetcher = fetcher
+        self.executor = executor
+
+    async def fetch(self, url, body=None, headers=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(self.fetcher.fetch, url, body, headers))
+
 
 class Urllib2Fetcher(HTTPFetcher):
     """An C{L{HTTPFetcher}} that uses urllib2.
@@ -212,19 +506,7 @@ class Urllib2Fetcher(HTTPFetcher):
     urlopen = staticmethod(urllib.request.urlopen)
 
     def fetch(self, url, body=None, headers=None):
-        if not _allowedURL(url):
-            raise ValueError('Bad URL scheme: %r' % (url, ))
-
-        if headers is None:
-            headers = {}
-
-        headers.setdefault('User-Agent', "%s Python-urllib/%s" %
-                           (USER_AGENT, urllib.request.__version__))
-
-        if isinstance(body, str):
-            body = bytes(body, encoding="utf-8")
-
-        req = urllib.request.Request(url, data=body, headers=headers)
+        req = self._makeRequest(url, body, headers)
 
         url_resource = None
         try:
@@ -240,6 +522,34 @@ class Urllib2Fetcher(HTTPFetcher):
         except Exception as why:
             raise AssertionError(why)
 
+    def fetchStream(self, url, headers=None):
+        req = self._makeRequest(url, None, headers)
+
+        try:
+            url_resource = self.urlopen(req)
+        except urllib.error.HTTPError as why:
+            url_resource = why
+
+        return HTTPStreamResponse(
+            url_resource.geturl(), getattr(url_resource, 'code', 200),
+            self._lowerCaseKeys(dict(list(url_resource.info().items()))),
+            url_resource)
+
+    def _makeRequest(self, url, body, headers):
+        if not _allowedURL(url):
+            raise ValueError('Bad URL scheme: %r' % (url, ))
+
+        if headers is None:
+            headers = {}
+
+        headers.setdefault('User-Agent', "%s Python-urllib/%s" %
+                           (USER_AGENT, urllib.request.__version__))
+
+        if isinstance(body, str):
+            body = bytes(body, encoding="utf-8")
+
+        return urllib.request.Request(url, data=body, headers=headers)
+
     def _makeResponse(self, urllib2_response):
         '''
         Construct an HTTPResponse from the the urllib response. Attempt to
@@ -257,17 +567,7 @@ class Urllib2Fetcher(HTTPFetcher):
         else:
             resp.status = 200
 
-        _, extra_dict = self._parseHeaderValue(
-            resp.headers.get("content-type", ""))
-        # Try to decode the response body to a string, if there's a
-        # charset known; fall back to ISO-8859-1 otherwise, since that's
-        # what's suggested in HTTP/1.1
-        charset = extra_dict.get('charset', 'latin1')
-        try:
-            resp.body = resp.body.decode(charset)
-        except Exception:
-            pass
-
+        resp.body = _decodeBody(resp.body, resp.headers)
         return resp
 
     def _lowerCaseKeys(self, headers_dict):
@@ -282,26 +582,14 @@ class Urllib2Fetcher(HTTPFetcher):
         like "text/html; charset=utf-8") into a main value and a dictionary of
         extra information (in this case, 'text/html' and {'charset': 'utf8'}).
         """
-        values = header_value.split(';', 1)
-        if len(values) == 1:
-            # There's no extra info -- return the main value and an empty dict
-            return values[0], {}
-        main_value, extra_values = values[0], values[1].split(';')
-        extra_dict = {}
-        for value_string in extra_values:
-            try:
-                key, value = value_string.split('=', 1)
-                extra_dict[key.strip()] = value.strip()
-            except ValueError:
-                # Can't unpack it -- must be malformed. Ignore
-                pass
-        return main_value, extra_dict
+        return _parseHeaderValue(header_value)
 
 
 class HTTPError(HTTPFetchingError):
     """
-    This exception is raised by the C{L{CurlHTTPFetcher}} when it
-    encounters an exceptional situation fetching a URL.
+    This exception is raised by the C{L{CurlHTTPFetcher}} and the
+    C{L{AsyncioHTTPFetcher}} when they encounter an exceptional
+    situation fetching a URL.
     """
     pass
 
@@ -422,6 +710,215 @@ class CurlHTTPFetcher(HTTPFetcher):
             c.close()
 
 
+class PooledHTTPFetcher(HTTPFetcher):
+    """An C{L{HTTPFetcher}} that uses C{http.client} and keeps
+    connections alive.
+
+    Connections are pooled per scheme, host and port, so that the
+    discovery, association and C{check_authentication} requests made
+    for a login to the same server do not each pay for a new TCP and
+    TLS handshake.  It is safe to share between threads.  To use it for
+    all fetches::
+
+        setDefaultFetcher(PooledHTTPFetcher())
+
+    @cvar ALLOWED_TIME: The socket timeout in seconds, and the number of
+        seconds to wait for a connection when a host has
+        C{max_connections_per_host} in use.
+
+    @cvar MAX_REDIRECTS: The number of redirects followed before giving
+        up.
+
+    @cvar idempotent_methods: The request methods that are sent again
+        on a new connection when a pooled connection fails after the
+        request was sent.  Other requests are only sent again if the
+        connection failed while they were being sent.
+
+    @ivar max_connections_per_host: The number of connections, in use
+        or idle, that may be open to each scheme, host and port.
+
+    @ivar idle_timeout: The number of seconds an idle connection is
+        kept for reuse.
+    """
+    ALLOWED_TIME = 20  # seconds
+    MAX_REDIRECTS = 10
+
+    idempotent_methods = frozenset(['GET', 'HEAD'])
+
+    connection_classes = {
+        'http': http.client.HTTPConnection,
+        'https': http.client.HTTPSConnection,
+    }
+
+    def __init__(self, max_connections_per_host=4, idle_timeout=30,
+                 ssl_context=None):
+        """
+        @param ssl_context: The context for HTTPS connections, or
+            C{None} to use C{ssl.create_default_context()}.
+        @type ssl_context: C{ssl.SSLContext}
+        """
+        self.max_connections_per_host = max_connections_per_host
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self._condition = threading.Condition()
+        # (scheme, host, port) -> [(connection, last used)], most
+        # recently used last
+        self._idle = {}
+        # (scheme, host, port) -> number of connections, in use or idle
+        self._open = {}
+
+    def fetch(self, url, body=None, headers=None):
+        """Perform an HTTP request
+
+        @raises ValueError: If the URL is not an HTTP or HTTPS URL.
+
+        @raises HTTPError: If there are too many redirects, or no
+            connection to the host became free in time.
+
+        @raises Exception: Any exception that can be raised by
+            C{http.client}
+
+        @see: C{L{HTTPFetcher.fetch}}
+        """
+        if headers is None:
+            headers = {}
+        headers = dict(headers)
+        headers.setdefault('User-Agent', "%s Python-http.client" %
+                           (USER_AGENT, ))
+
+        if isinstance(body, str):
+            body = bytes(body, encoding="utf-8")
+
+        method = 'GET' if body is None else 'POST'
+        for _ in range(self.MAX_REDIRECTS + 1):
+            if not _allowedURL(url):
+                raise ValueError('Bad URL scheme: %r' % (url, ))
+
+            status, response_headers, data = self._request(
+                method, url, body, headers)
+
+            location = response_headers.get('location')
+            if status in _REDIRECT_CODES and location:
+                url, method, body, headers = _redirect(
+                    url, location, status, method, body, headers)
+            else:
+                return HTTPResponse(
+                    final_url=url,
+                    status=status,
+                    headers=response_headers,
+                    body=_decodeBody(data, response_headers))
+
+        raise HTTPError("Too many redirects fetching: %r" % (url, ))
+
+    def _request(self, method, url, body, headers):
+        """Make one request, on a pooled connection if there is one.
+
+        @returns: the status, the lower-cased headers and the body of
+            the response
+        """
+        parsed = urllib.parse.urlsplit(url)
+        if not parsed.hostname:
+            raise ValueError('No host in URL: %r' % (url, ))
+        connection_class = self.connection_classes[parsed.scheme]
+        port = parsed.port or connection_class.default_port
+        key = (parsed.scheme, parsed.hostname, port)
+
+        target = parsed.path or '/'
+        if parsed.query:
+            target = '%s?%s' % (target, parsed.query)
+
+        limit = MAX_RESPONSE_KB * 1024
+        while True:
+            conn, reused = self._getConnection(key)
+            reusable = False
+            try:
+                sent = False
+                try:
+                    conn.request(method, target, body, headers)
+                    sent = True
+                    response = conn.getresponse()
+                except (ConnectionError, http.client.BadStatusLine):
+                    # The server may have closed the idle connection
+                    # before it got our request; try another one, unless
+                    # the request may have been acted on and doing so
+                    # again is not safe.
+                    if reused and (not sent or
+                                   method in self.idempotent_methods):
+                        continue
+                    raise
+
+                # Read one byte past the limit to tell whether the body
+                # was cut short
+                data = response.read(limit + 1)
+                reusable = (len(data) <= limit and not response.will_close
+                            and response.isclosed())
+
+                response_headers = {}
+                for name, value in response.getheaders():
+                    name = name.lower()
+                    if name in response_headers:
+                        value = '%s, %s' % (response_headers[name], value)
+                    response_headers[name] = value
+
+                return response.status, response_headers, data[:limit]
+            finally:
+                self._releaseConnection(key, conn, reusable)
+
+    def _getConnection(self, key):
+        """Get an idle connection from the pool or make a new one,
+        waiting for one to be released if the host has
+        C{max_connections_per_host} open.
+
+        @returns: the connection and whether it came from the pool
+        """
+        deadline = time.monotonic() + self.ALLOWED_TIME
+        with self._condition:
+            while True:
+                idle = self._idle.get(key, [])
+                while idle:
+                    conn, last_used = idle.pop()
+                    if time.monotonic() - last_used < self.idle_timeout:
+                        return conn, True
+                    conn.close()
+                    self._open[key] -= 1
+
+                if self._open.get(key, 0) < self.max_connections_per_host:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise HTTPError("Timed out waiting for a connection to "
+                                    "%s://%s:%d" % key)
+                self._condition.wait(remaining)
+
+        scheme, host, port = key
+        kwargs = {'timeout': self.ALLOWED_TIME}
+        if scheme == 'https':
+            kwargs['context'] = (self.ssl_context or
+                                 ssl.create_default_context())
+        return self.connection_classes[scheme](host, port, **kwargs), False
+
+    def _releaseConnection(self, key, conn, reusable):
+        with self._condition:
+            if reusable:
+                self._idle.setdefault(key, []).append(
+                    (conn, time.monotonic()))
+            else:
+                conn.close()
+                self._open[key] -= 1
+            self._condition.notify()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._condition:
+            for key, idle in self._idle.items():
+                for conn, _ in idle:
+                    conn.close()
+                self._open[key] -= len(idle)
+            self._idle = {}
+
+
 class HTTPLib2Fetcher(HTTPFetcher):
     """A fetcher that uses C{httplib2} for performing HTTP
     requests. This implementation supports HTTP caching.
@@ -491,3 +988,708 @@ class HTTPLib2Fetcher(HTTPFetcher):
             final_url=final_url,
             headers=dict(list(httplib2_response.items())),
             status=httplib2_response.status, )
+
+
+class _NoResponse(Exception):
+    """The connection was closed before a response was received."""
+
+
+class _Connection(object):
+    """A connection opened by an C{L{AsyncioHTTPFetcher}}, with the
+    event loop it belongs to and when it was last used."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.last_used = time.monotonic()
+
+    def isUsable(self, idle_timeout):
+        """Can this idle connection be used for another request from
+        the running event loop?"""
+        return (self.loop is asyncio.get_running_loop() and
+                not self.writer.is_closing() and
+                not self.reader.at_eof() and
+                time.monotonic() - self.last_used < idle_timeout)
+
+    def close(self):
+        try:
+            self.writer.close()
+        except RuntimeError:
+            # The event loop the connection was made on is closed;
+            # the socket is closed when it is garbage collected.
+            pass
+
+
+class AsyncioHTTPFetcher(AsyncHTTPFetcher):
+    """An C{L{AsyncHTTPFetcher}} that speaks HTTP/1.1 over asyncio
+    streams.
+
+    Connections are kept alive and pooled per scheme, host and port,
+    so that discovery and C{check_authentication} requests to the same
+    server do not each pay for a new TCP and TLS handshake.  Pooled
+    connections belong to the event loop that made them; call
+    L{close} before that loop is closed.
+
+    @cvar ALLOWED_TIME: The number of seconds a fetch, including
+        redirects, may take.
+
+    @cvar MAX_REDIRECTS: The number of redirects followed before giving
+        up.
+
+    @cvar idempotent_methods: The request methods that are sent again
+        on a new connection when a pooled connection fails after the
+        request was sent.  Other requests are only sent again if the
+        connection failed while they were being sent.
+
+    @ivar max_idle_per_host: The number of idle connections kept open
+        for each scheme, host and port.
+
+    @ivar idle_timeout: The number of seconds an idle connection is
+        kept for reuse.
+    """
+    ALLOWED_TIME = 20  # seconds
+    MAX_REDIRECTS = 10
+
+    default_ports = {'http': 80, 'https': 443}
+
+    idempotent_methods = frozenset(['GET', 'HEAD'])
+
+    def __init__(self, max_idle_per_host=4, idle_timeout=30,
+                 ssl_context=None):
+        """
+        @param ssl_context: The context for HTTPS connections, or
+            C{None} to use C{ssl.create_default_context()}.
+        @type ssl_context: C{ssl.SSLContext}
+        """
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        # (scheme, host, port) -> [_Connection], most recently used last
+        self._pool = {}
+
+    async def fetch(self, url, body=None, headers=None):
+        """Perform an HTTP request
+
+        @raises ValueError: If the URL is not an HTTP or HTTPS URL.
+
+        @raises HTTPError: If the server does not speak HTTP, there
+            are too many redirects or the fetch times out.
+
+        @raises OSError: If a connection could not be made.
+
+        @see: C{L{AsyncHTTPFetcher.fetch}}
+        """
+        try:
+            return await asyncio.wait_for(
+                self._fetch(url, body, headers), self.ALLOWED_TIME)
+        except asyncio.TimeoutError:
+            raise HTTPError("Timed out fetching: %r" % (url, ))
+
+    async def _fetch(self, url, body, headers):
+        if headers is None:
+            headers = {}
+        headers = dict(headers)
+        headers.setdefault('User-Agent', "%s asyncio" % (USER_AGENT, ))
+
+        if isinstance(body, str):
+            body = bytes(body, encoding="utf-8")
+
+        method = 'GET' if body is None else 'POST'
+        for _ in range(self.MAX_REDIRECTS + 1):
+            if not _allowedURL(url):
+                raise ValueError('Bad URL scheme: %r' % (url, ))
+
+            status, response_headers, data = await self._request(
+                method, url, body, headers)
+
+            location = response_headers.get('location')
+            if status in _REDIRECT_CODES and location:
+                url, method, body, headers = _redirect(
+                    url, location, status, method, body, headers)
+            else:
+                return HTTPResponse(
+                    final_url=url,
+                    status=status,
+                    headers=response_headers,
+                    body=_decodeBody(data, response_headers))
+
+        raise HTTPError("Too many redirects fetching: %r" % (url, ))
+
+    async def _request(self, method, url, body, headers):
+        """Make one request, on a pooled connection if there is one.
+
+        @returns: the status, the lower-cased headers and the body of
+            the response
+        """
+        parsed = urllib.parse.urlsplit(url)
+        if not parsed.hostname:
+            raise ValueError('No host in URL: %r' % (url, ))
+        port = parsed.port or self.default_ports[parsed.scheme]
+        key = (parsed.scheme, parsed.hostname, port)
+
+        host = parsed.hostname
+        if ':' in host:
+            host = '[%s]' % (host, )
+        if parsed.port is not None:
+            host = '%s:%d' % (host, parsed.port)
+        target = parsed.path or '/'
+        if parsed.query:
+            target = '%s?%s' % (target, parsed.query)
+
+        lines = ['%s %s HTTP/1.1' % (method, target), 'Host: %s' % (host, )]
+        for name, value in headers.items():
+            if name.lower() not in ('host', 'content-length', 'connection'):
+                lines.append('%s: %s' % (name, value))
+        if body is not None:
+            lines.append('Content-Length: %d' % (len(body), ))
+        lines.append('Connection: keep-alive')
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        if body is not None:
+            request += body
+
+        while True:
+            conn, reused = await self._getConnection(key)
+            sent = False
+            try:
+                try:
+                    conn.writer.write(request)
+                    await conn.writer.drain()
+                    sent = True
+                    status_line = await conn.reader.readline()
+                    if not status_line:
+                        raise _NoResponse()
+                except (_NoResponse, ConnectionError):
+                    # The server may have closed the idle connection
+                    # before it got our request; try another one, unless
+                    # the request may have been acted on and doing so
+                    # again is not safe.
+                    if reused and (not sent or
+                                   method in self.idempotent_methods):
+                        conn.close()
+                        continue
+                    raise HTTPError(
+                        "Connection closed without a response: %r" % (url, ))
+
+                status, response_headers, data, keep_alive = \
+                    await self._readResponse(conn.reader, method,
+                                             status_line)
+            except BaseException:
+                conn.close()
+                raise
+
+            if keep_alive:
+                self._releaseConnection(key, conn)
+            else:
+                conn.close()
+            return status, response_headers, data
+
+    async def _getConnection(self, key):
+        """Get an idle connection from the pool, or open a new one.
+
+        @returns: the connection and whether it came from the pool
+        """
+        idle = self._pool.get(key, [])
+        while idle:
+            conn = idle.pop()
+            if conn.isUsable(self.idle_timeout):
+                return conn, True
+            conn.close()
+
+        scheme, host, port = key
+        if scheme == 'https':
+            ssl_context = self.ssl_context or ssl.create_default_context()
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=ssl_context, server_hostname=host)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return _Connection(reader, writer), False
+
+    def _releaseConnection(self, key, conn):
+        conn.last_used = time.monotonic()
+        idle = self._pool.setdefault(key, [])
+        idle.append(conn)
+        while len(idle) > self.max_idle_per_host:
+            idle.pop(0).close()
+
+    async def _readResponse(self, reader, method, status_line):
+        """Read the rest of a response, keeping at most
+        C{MAX_RESPONSE_KB} of its body.
+
+        @returns: the status, the lower-cased headers, the body and
+            whether the connection can be reused
+        """
+        while True:
+            try:
+                version, status = status_line.decode('latin-1').split()[:2]
+                status = int(status)
+            except ValueError:
+                raise HTTPError("Malformed HTTP status line in response: "
+                                "%r" % (status_line, ))
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise HTTPError("Connection closed in response headers")
+                line = line.decode('latin-1').strip()
+                if not line:
+                    break
+                try:
+                    name, value = line.split(':', 1)
+                except ValueError:
+                    raise HTTPError("Malformed HTTP header line in response: "
+                                    "%r" % (line, ))
+                name = name.strip().lower()
+                value = value.strip()
+                if name in headers:
+                    headers[name] = '%s, %s' % (headers[name], value)
+                else:
+                    headers[name] = value
+
+            # Skip interim responses, such as 100 Continue
+            if not 100 <= status < 200:
+                break
+            status_line = await reader.readline()
+
+        connection = [token.strip().lower()
+                      for token in headers.get('connection', '').split(',')]
+        keep_alive = version == 'HTTP/1.1' and 'close' not in connection
+
+        limit = MAX_RESPONSE_KB * 1024
+        if method == 'HEAD' or status in (204, 304):
+            data = b''
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            data, complete = await self._readChunked(reader, limit)
+            keep_alive = keep_alive and complete
+        elif 'content-length' in headers:
+            try:
+                length = int(headers['content-length'])
+            except ValueError:
+                raise HTTPError("Malformed Content-Length in response: %r" %
+                                (headers['content-length'], ))
+            data = await reader.readexactly(min(length, limit))
+            keep_alive = keep_alive and length <= limit
+        else:
+            # The body ends when the connection is closed
+            data = await self._readUntilClosed(reader, limit)
+            keep_alive = False
+
+        return status, headers, data, keep_alive
+
+    async def _readChunked(self, reader, limit):
+        """Read a chunked body, stopping once it is over C{limit}.
+
+        @returns: the body and whether all of it was read
+        """
+        chunks = []
+        received = 0
+        while True:
+            size_line = await reader.readline()
+            try:
+                size = int(size_line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise HTTPError("Malformed chunk size in response: %r" %
+                                (size_line, ))
+            if size == 0:
+                # Skip any trailers
+                while (await reader.readline()).strip():
+                    pass
+                return b''.join(chunks), True
+
+            if received + size > limit:
+                chunks.append(await reader.readexactly(limit - received))
+                return b''.join(chunks), False
+
+            chunks.append(await reader.readexactly(size))
+            received += size
+            await reader.readline()
+
+    async def _readUntilClosed(self, reader, limit):
+        chunks = []
+        received = 0
+        while received < limit:
+            chunk = await reader.read(limit - received)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            received += len(chunk)
+        return b''.join(chunks)
+
+    async def close(self):
+        """Close all idle connections."""
+        pool, self._pool = self._pool, {}
+        for idle in pool.values():
+            for conn in idle:
+                conn.close()
+                if conn.loop is asyncio.get_running_loop():
+                    try:
+                        await conn.writer.wait_closed()
+                    except OSError:
+                        pass
+
+
+class _CacheEntry(object):
+    """A response kept by an C{L{HTTPCache}}, with when it stops being
+    fresh and the validators to revalidate it with."""
+
+    def __init__(self, response, fresh_until):
+        self.response = response
+        self.fresh_until = fresh_until
+
+    def isFresh(self):
+        return time.time() < self.fresh_until
+
+    def hasValidators(self):
+        return ('etag' in self.response.headers or
+                'last-modified' in self.response.headers)
+
+    def conditionalHeaders(self):
+        """The headers to ask the server whether our response is
+        still current."""
+        headers = {}
+        if 'etag' in self.response.headers:
+            headers['If-None-Match'] = self.response.headers['etag']
+        if 'last-modified' in self.response.headers:
+            headers['If-Modified-Since'] = \
+                self.response.headers['last-modified']
+        return headers
+
+    def copyResponse(self):
+        response = self.response
+        return HTTPResponse(response.final_url, response.status,
+                            dict(response.headers), response.body)
+
+    def size(self):
+        body = self.response.body
+        return len(body) if body is not None else 0
+
+    def toJSON(self):
+        response = self.response
+        body = response.body
+        is_bytes = isinstance(body, bytes)
+        if is_bytes:
+            body = body.decode('latin-1')
+        return json.dumps({
+            'final_url': response.final_url,
+            'status': response.status,
+            'headers': response.headers,
+            'body': body,
+            'body_is_bytes': is_bytes,
+            'fresh_until': self.fresh_until,
+        })
+
+    @classmethod
+    def fromJSON(cls, data):
+        values = json.loads(data)
+        body = values['body']
+        if values['body_is_bytes']:
+            body = body.encode('latin-1')
+        response = HTTPResponse(values['final_url'], values['status'],
+                                values['headers'], body)
+        return cls(response, values['fresh_until'])
+
+
+def _parseHTTPDate(value):
+    """The time in an HTTP date header, or C{None} if it is invalid."""
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _currentAge(headers, now):
+    """How old, in seconds, a response with these (lower-cased) headers
+    that was received at C{now} is, following RFC 7234 section 4.2.3.
+    The time the request was made is not known, so the response delay
+    is taken to be zero."""
+    apparent_age = 0
+    date = _parseHTTPDate(headers.get('date', ''))
+    if date is not None:
+        apparent_age = max(now - date, 0)
+
+    try:
+        age_value = max(int(headers.get('age', 0)), 0)
+    except ValueError:
+        age_value = 0
+    return max(apparent_age, age_value)
+
+
+def _freshnessLifetime(headers, now):
+    """How long, in seconds, a response with these (lower-cased)
+    headers that was received at C{now} may be used without
+    revalidating it, or C{None} if it must not be cached at all.  The
+    time the response already spent in other caches, from its C{Age}
+    header, is taken off."""
+    lifetime = _originalFreshnessLifetime(headers, now)
+    if lifetime is None or lifetime == 0:
+        return lifetime
+    return max(lifetime - _currentAge(headers, now), 0)
+
+
+def _originalFreshnessLifetime(headers, now):
+    directives = {}
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+
+    if 'no-store' in directives or headers.get('vary', '').strip() == '*':
+        return None
+
+    if 'no-cache' in directives:
+        return 0
+
+    if 'max-age' in directives:
+        try:
+            return max(int(directives['max-age']), 0)
+        except ValueError:
+            return 0
+
+    if 'expires' in headers:
+        try:
+            expires = email.utils.parsedate_to_datetime(headers['expires'])
+        except (TypeError, ValueError):
+            # An invalid Expires means already expired
+            return 0
+
+        date = _parseHTTPDate(headers.get('date', ''))
+        if date is None:
+            date = now
+        return max(expires.timestamp() - date, 0)
+
+    return 0
+
+
+class HTTPCache(object):
+    """A cache of responses to GET requests, used by
+    C{L{CachingFetcher}} and C{L{AsyncCachingFetcher}}.
+
+    Responses are kept in memory in least-recently-used order, up to
+    C{max_size} bytes of bodies, and also written to C{cache_dir} if
+    one is given, so that they outlive the process and can be shared
+    between processes.  Only successful responses that may be cached
+    according to their C{Cache-Control} header, and that are either
+    fresh or can be revalidated with an C{ETag} or C{Last-Modified},
+    are kept.
+    """
+
+    def __init__(self, max_size=16 * 1024 * 1024, cache_dir=None):
+        """
+        @param max_size: The largest number of bytes of response bodies
+            to keep in memory.
+        @type max_size: int
+
+        @param cache_dir: A directory to keep responses in as well, or
+            C{None} to only keep them in memory.
+        @type cache_dir: str
+        """
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def key(self, url, headers):
+        """The cache key of a GET request.  The request headers are
+        part of it, since they can change the response (as C{Accept}
+        does for Yadis discovery)."""
+        if headers is None:
+            headers = {}
+        return (url, tuple(sorted(
+            (name.lower(), value) for (name, value) in headers.items())))
+
+    def get(self, key):
+        """Get the entry for a request, or C{None}."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        entry = self._readFile(key)
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def update(self, key, entry, response):
+        """Update the cache with the response to a request, made
+        conditional on C{entry} if there was one.
+
+        @returns: the response to return for the request
+        @rtype: L{HTTPResponse}
+        """
+        now = time.time()
+        if entry is not None and response.status == 304:
+            # Not modified; use our response with the updated headers
+            headers = dict(entry.response.headers)
+            for name, value in response.headers.items():
+                if name != 'content-length':
+                    headers[name] = value
+            entry = _CacheEntry(
+                HTTPResponse(entry.response.final_url, entry.response.status,
+                             headers, entry.response.body), now)
+        elif response.status == 200:
+            entry = _CacheEntry(response, now)
+        else:
+            self.discard(key)
+            return response
+
+        lifetime = _freshnessLifetime(entry.response.headers, now)
+        if lifetime is None or (lifetime == 0 and not entry.hasValidators()):
+            self.discard(key)
+        else:
+            entry.fresh_until = now + lifetime
+            self._remember(key, entry)
+            self._writeFile(key, entry)
+        return entry.copyResponse()
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry.size()
+        if self.cache_dir is not None:
+            try:
+                os.unlink(self._filename(key))
+            except OSError:
+                pass
+
+    def _remember(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old.size()
+            if entry.size() > self.max_size:
+                return
+            self._entries[key] = entry
+            self._size += entry.size()
+            while self._size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size()
+
+    def _filename(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def _readFile(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._filename(key), encoding='utf-8') as cache_file:
+                return _CacheEntry.fromJSON(cache_file.read())
+        except (OSError, ValueError, KeyError):
+            # Missing, or written by an incompatible version
+            return None
+
+    def _writeFile(self, key, entry):
+        if self.cache_dir is None:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+                tmp_file.write(entry.toJSON())
+            os.replace(tmp, self._filename(key))
+        except OSError:
+            # The cache is only an optimization
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+
+class CachingFetcher(HTTPFetcher):
+    """An C{L{HTTPFetcher}} that caches the responses of another one
+    to GET requests, honouring C{Cache-Control: max-age}, C{Expires},
+    and revalidating stale responses with C{ETag} and C{Last-Modified}
+    conditional requests.  This saves refetching identity pages and
+    XRDS documents during discovery.  POST requests, such as
+    associate and C{check_authentication}, are never cached::
+
+        setDefaultFetcher(CachingFetcher(createHTTPFetcher()))
+
+    @ivar cache: Where responses are kept.
+    @type cache: L{HTTPCache}
+    """
+
+    def __init__(self, fetcher, cache=None):
+        """
+        @param fetcher: The fetcher to make requests with
+        @type fetcher: L{HTTPFetcher}
+
+        @param cache: The cache to keep responses in, or C{None} for a
+            new in-memory L{HTTPCache}.
+        @type cache: L{HTTPCache}
+        """
+        self.fetcher = fetcher
+        if cache is None:
+            cache = HTTPCache()
+        self.cache = cache
+
+    def fetch(self, url, body=None, headers=None):
+        if body is not None:
+            return self.fetcher.fetch(url, body, headers)
+
+        key = self.cache.key(url, headers)
+        entry = self.cache.get(key)
+        if entry is not None and entry.isFresh():
+            return entry.copyResponse()
+
+        request_headers = dict(headers or {})
+        if entry is not None:
+            request_headers.update(entry.conditionalHeaders())
+        response = self.fetcher.fetch(url, None, request_headers)
+        return self.cache.update(key, entry, response)
+
+
+class AsyncCachingFetcher(AsyncHTTPFetcher):
+    """Like L{CachingFetcher}, for an L{AsyncHTTPFetcher}.
+
+    If the cache keeps responses on disk, it is read and written in an
+    executor, so that it does not block the event loop.
+    """
+
+    def __init__(self, fetcher, cache=None, executor=None):
+        """
+        @param fetcher: The fetcher to make requests with
+        @type fetcher: L{AsyncHTTPFetcher}
+
+        @param cache: The cache to keep responses in, or C{None} for a
+            new in-memory L{HTTPCache}.
+        @type cache: L{HTTPCache}
+
+        @param executor: The C{concurrent.futures} executor to use the
+            cache's directory in, or C{None} for the event loop's
+            default one.
+        """
+        self.fetcher = fetcher
+        if cache is None:
+            cache = HTTPCache()
+        self.cache = cache
+        self.executor = executor
+
+    async def _callCache(self, method, *args):
+        if self.cache.cache_dir is None:
+            return method(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(method, *args))
+
+    async def fetch(self, url, body=None, headers=None):
+        if body is not None:
+            return await self.fetcher.fetch(url, body, headers)
+
+        key = self.cache.key(url, headers)
+        entry = await self._callCache(self.cache.get, key)
+        if entry is not None and entry.isFresh():
+            return entry.copyResponse()
+
+        request_headers = dict(headers or {})
+        if entry is not None:
+            request_headers.update(entry.conditionalHeaders())
+        response = await self.fetcher.fetch(url, None, request_headers)
+        return await self._callCache(self.cache.update, key, entry, response)
+
+    async def close(self):
+        await self.fetcher.close()
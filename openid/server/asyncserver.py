@@ -0,0 +1,290 @@
+# -*- test-case-name: openid.test.test_asyncserver -*-
+"""OpenID server protocol and logic for asyncio applications.
+
+This module has the same interface as L{openid.server.server}, except
+that the methods of C{L{AsyncServer}} and C{L{AsyncSignatory}} that do
+store I/O are coroutines, and the Diffie-Hellman arithmetic of
+association requests is run in an executor so that it does not hold
+up the event loop::
+
+    oserver = AsyncServer(store, "http://example.com/op")
+    request = await oserver.decodeRequest(query)
+    if request.mode in ['checkid_immediate', 'checkid_setup']:
+        ...
+    else:
+        response = await oserver.handleRequest(request)
+
+    webresponse = await oserver.encodeResponse(response)
+
+The store should implement
+C{L{AsyncOpenIDStore<openid.store.asyncinterface.AsyncOpenIDStore>}}.
+A blocking C{L{OpenIDStore<openid.store.interface.OpenIDStore>}} may
+be given instead, in which case it is used through a
+C{L{SyncToAsyncStore<openid.store.asyncinterface.SyncToAsyncStore>}}.
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+from copy import deepcopy
+
+from openid import kvform
+from openid.message import OPENID_NS
+from openid.server.server import Server, Signatory, SigningEncoder, \
+     Decoder, OpenIDResponse, EncodingError, AlreadySigned
+from openid.store.asyncinterface import SyncToAsyncStore
+
+__all__ = [
+    'AsyncServer',
+    'AsyncSignatory',
+    'AsyncSigningEncoder',
+]
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSignatory(Signatory):
+    """I sign things and check signatures, for asyncio code.  See
+    L{Signatory<openid.server.server.Signatory>}; my methods are
+    coroutines, and my store is an
+    L{AsyncOpenIDStore<openid.store.asyncinterface.AsyncOpenIDStore>}.
+    """
+
+    async def verify(self, assoc_handle, message):
+        """Verify that the signature for some data is valid.
+
+        @returns: C{True} if the signature is valid, C{False} if not.
+        @returntype: bool
+        """
+        assoc = await self.getAssociation(assoc_handle, dumb=True)
+        if not assoc:
+            logger.error("failed to get assoc with handle %r to verify "
+                         "message %r" % (assoc_handle, message))
+            return False
+
+        try:
+            valid = assoc.checkMessageSignature(message)
+        except ValueError as ex:
+            logger.exception("Error in verifying %s with %s: %s" %
+                             (message, assoc, ex))
+            return False
+        return valid
+
+    async def sign(self, response):
+        """Sign a response.
+
+        @returns: A signed copy of the response.
+        @returntype: L{OpenIDResponse}
+        """
+        signed_response = deepcopy(response)
+        assoc_handle = response.request.assoc_handle
+        if assoc_handle:
+            # normal mode; see Signatory.sign about checkExpiration
+            assoc = await self.getAssociation(
+                assoc_handle, dumb=False, checkExpiration=False)
+
+            if not assoc or assoc.expiresIn <= 0:
+                # fall back to dumb mode
+                signed_response.fields.setArg(OPENID_NS, 'invalidate_handle',
+                                              assoc_handle)
+                assoc_type = assoc and assoc.assoc_type or 'HMAC-SHA1'
+                if assoc and assoc.expiresIn <= 0:
+                    await self.invalidate(assoc_handle, dumb=False)
+                assoc = await self.createAssociation(
+                    dumb=True, assoc_type=assoc_type)
+        else:
+            # dumb mode.
+            assoc = await self.createAssociation(dumb=True)
+
+        try:
+            signed_response.fields = assoc.signMessage(signed_response.fields)
+        except kvform.KVFormError as err:
+            raise EncodingError(response, explanation=str(err))
+        return signed_response
+
+    async def createAssociation(self, dumb=True, assoc_type='HMAC-SHA1'):
+        """Make a new association and store it.
+
+        @returntype: L{openid.association.Association}
+        """
+        assoc = self._makeAssociation(assoc_type)
+        await self.store.storeAssociation(self._getKey(dumb), assoc)
+        return assoc
+
+    async def getAssociation(self, assoc_handle, dumb, checkExpiration=True):
+        """Get the association with the specified handle.
+
+        @returns: the association, or None if no valid association with that
+            handle was found.
+        @returntype: L{openid.association.Association}
+        """
+        if assoc_handle is None:
+            raise ValueError("assoc_handle must not be None")
+
+        key = self._getKey(dumb)
+        assoc = await self.store.getAssociation(key, assoc_handle)
+        if assoc is not None and assoc.expiresIn <= 0:
+            logger.info("requested %sdumb key %r is expired (by %s seconds)" %
+                        ((not dumb) and 'not-' or '', assoc_handle,
+                         assoc.expiresIn))
+            if checkExpiration:
+                await self.store.removeAssociation(key, assoc_handle)
+                assoc = None
+        return assoc
+
+    async def invalidate(self, assoc_handle, dumb):
+        """Invalidates the association with the given handle."""
+        await self.store.removeAssociation(self._getKey(dumb), assoc_handle)
+
+
+class AsyncSigningEncoder(SigningEncoder):
+    """I encode responses in to L{WebResponses<WebResponse>}, signing
+    them with an L{AsyncSignatory} when required.
+    """
+
+    async def encode(self, response):
+        """Encode a response to a L{WebResponse}, signing it first if
+        appropriate.
+
+        @raises EncodingError: When I can't figure out how to encode this
+            message.
+
+        @raises AlreadySigned: When this response is already signed.
+
+        @returntype: L{WebResponse}
+        """
+        if (not isinstance(response, Exception)) and response.needsSigning():
+            if not self.signatory:
+                raise ValueError("Must have a store to sign this request: %s" %
+                                 (response, ), response)
+            if response.fields.hasKey(OPENID_NS, 'sig'):
+                raise AlreadySigned(response)
+            response = await self.signatory.sign(response)
+        return super(SigningEncoder, self).encode(response)
+
+
+class AsyncServer(Server):
+    """I handle requests for an OpenID server in asyncio code.  See
+    L{Server<openid.server.server.Server>}; L{decodeRequest},
+    L{handleRequest} and L{encodeResponse} are coroutines here.
+
+    @ivar executor: The C{concurrent.futures} executor I run
+        Diffie-Hellman arithmetic in, or C{None} for the event loop's
+        default one.
+    """
+
+    def __init__(self,
+                 store,
+                 op_endpoint=None,
+                 signatoryClass=AsyncSignatory,
+                 encoderClass=AsyncSigningEncoder,
+                 decoderClass=Decoder,
+                 executor=None):
+        """A new L{AsyncServer}.
+
+        @param store: The back-end where my associations are stored.
+        @type store: L{openid.store.asyncinterface.AsyncOpenIDStore}
+
+        @param op_endpoint: My URL, the fully qualified address of this
+            server's endpoint, i.e. C{http://example.com/server}
+        @type op_endpoint: str
+
+        @param executor: See L{executor}.
+        """
+        # Stores are duck-typed, so tell blocking ones by their methods
+        if (store is not None and
+                not inspect.iscoroutinefunction(store.getAssociation)):
+            store = SyncToAsyncStore(store)
+        Server.__init__(self, store, op_endpoint, signatoryClass,
+                        encoderClass, decoderClass)
+        self.executor = executor
+
+    async def _runInExecutor(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(func, *args))
+
+    async def handleRequest(self, request):
+        """Handle a request.
+
+        @raises NotImplementedError: When I do not have a handler defined
+            for that type of request.
+
+        @returntype: L{OpenIDResponse}
+        """
+        handler = getattr(self, 'openid_' + request.mode, None)
+        if handler is not None:
+            return await handler(request)
+        else:
+            raise NotImplementedError(
+                "%s has no handler for a request of mode %r." %
+                (self, request.mode))
+
+    async def openid_check_authentication(self, request):
+        """Handle and respond to C{check_authentication} requests.
+
+        @returntype: L{OpenIDResponse}
+        """
+        is_valid = await self.signatory.verify(request.assoc_handle,
+                                               request.signed)
+        # Now invalidate that assoc_handle so it this checkAuth message cannot
+        # be replayed.
+        await self.signatory.invalidate(request.assoc_handle, dumb=True)
+        response = OpenIDResponse(request)
+        valid_str = (is_valid and "true") or "false"
+        response.fields.setArg(OPENID_NS, 'is_valid', valid_str)
+
+        if request.invalidate_handle:
+            assoc = await self.signatory.getAssociation(
+                request.invalidate_handle, dumb=False)
+            if not assoc:
+                response.fields.setArg(OPENID_NS, 'invalidate_handle',
+                                       request.invalidate_handle)
+        return response
+
+    async def openid_associate(self, request):
+        """Handle and respond to C{associate} requests.
+
+        @returntype: L{OpenIDResponse}
+        """
+        assoc_type = request.assoc_type
+        session_type = request.session.session_type
+        if self.negotiator.isAllowed(assoc_type, session_type):
+            assoc = await self.signatory.createAssociation(
+                dumb=False, assoc_type=assoc_type)
+            # Encrypting the secret is the Diffie-Hellman key agreement
+            return await self._runInExecutor(request.answer, assoc)
+        else:
+            message = ('Association type %r is not supported with '
+                       'session type %r' % (assoc_type, session_type))
+            (preferred_assoc_type, preferred_session_type) = \
+                                   self.negotiator.getAllowedType()
+            return request.answerUnsupported(message, preferred_assoc_type,
+                                             preferred_session_type)
+
+    async def decodeRequest(self, query):
+        """Transform query parameters into an L{OpenIDRequest}.
+
+        @raises ProtocolError: When the query does not seem to be a valid
+            OpenID request.
+
+        @returntype: L{OpenIDRequest}
+
+        @see: L{Decoder.decode}
+        """
+        if query and query.get('openid.mode') == 'associate':
+            # Decoding an association request makes our Diffie-Hellman
+            # key pair
+            return await self._runInExecutor(self.decoder.decode, query)
+        return self.decoder.decode(query)
+
+    async def encodeResponse(self, response):
+        """Encode a response to a L{WebResponse}, signing it first if
+        appropriate.
+
+        @returntype: L{WebResponse}
+
+        @see: L{AsyncSigningEncoder.encode}
+        """
+        return await self.encoder.encode(response)
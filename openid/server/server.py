@@ -1242,19 +1242,25 @@ class Signatory(object):
         @returns: the new association.
         @returntype: L{openid.association.Association}
         """
+        assoc = self._makeAssociation(assoc_type)
+        self.store.storeAssociation(self._getKey(dumb), assoc)
+        return assoc
+
+    def _makeAssociation(self, assoc_type):
         secret = cryptutil.getBytes(getSecretSize(assoc_type))
         uniq = oidutil.toBase64(cryptutil.getBytes(4)).decode()
         handle = '{%s}{%x}{%s}' % (assoc_type, int(time.time()), uniq)
 
-        assoc = Association.fromExpiresIn(self.SECRET_LIFETIME, handle, secret,
-                                          assoc_type)
+        return Association.fromExpiresIn(self.SECRET_LIFETIME, handle, secret,
+                                         assoc_type)
 
+    def _getKey(self, dumb):
+        """Return the key that associations used with or without dumb
+        mode are stored under."""
         if dumb:
-            key = self._dumb_key
+            return self._dumb_key
         else:
-            key = self._normal_key
-        self.store.storeAssociation(key, assoc)
-        return assoc
+            return self._normal_key
 
     def getAssociation(self, assoc_handle, dumb, checkExpiration=True):
         """Get the association with the specified handle.
@@ -1277,10 +1283,7 @@ class Signatory(object):
         if assoc_handle is None:
             raise ValueError("assoc_handle must not be None")
 
-        if dumb:
-            key = self._dumb_key
-        else:
-            key = self._normal_key
+        key = self._getKey(dumb)
         assoc = self.store.getAssociation(key, assoc_handle)
         if assoc is not None and assoc.expiresIn <= 0:
             logger.info("requested %sdumb key %r is expired (by %s seconds)" %
@@ -1299,11 +1302,7 @@ class Signatory(object):
         @param dumb: Is this association used with dumb mode?
         @type dumb: bool
         """
-        if dumb:
-            key = self._dumb_key
-        else:
-            key = self._normal_key
-        self.store.removeAssociation(key, assoc_handle)
+        self.store.removeAssociation(self._getKey(dumb), assoc_handle)
 
 
 class Encoder(object):
@@ -2,7 +2,14 @@
 This package contains the modules related to this library's use of
 persistent storage.
 
-@sort: interface, filestore, sqlstore, memstore
+@sort: interface, filestore, sqlstore, memstore, shmstore, redisstore,
+    cachestore, noncebatch, tieredstore, scheduler, asyncinterface,
+    asyncmemstore, asyncsqlstore
 """
 
-__all__ = ['interface', 'filestore', 'sqlstore', 'memstore', 'nonce']
+# shmstore is left out since it needs fcntl, which Windows lacks
+__all__ = [
+    'interface', 'filestore', 'sqlstore', 'memstore', 'redisstore',
+    'cachestore', 'noncebatch', 'tieredstore', 'scheduler', 'asyncinterface',
+    'asyncmemstore', 'asyncsqlstore', 'nonce'
+]
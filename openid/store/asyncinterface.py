@@ -0,0 +1,162 @@
+"""
+This module contains the definition of the C{L{AsyncOpenIDStore}}
+interface, the asyncio counterpart of
+C{L{OpenIDStore<openid.store.interface.OpenIDStore>}}, and adapters
+to use stores of one kind where the other kind is expected.
+
+The asyncio stores need Python 3.7 or later.
+"""
+
+import asyncio
+import functools
+import threading
+
+from openid.store.interface import OpenIDStore
+
+
+class AsyncOpenIDStore(object):
+    """
+    This is the interface for stores used by the asyncio parts of the
+    library.  It has the same methods as
+    C{L{OpenIDStore<openid.store.interface.OpenIDStore>}}, with the
+    same arguments and results, except that they are coroutines; see
+    that class for what each of them does.
+
+    @sort: storeAssociation, getAssociation, removeAssociation,
+        useNonce
+    """
+
+    async def storeAssociation(self, server_url, association):
+        """See C{L{OpenIDStore.storeAssociation}}."""
+        raise NotImplementedError
+
+    async def getAssociation(self, server_url, handle=None):
+        """See C{L{OpenIDStore.getAssociation}}."""
+        raise NotImplementedError
+
+    async def removeAssociation(self, server_url, handle):
+        """See C{L{OpenIDStore.removeAssociation}}."""
+        raise NotImplementedError
+
+    async def useNonce(self, server_url, timestamp, salt):
+        """See C{L{OpenIDStore.useNonce}}."""
+        raise NotImplementedError
+
+    async def cleanupNonces(self):
+        """See C{L{OpenIDStore.cleanupNonces}}."""
+        raise NotImplementedError
+
+    async def cleanupAssociations(self):
+        """See C{L{OpenIDStore.cleanupAssociations}}."""
+        raise NotImplementedError
+
+    async def cleanup(self):
+        """See C{L{OpenIDStore.cleanup}}."""
+        return (await self.cleanupNonces(), await self.cleanupAssociations())
+
+
+class SyncToAsyncStore(AsyncOpenIDStore):
+    """
+    Makes a blocking C{L{OpenIDStore}} usable as an
+    C{L{AsyncOpenIDStore}} by running each call in an executor, so
+    that it does not block the event loop.
+    """
+
+    def __init__(self, store, executor=None):
+        """
+        @param store: The blocking store.
+
+        @type store: C{L{OpenIDStore}}
+
+        @param executor: The C{concurrent.futures} executor to run
+            calls in, or C{None} for the event loop's default one.  The
+            store must be safe to use from the executor's threads.
+        """
+        self.store = store
+        self.executor = executor
+
+    async def _call(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(method, *args))
+
+    async def storeAssociation(self, server_url, association):
+        return await self._call(self.store.storeAssociation, server_url,
+                                association)
+
+    async def getAssociation(self, server_url, handle=None):
+        return await self._call(self.store.getAssociation, server_url,
+                                handle)
+
+    async def removeAssociation(self, server_url, handle):
+        return await self._call(self.store.removeAssociation, server_url,
+                                handle)
+
+    async def useNonce(self, server_url, timestamp, salt):
+        return await self._call(self.store.useNonce, server_url, timestamp,
+                                salt)
+
+    async def cleanupNonces(self):
+        return await self._call(self.store.cleanupNonces)
+
+    async def cleanupAssociations(self):
+        return await self._call(self.store.cleanupAssociations)
+
+
+class AsyncToSyncStore(OpenIDStore):
+    """
+    Makes an C{L{AsyncOpenIDStore}} usable as a blocking
+    C{L{OpenIDStore}} by running each call on an event loop in another
+    thread and waiting for the result.  It must not be used from a
+    thread that is running the event loop the store uses.
+    """
+
+    def __init__(self, store, loop=None):
+        """
+        @param store: The asyncio store.
+
+        @type store: C{L{AsyncOpenIDStore}}
+
+        @param loop: A running event loop in another thread to run the
+            store's coroutines on.  If C{None}, a loop is started on a
+            daemon thread of its own; call L{close} to stop it.
+        """
+        self.store = store
+        self._thread = None
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=loop.run_forever,
+                                            name='openid-async-store')
+            self._thread.daemon = True
+            self._thread.start()
+        self.loop = loop
+
+    def close(self):
+        """Stop the event loop started for this store, if any."""
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+            self.loop.close()
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def storeAssociation(self, server_url, association):
+        return self._call(self.store.storeAssociation(server_url,
+                                                      association))
+
+    def getAssociation(self, server_url, handle=None):
+        return self._call(self.store.getAssociation(server_url, handle))
+
+    def removeAssociation(self, server_url, handle):
+        return self._call(self.store.removeAssociation(server_url, handle))
+
+    def useNonce(self, server_url, timestamp, salt):
+        return self._call(self.store.useNonce(server_url, timestamp, salt))
+
+    def cleanupNonces(self):
+        return self._call(self.store.cleanupNonces())
+
+    def cleanupAssociations(self):
+        return self._call(self.store.cleanupAssociations())
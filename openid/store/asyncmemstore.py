@@ -0,0 +1,37 @@
+"""A simple asyncio store using only in-process memory."""
+
+from openid.store.asyncinterface import AsyncOpenIDStore
+from openid.store.memstore import MemoryStore
+
+
+class AsyncMemoryStore(AsyncOpenIDStore):
+    """In-process memory store for asyncio code.
+
+    Use for single long-running processes.  No persistence supplied.
+    Nothing here ever waits, so every call completes without giving
+    up the event loop, which also makes it safe to share between tasks.
+
+    Any keyword arguments are passed on to the underlying
+    C{L{MemoryStore<openid.store.memstore.MemoryStore>}}.
+    """
+
+    def __init__(self, **kwargs):
+        self.store = MemoryStore(**kwargs)
+
+    async def storeAssociation(self, server_url, association):
+        return self.store.storeAssociation(server_url, association)
+
+    async def getAssociation(self, server_url, handle=None):
+        return self.store.getAssociation(server_url, handle)
+
+    async def removeAssociation(self, server_url, handle):
+        return self.store.removeAssociation(server_url, handle)
+
+    async def useNonce(self, server_url, timestamp, salt):
+        return self.store.useNonce(server_url, timestamp, salt)
+
+    async def cleanupNonces(self):
+        return self.store.cleanupNonces()
+
+    async def cleanupAssociations(self):
+        return self.store.cleanupAssociations()
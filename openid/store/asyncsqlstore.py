@@ -0,0 +1,431 @@
+"""
+This module contains C{L{AsyncOpenIDStore}} implementations that use
+various SQL databases to back them, through asyncio database drivers.
+
+The stores talk to the database through a small connection interface:
+C{await conn.execute(sql, args)} runs a statement and returns a cursor
+with an C{await cursor.fetchall()} method and a C{rowcount} attribute,
+and C{await conn.commit()} and C{await conn.rollback()} end the
+transaction.  C{aiosqlite} and C{psycopg} (version 3) async connections
+provide it as they are; use L{AsyncpgConnection} for C{asyncpg} and
+L{AsyncDBAPIConnection} for any blocking DB-API connection.
+
+Example of how to initialize a store database::
+
+    conn = await aiosqlite.connect('cstore.db')
+    await asyncsqlstore.AsyncSQLiteStore(conn).createTables()
+"""
+import asyncio
+import concurrent.futures
+import functools
+import re
+import time
+
+from openid.association import Association
+from openid.store.asyncinterface import AsyncOpenIDStore
+from openid.store.sqlstore import SQLiteStore, PostgreSQLStore
+from openid.store import nonce
+
+
+class _Result(object):
+    """The rows and row count of a statement that has already run."""
+
+    def __init__(self, rows, rowcount):
+        self.rows = rows
+        self.rowcount = rowcount
+
+    async def fetchall(self):
+        return self.rows
+
+
+class AsyncDBAPIConnection(object):
+    """
+    Makes a blocking DB-API connection usable by the stores in this
+    module by running each call on a single worker thread.
+
+    The connection is used from that thread rather than the one that
+    made it, so for C{sqlite3} it must be opened with
+    C{check_same_thread=False}.
+    """
+
+    def __init__(self, conn, executor=None):
+        """
+        @param conn: The DB-API connection.
+
+        @param executor: The C{concurrent.futures} executor to run
+            calls in.  It must not run two calls on the connection at
+            once; by default, one with a single thread is created.
+        """
+        self.conn = conn
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.executor = executor
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(func, *args))
+
+    def _execute(self, sql, args):
+        cur = self.conn.cursor()
+        try:
+            cur.execute(sql, args)
+            if cur.description is None:
+                rows = []
+            else:
+                rows = cur.fetchall()
+            return _Result(rows, cur.rowcount)
+        finally:
+            cur.close()
+
+    async def execute(self, sql, args=()):
+        return await self._call(self._execute, sql, args)
+
+    async def commit(self):
+        return await self._call(self.conn.commit)
+
+    async def rollback(self):
+        return await self._call(self.conn.rollback)
+
+    async def close(self):
+        await self._call(self.conn.close)
+        self.executor.shutdown()
+
+
+class AsyncpgConnection(object):
+    """
+    Makes an C{asyncpg} connection usable by the stores in this module.
+
+    C{asyncpg} numbers its parameters (C{$1}) and has no implicit
+    transactions, so this translates the C{%s} parameters of the
+    statements and starts a transaction on the first statement after
+    each commit or rollback.
+    """
+
+    _param_re = re.compile('%s')
+
+    def __init__(self, conn):
+        """
+        @param conn: The C{asyncpg} connection.
+        """
+        self.conn = conn
+        self._transaction = None
+
+    def _number(self, sql):
+        count = [0]
+
+        def repl(match):
+            count[0] += 1
+            return '$%d' % (count[0], )
+
+        return self._param_re.sub(repl, sql)
+
+    async def execute(self, sql, args=()):
+        if self._transaction is None:
+            self._transaction = self.conn.transaction()
+            await self._transaction.start()
+
+        sql = self._number(sql)
+        if sql.lstrip().upper().startswith('SELECT'):
+            rows = await self.conn.fetch(sql, *args)
+            return _Result(rows, len(rows))
+
+        # The status is like 'DELETE 3' or 'INSERT 0 1'
+        status = await self.conn.execute(sql, *args)
+        count = status.split()[-1]
+        return _Result([], int(count) if count.isdigit() else -1)
+
+    async def _end(self, method):
+        transaction, self._transaction = self._transaction, None
+        if transaction is not None:
+            await getattr(transaction, method)()
+
+    async def commit(self):
+        await self._end('commit')
+
+    async def rollback(self):
+        await self._end('rollback')
+
+
+class AsyncSQLStore(AsyncOpenIDStore):
+    """
+    This is the parent class for the asyncio SQL stores, which contains
+    the logic common to all of them.  It works like
+    C{L{SQLStore<openid.store.sqlstore.SQLStore>}}, and uses the same
+    tables.
+
+    The table names used are determined by the class variables
+    C{L{associations_table}} and C{L{nonces_table}}.  To change the
+    name of the tables used, pass new table names into the
+    constructor.
+
+    To create the tables with the proper schema, see the
+    C{L{createTables}} method.
+
+    Calls on one store run one at a time, since they share a single
+    connection.  This class shouldn't be used directly.  Use one of
+    its subclasses instead.
+
+    @cvar associations_table: This is the default name of the table to
+        keep associations in
+
+    @cvar nonces_table: This is the default name of the table to keep
+        nonces in.
+
+    @cvar cleanup_batch_size: The largest number of rows that
+        C{L{cleanupNonces}} and C{L{cleanupAssociations}} delete in
+        one transaction.
+
+    @sort: __init__, createTables
+    """
+
+    associations_table = 'oid_associations'
+    nonces_table = 'oid_nonces'
+    cleanup_batch_size = 1000
+
+    def __init__(self, conn, associations_table=None, nonces_table=None):
+        """
+        This creates a new AsyncSQLStore instance.
+
+        @param conn: An established connection to a database of the
+            correct type for the subclass you're using, with the
+            interface described in
+            L{asyncsqlstore<openid.store.asyncsqlstore>}.
+
+        @param associations_table: This is an optional parameter to
+            specify the name of the table used for storing
+            associations.
+
+        @type associations_table: C{str}
+
+        @param nonces_table: This is an optional parameter to specify
+            the name of the table used for storing nonces.
+
+        @type nonces_table: C{str}
+        """
+        self.conn = conn
+        self.cur = None
+        self._statement_cache = {}
+        self._table_names = {
+            'associations': associations_table or self.associations_table,
+            'nonces': nonces_table or self.nonces_table,
+        }
+        # Made on first use, in the event loop using the store; see
+        # _getLock
+        self._lock = None
+        self._lock_loop = None
+
+    def blobDecode(self, blob):
+        """Convert a blob as returned by the SQL engine into a bytes
+        object."""
+        return bytes(blob)
+
+    def blobEncode(self, s):
+        """Convert a bytes object into the necessary object for storing
+        in the database as a blob."""
+        return s
+
+    def _getSQL(self, sql_name):
+        try:
+            return self._statement_cache[sql_name]
+        except KeyError:
+            sql = getattr(self, sql_name)
+            sql %= self._table_names
+            self._statement_cache[sql_name] = sql
+            return sql
+
+    async def _execSQL(self, sql_name, *args):
+        self.cur = await self.conn.execute(self._getSQL(sql_name), list(args))
+
+    def __getattr__(self, attr):
+        # if the attribute starts with db_, use a default
+        # implementation that looks up the appropriate SQL statement
+        # as an attribute of this object and executes it.
+        if attr[:3] == 'db_':
+            sql_name = attr[3:] + '_sql'
+
+            async def func(*args):
+                return await self._execSQL(sql_name, *args)
+
+            setattr(self, attr, func)
+            return func
+        else:
+            raise AttributeError('Attribute %r not found' % (attr, ))
+
+    def _getLock(self):
+        # Before Python 3.10, a lock belongs to the event loop that was
+        # current when it was made, so a new one is made whenever the
+        # store is used from another loop.  The store must only be used
+        # from one loop at a time.
+        loop = asyncio.get_running_loop()
+        if self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    async def _callInTransaction(self, func, *args):
+        """Await the given coroutine function inside of a transaction.
+        If no exception is raised, the transaction is comitted,
+        otherwise it is rolled back."""
+        async with self._getLock():
+            # No nesting of transactions
+            await self.conn.rollback()
+            try:
+                ret = await func(*args)
+            except:
+                await self.conn.rollback()
+                raise
+            else:
+                await self.conn.commit()
+            finally:
+                self.cur = None
+
+            return ret
+
+    async def txn_createTables(self):
+        await self.db_create_nonce()
+        await self.db_create_nonce_index()
+        await self.db_create_assoc()
+        await self.db_create_assoc_index()
+
+    async def createTables(self):
+        """
+        This method creates the database tables necessary for this
+        store to work.  It should not be called if the tables already
+        exist.
+        """
+        return await self._callInTransaction(self.txn_createTables)
+
+    async def txn_storeAssociation(self, server_url, association):
+        a = association
+        await self.db_set_assoc(server_url, a.handle,
+                                self.blobEncode(a.secret), a.issued,
+                                a.lifetime, a.assoc_type,
+                                a.issued + a.lifetime)
+
+    async def storeAssociation(self, server_url, association):
+        return await self._callInTransaction(self.txn_storeAssociation,
+                                             server_url, association)
+
+    async def txn_getAssociation(self, server_url, handle=None):
+        if handle is not None:
+            await self.db_get_assoc(server_url, handle)
+        else:
+            await self.db_get_assocs(server_url)
+
+        rows = await self.cur.fetchall()
+        associations = []
+        for values in rows:
+            values = list(values)
+            values[1] = self.blobDecode(values[1])
+            assoc = Association(*values)
+            if assoc.expiresIn == 0:
+                await self.txn_removeAssociation(server_url, assoc.handle)
+            else:
+                associations.append((assoc.issued, assoc))
+
+        if associations:
+            associations.sort(key=lambda pair: pair[0])
+            return associations[-1][1]
+        else:
+            return None
+
+    async def getAssociation(self, server_url, handle=None):
+        return await self._callInTransaction(self.txn_getAssociation,
+                                             server_url, handle)
+
+    async def txn_removeAssociation(self, server_url, handle):
+        await self.db_remove_assoc(server_url, handle)
+        return self.cur.rowcount > 0  # -1 is undefined
+
+    async def removeAssociation(self, server_url, handle):
+        return await self._callInTransaction(self.txn_removeAssociation,
+                                             server_url, handle)
+
+    async def txn_useNonce(self, server_url, timestamp, salt):
+        await self.db_add_nonce(server_url, timestamp, salt)
+        # Duplicate nonces are ignored rather than failing, so nothing
+        # is inserted for them.  An undefined count (-1) can not tell a
+        # new nonce from a replayed one, so the nonce is rejected.
+        return self.cur.rowcount > 0
+
+    async def useNonce(self, server_url, timestamp, salt):
+        if abs(timestamp - time.time()) > nonce.SKEW:
+            return False
+
+        return await self._callInTransaction(self.txn_useNonce, server_url,
+                                             timestamp, salt)
+
+    async def txn_cleanupNonces(self, batch_size):
+        await self.db_clean_nonce(int(time.time()) - nonce.SKEW, batch_size)
+        return self.cur.rowcount
+
+    async def txn_cleanupAssociations(self, batch_size):
+        await self.db_clean_assoc(int(time.time()), batch_size)
+        return self.cur.rowcount
+
+    async def _cleanupInBatches(self, clean_batch):
+        removed = 0
+        while True:
+            count = await self._callInTransaction(clean_batch,
+                                                  self.cleanup_batch_size)
+            if count > 0:
+                removed += count
+            if count < self.cleanup_batch_size:
+                return removed
+
+    async def cleanupNonces(self):
+        return await self._cleanupInBatches(self.txn_cleanupNonces)
+
+    async def cleanupAssociations(self):
+        return await self._cleanupInBatches(self.txn_cleanupAssociations)
+
+
+class AsyncSQLiteStore(AsyncSQLStore):
+    """
+    This is an SQLite-based specialization of C{L{AsyncSQLStore}}, for
+    use with C{aiosqlite}.  It uses the same statements as
+    C{L{SQLiteStore<openid.store.sqlstore.SQLiteStore>}}.
+    """
+
+    create_nonce_sql = SQLiteStore.create_nonce_sql
+    create_nonce_index_sql = SQLiteStore.create_nonce_index_sql
+    create_assoc_sql = SQLiteStore.create_assoc_sql
+    create_assoc_index_sql = SQLiteStore.create_assoc_index_sql
+    set_assoc_sql = SQLiteStore.set_assoc_sql
+    get_assocs_sql = SQLiteStore.get_assocs_sql
+    get_assoc_sql = SQLiteStore.get_assoc_sql
+    remove_assoc_sql = SQLiteStore.remove_assoc_sql
+    clean_assoc_sql = SQLiteStore.clean_assoc_sql
+    add_nonce_sql = SQLiteStore.add_nonce_sql
+    clean_nonce_sql = SQLiteStore.clean_nonce_sql
+
+
+class AsyncPostgreSQLStore(AsyncSQLStore):
+    """
+    This is a PostgreSQL-based specialization of C{L{AsyncSQLStore}},
+    for use with C{psycopg} async connections or, through
+    L{AsyncpgConnection}, C{asyncpg}.  It uses the same statements as
+    C{L{PostgreSQLStore<openid.store.sqlstore.PostgreSQLStore>}},
+    except that associations are set with a single upsert.
+    """
+
+    create_nonce_sql = PostgreSQLStore.create_nonce_sql
+    create_nonce_index_sql = PostgreSQLStore.create_nonce_index_sql
+    create_assoc_sql = PostgreSQLStore.create_assoc_sql
+    create_assoc_index_sql = PostgreSQLStore.create_assoc_index_sql
+    set_assoc_sql = ('INSERT INTO %(associations)s '
+                     '(server_url, handle, secret, issued, '
+                     'lifetime, assoc_type, expires_at) '
+                     'VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s) '
+                     'ON CONFLICT (server_url, handle) DO UPDATE SET '
+                     'secret = EXCLUDED.secret, issued = EXCLUDED.issued, '
+                     'lifetime = EXCLUDED.lifetime, '
+                     'assoc_type = EXCLUDED.assoc_type, '
+                     'expires_at = EXCLUDED.expires_at;')
+    get_assocs_sql = PostgreSQLStore.get_assocs_sql
+    get_assoc_sql = PostgreSQLStore.get_assoc_sql
+    remove_assoc_sql = PostgreSQLStore.remove_assoc_sql
+    clean_assoc_sql = PostgreSQLStore.clean_assoc_sql
+    add_nonce_sql = PostgreSQLStore.add_nonce_sql
+    clean_nonce_sql = PostgreSQLStore.clean_nonce_sql
@@ -0,0 +1,117 @@
+"""
+This module contains an C{L{OpenIDStore}} that caches associations
+from another store in memory.
+
+Example of how to put a cache in front of an SQL store::
+
+    store = cachestore.CachingStore(sqlstore.MySQLStore(conn))
+"""
+
+import collections
+import copy
+import threading
+import time
+
+from openid.store.interface import OpenIDStore
+
+
+class CachingStore(OpenIDStore):
+    """
+    This store keeps recently used associations from a backing store
+    in a bounded, least-recently-used cache, so that checking several
+    signatures made with the same association only fetches it from the
+    backing store once.
+
+    Associations are cached for at most C{max_age} seconds, and never
+    past their expiration.  Storing or removing an association through
+    this store updates the cache, but changes made to the backing store
+    by other processes are only seen once the cached entries age out,
+    so keep C{max_age} short if associations may be removed elsewhere.
+
+    Nonces are always checked in the backing store.
+    """
+
+    def __init__(self, store, max_entries=1000, max_age=300):
+        """
+        Create a new CachingStore.
+
+        @param store: The store to cache associations from.
+
+        @type store: C{L{OpenIDStore}}
+
+        @param max_entries: The largest number of associations to keep
+            in the cache.
+
+        @type max_entries: C{int}
+
+        @param max_age: The longest time, in seconds, to cache an
+            association for.
+
+        @type max_age: C{int}
+        """
+        self.store = store
+        self.max_entries = max_entries
+        self.max_age = max_age
+        # (server_url, handle or None) -> (time to evict, association)
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cacheGet(self, key):
+        with self._lock:
+            try:
+                evict_at, association = self._cache[key]
+            except KeyError:
+                return None
+
+            if evict_at <= time.time():
+                del self._cache[key]
+                return None
+
+            self._cache.move_to_end(key)
+            return association
+
+    def _cachePut(self, key, association):
+        max_age = min(self.max_age, association.expiresIn)
+        if max_age <= 0:
+            return
+
+        with self._lock:
+            self._cache[key] = (time.time() + max_age, association)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _cacheDiscard(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._cache.pop(key, None)
+
+    def storeAssociation(self, server_url, association):
+        self.store.storeAssociation(server_url, association)
+        # The newest association for the server may have changed
+        self._cacheDiscard((server_url, None))
+        self._cachePut((server_url, association.handle),
+                       copy.copy(association))
+
+    def getAssociation(self, server_url, handle=None):
+        key = (server_url, handle)
+        association = self._cacheGet(key)
+        if association is None:
+            association = self.store.getAssociation(server_url, handle)
+            if association is not None:
+                self._cachePut(key, association)
+        return association
+
+    def removeAssociation(self, server_url, handle):
+        removed = self.store.removeAssociation(server_url, handle)
+        self._cacheDiscard((server_url, handle), (server_url, None))
+        return removed
+
+    def useNonce(self, server_url, timestamp, salt):
+        return self.store.useNonce(server_url, timestamp, salt)
+
+    def cleanupNonces(self):
+        return self.store.cleanupNonces()
+
+    def cleanupAssociations(self):
+        return self.store.cleanupAssociations()
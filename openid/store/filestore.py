@@ -6,10 +6,11 @@ flat files.
 import string
 import os
 import os.path
+import shutil
 import time
 import logging
 
-from errno import EEXIST, ENOENT
+from errno import EEXIST, ENOENT, ENOTEMPTY
 
 from tempfile import mkstemp
 
@@ -34,6 +35,14 @@ def _safe64(s):
     return bytes(h64)
 
 
+def _unreprHash(s):
+    """Undo the repr that older filenames wrapped around a _safe64 hash.
+    """
+    if s.startswith("b'") and s.endswith("'"):
+        return s[2:-1]
+    return s
+
+
 def _filenameEscape(s):
     filename_chunks = []
     for c in s:
@@ -93,9 +102,20 @@ class FileOpenIDStore(OpenIDStore):
 
     Methods of this object can raise OSError if unexpected filesystem
     conditions, such as bad permissions or missing directories, occur.
+
+    @cvar index_filename: The name of the file in each server's
+        association directory that names the newest association, when
+        the store is sharded.
+
+    @cvar nonce_bucket_size: The number of seconds' worth of nonces
+        kept in each nonce directory, when the store is sharded.
     """
 
-    def __init__(self, directory):
+    index_filename = 'newest'
+
+    nonce_bucket_size = 60
+
+    def __init__(self, directory, sharded=False):
         """
         Initializes a new FileOpenIDStore.  This initializes the
         nonce and association directories, which are subdirectories of
@@ -105,6 +125,20 @@ class FileOpenIDStore(OpenIDStore):
             directories in.
 
         @type directory: C{str}
+
+        @param sharded: If true, the associations for each server URL
+            are kept in a subdirectory of their own, along with an
+            index file naming the newest one, so that looking up the
+            association for a server does not have to list every
+            association in the store.  Use C{L{migrateAssociations}}
+            to move the associations of an existing unsharded store
+            into place.
+
+            Nonces are likewise kept in one subdirectory per minute,
+            so that expired nonces can be removed a whole directory at
+            a time.
+
+        @type sharded: C{bool}
         """
         # Make absolute
         directory = os.path.normpath(os.path.abspath(directory))
@@ -119,8 +153,14 @@ class FileOpenIDStore(OpenIDStore):
 
         self.max_nonce_age = 6 * 60 * 60  # Six hours, in seconds
 
+        self.sharded = sharded
+
         self._setup()
 
+        # Whether nonces stored by an unsharded store may still be
+        # around, in which case they have to be checked as well.
+        self._flat_nonces = sharded and self._hasFlatNonces()
+
     def _setup(self):
         """Make sure that the directories in which we store our data
         exist.
@@ -150,6 +190,33 @@ class FileOpenIDStore(OpenIDStore):
             _removeIfPresent(name)
             raise
 
+    def _getServerPrefix(self, server_url):
+        """Create the part of an association filename that identifies
+        the server URL.
+
+        str -> str
+        """
+        if server_url.find('://') == -1:
+            raise ValueError('Bad server URL: %r' % server_url)
+
+        proto, rest = server_url.split('://', 1)
+        domain = _filenameEscape(rest.split('/', 1)[0])
+        url_hash = _safe64(server_url)
+        if self.sharded:
+            url_hash = url_hash.decode('ascii')
+        # Unsharded stores have always put the repr of the hash bytes in
+        # their filenames, and keep doing so to find the files they have
+        return '%s-%s-%s' % (proto, domain, url_hash)
+
+    def getServerDirname(self, server_url):
+        """Return the directory holding the associations for a given
+        server url in a sharded store.
+
+        str -> str
+        """
+        return os.path.join(self.association_dir,
+                            self._getServerPrefix(server_url))
+
     def getAssociationFilename(self, server_url, handle):
         """Create a unique filename for a given server url and
         handle. This implementation does not assume anything about the
@@ -159,33 +226,34 @@ class FileOpenIDStore(OpenIDStore):
 
         (str, str) -> str
         """
-        if server_url.find('://') == -1:
-            raise ValueError('Bad server URL: %r' % server_url)
-
-        proto, rest = server_url.split('://', 1)
-        domain = _filenameEscape(rest.split('/', 1)[0])
-        url_hash = _safe64(server_url)
+        prefix = self._getServerPrefix(server_url)
         if handle:
             handle_hash = _safe64(handle)
         else:
             handle_hash = ''
 
-        filename = '%s-%s-%s-%s' % (proto, domain, url_hash, handle_hash)
+        if self.sharded:
+            if not handle:
+                raise ValueError('A sharded store has no association '
+                                 'filename for an empty handle')
+            return os.path.join(self.association_dir, prefix,
+                                handle_hash.decode('ascii'))
+
+        filename = '%s-%s' % (prefix, handle_hash)
 
         return os.path.join(self.association_dir, filename)
 
-    def storeAssociation(self, server_url, association):
-        """Store an association in the association directory.
+    def _writeFile(self, filename, data):
+        """Atomically replace the contents of a file by writing them
+        to a temporary file and renaming it into place.
 
-        (str, Association) -> NoneType
+        (str, bytes) -> NoneType
         """
-        association_s = association.serialize()  # NOTE: UTF-8 encoded bytes
-        filename = self.getAssociationFilename(server_url, association.handle)
         tmp_file, tmp = self._mktemp()
 
         try:
             try:
-                tmp_file.write(association_s)
+                tmp_file.write(data)
                 os.fsync(tmp_file.fileno())
             finally:
                 tmp_file.close()
@@ -216,6 +284,61 @@ class FileOpenIDStore(OpenIDStore):
             _removeIfPresent(tmp)
             raise
 
+    def storeAssociation(self, server_url, association):
+        """Store an association in the association directory.
+
+        (str, Association) -> NoneType
+        """
+        association_s = association.serialize()  # NOTE: UTF-8 encoded bytes
+        filename = self.getAssociationFilename(server_url, association.handle)
+        if not self.sharded:
+            self._writeFile(filename, association_s)
+            return
+
+        while True:
+            _ensureDir(os.path.dirname(filename))
+            try:
+                self._writeFile(filename, association_s)
+                break
+            except OSError as why:
+                # cleanupAssociations removed the server's directory
+                # before we could use it; make it again.
+                if why.errno != ENOENT:
+                    raise
+
+        newest = self._readIndex(os.path.dirname(filename))
+        if newest is None or newest[0] <= association.issued:
+            self._writeIndex(filename, association.issued)
+
+    def _readIndex(self, server_dir):
+        """Read the index file of a server's association directory.
+
+        str -> (int, str) or NoneType
+        """
+        index_filename = os.path.join(server_dir, self.index_filename)
+        try:
+            with open(index_filename, 'r') as index_file:
+                issued, name = index_file.read().split(' ', 1)
+                return int(issued), name
+        except IOError as why:
+            if why.errno == ENOENT:
+                return None
+            else:
+                raise
+        except ValueError:
+            return None
+
+    def _writeIndex(self, filename, issued):
+        """Point the index file of a server's association directory at
+        the given association file.
+
+        (str, int) -> NoneType
+        """
+        server_dir, name = os.path.split(filename)
+        index_s = ('%d %s' % (issued, name)).encode('utf-8')
+        self._writeFile(os.path.join(server_dir, self.index_filename),
+                        index_s)
+
     def getAssociation(self, server_url, handle=None):
         """Retrieve an association. If no handle is specified, return
         the association with the latest expiration.
@@ -225,6 +348,10 @@ class FileOpenIDStore(OpenIDStore):
         if handle is None:
             handle = ''
 
+        if self.sharded and not handle:
+            return self._getNewestAssociation(
+                self.getServerDirname(server_url))
+
         # The filename with the empty handle is a prefix of all other
         # associations for the given server URL.
         filename = self.getAssociationFilename(server_url, handle)
@@ -258,6 +385,87 @@ class FileOpenIDStore(OpenIDStore):
             else:
                 return None
 
+    def _getNewestAssociation(self, server_dir):
+        """Return the newest association in a server's association
+        directory, trying the one named in the index file first.
+
+        The index is only a hint: if two processes store associations
+        for the same server at the same time, it may name an
+        association other than the newest one.  It is rebuilt whenever
+        the association it names is gone.
+
+        str -> Association or NoneType
+        """
+        newest = self._readIndex(server_dir)
+        if newest is not None:
+            association = self._getAssociation(
+                os.path.join(server_dir, newest[1]))
+            if association is not None:
+                return association
+
+        try:
+            association_files = os.listdir(server_dir)
+        except OSError as why:
+            if why.errno == ENOENT:
+                return None
+            else:
+                raise
+
+        matching_associations = []
+        for name in association_files:
+            if name == self.index_filename:
+                continue
+            full_name = os.path.join(server_dir, name)
+            association = self._getAssociation(full_name)
+            if association is not None:
+                matching_associations.append(
+                    (association.issued, full_name, association))
+
+        if not matching_associations:
+            _removeIfPresent(os.path.join(server_dir, self.index_filename))
+            return None
+
+        issued, full_name, assoc = max(matching_associations)
+        self._writeIndex(full_name, issued)
+        return assoc
+
+    def migrateAssociations(self):
+        """Move associations stored by an unsharded store into the
+        per-server directories used by a sharded one.  It is safe to
+        run this more than once, and while sharded stores are using the
+        directory, but not while unsharded ones are.
+
+        @return: the number of associations moved.
+        @returntype: int
+        """
+        if not self.sharded:
+            raise ValueError('Only a sharded store can migrate '
+                             'associations')
+
+        moved = 0
+        for name in os.listdir(self.association_dir):
+            filename = os.path.join(self.association_dir, name)
+            if os.path.isdir(filename):
+                continue
+
+            # Flat names are proto-domain-url_hash-handle_hash, with the
+            # hashes written as the repr of bytes.
+            parts = [_unreprHash(part) for part in name.split('-')]
+            if len(parts) != 4 or not all(parts):
+                # Not something getAssociationFilename could have made;
+                # leave it for cleanupAssociations.
+                logger.warning('Not migrating association file %r', name)
+                continue
+
+            handle_hash = parts.pop()
+            server_dir = os.path.join(self.association_dir, '-'.join(parts))
+            _ensureDir(server_dir)
+            os.rename(filename, os.path.join(server_dir, handle_hash))
+            # Let the next lookup rebuild the index
+            _removeIfPresent(os.path.join(server_dir, self.index_filename))
+            moved += 1
+        return moved
+
     def _getAssociation(self, filename):
         try:
             assoc_file = open(filename, 'rb')
@@ -320,7 +528,27 @@ class FileOpenIDStore(OpenIDStore):
         filename = '%08x-%s-%s-%s-%s' % (timestamp, proto, domain, url_hash,
                                          salt_hash)
 
-        filename = os.path.join(self.nonce_dir, filename)
+        if not self.sharded:
+            return self._createNonceFile(os.path.join(self.nonce_dir,
+                                                      filename))
+
+        if (self._flat_nonces and
+                os.path.exists(os.path.join(self.nonce_dir, filename))):
+            return False
+
+        bucket_dir = self._getNonceBucketDirname(timestamp)
+        while True:
+            _ensureDir(bucket_dir)
+            try:
+                return self._createNonceFile(os.path.join(bucket_dir,
+                                                          filename))
+            except OSError as why:
+                # cleanupNonces removed the bucket before we could use
+                # it; make it again.
+                if why.errno != ENOENT:
+                    raise
+
+    def _createNonceFile(self, filename):
         try:
             fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o200)
         except OSError as why:
@@ -332,13 +560,35 @@ class FileOpenIDStore(OpenIDStore):
             os.close(fd)
             return True
 
+    def _getNonceBucketDirname(self, timestamp):
+        bucket = timestamp - timestamp % self.nonce_bucket_size
+        return os.path.join(self.nonce_dir, '%08x' % (bucket, ))
+
+    def _hasFlatNonces(self):
+        for name in os.listdir(self.nonce_dir):
+            if not os.path.isdir(os.path.join(self.nonce_dir, name)):
+                return True
+        return False
+
+    def _allAssocFilenames(self):
+        # A sharded store also lists the flat files that have not been
+        # migrated yet, so that cleanup still removes them once expired.
+        filenames = []
+        for filename in os.listdir(self.association_dir):
+            filename = os.path.join(self.association_dir, filename)
+            if not os.path.isdir(filename):
+                filenames.append(filename)
+            elif self.sharded:
+                filenames.extend(
+                    os.path.join(filename, name)
+                    for name in os.listdir(filename)
+                    if name != self.index_filename)
+        return filenames
+
     def _allAssocs(self):
         all_associations = []
 
-        association_filenames = [
-            os.path.join(self.association_dir, filename)
-            for filename in os.listdir(self.association_dir)
-        ]
+        association_filenames = self._allAssocFilenames()
         for association_filename in association_filenames:
             try:
                 association_file = open(association_filename, 'rb')
@@ -381,19 +631,82 @@ class FileOpenIDStore(OpenIDStore):
             if assoc.expiresIn == 0:
                 _removeIfPresent(assoc_filename)
                 removed += 1
+
+        if self.sharded:
+            for name in os.listdir(self.association_dir):
+                server_dir = os.path.join(self.association_dir, name)
+                if os.path.isdir(server_dir):
+                    self._removeEmptyServerDir(server_dir)
         return removed
 
+    def _removeEmptyServerDir(self, server_dir):
+        """Remove a server's association directory if nothing but its
+        index is left in it.  storeAssociation makes the directory again
+        if it loses the race with this.
+        """
+        if set(os.listdir(server_dir)) - set([self.index_filename]):
+            return
+        _removeIfPresent(os.path.join(server_dir, self.index_filename))
+        try:
+            os.rmdir(server_dir)
+        except OSError as why:
+            if why.errno not in (ENOENT, ENOTEMPTY, EEXIST):
+                raise
+
     def cleanupNonces(self):
         nonces = os.listdir(self.nonce_dir)
         now = time.time()
 
         removed = 0
+        flat_nonces = False
         # Check all nonces for expiry
         for nonce_fname in nonces:
+            filename = os.path.join(self.nonce_dir, nonce_fname)
+            # An unsharded store may be pointed at the nonces of a
+            # sharded one, so it cleans up their buckets too.
+            if os.path.isdir(filename):
+                removed += self._cleanupNonceBucket(filename, now)
+                continue
+
             timestamp = nonce_fname.split('-', 1)[0]
             timestamp = int(timestamp, 16)
             if abs(timestamp - now) > nonce.SKEW:
-                filename = os.path.join(self.nonce_dir, nonce_fname)
                 _removeIfPresent(filename)
                 removed += 1
+            else:
+                flat_nonces = True
+
+        if self.sharded:
+            self._flat_nonces = flat_nonces
+        return removed
+
+    def _cleanupNonceBucket(self, bucket_dir, now):
+        """Remove the expired nonces in one nonce directory, removing
+        the whole directory at once if every nonce in it has expired.
+
+        (str, float) -> int
+        """
+        first = int(os.path.basename(bucket_dir), 16)
+        last = first + self.nonce_bucket_size - 1
+        nonces = os.listdir(bucket_dir)
+        if last < now - nonce.SKEW or first > now + nonce.SKEW:
+            shutil.rmtree(bucket_dir, ignore_errors=True)
+            return len(nonces)
+
+        removed = 0
+        if first < now - nonce.SKEW or last > now + nonce.SKEW:
+            for nonce_fname in nonces:
+                timestamp = int(nonce_fname.split('-', 1)[0], 16)
+                if abs(timestamp - now) > nonce.SKEW:
+                    _removeIfPresent(os.path.join(bucket_dir, nonce_fname))
+                    removed += 1
+
+        if removed == len(nonces):
+            # Nothing is left in it. useNonce makes the directory again
+            # if it loses the race with this.
+            try:
+                os.rmdir(bucket_dir)
+            except OSError as why:
+                if why.errno not in (ENOENT, ENOTEMPTY, EEXIST):
+                    raise
         return removed
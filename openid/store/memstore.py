@@ -3,6 +3,9 @@
 from openid.store import nonce
 
 import copy
+import heapq
+import itertools
+import threading
 import time
 
 
@@ -49,26 +52,109 @@ class ServerAssocs(object):
         return len(remove), len(self.assocs)
 
 
+class IndexedServerAssocs(ServerAssocs):
+    """Associations for one server URL, indexed by issued date.
+
+    The associations are also kept in a heap ordered by issued date,
+    newest first, so that L{best} does not have to look at every
+    association.  Heap entries for associations that have since been
+    removed or replaced are discarded lazily.
+    """
+
+    def __init__(self):
+        ServerAssocs.__init__(self)
+        self.by_issued = []
+        self._counter = itertools.count()
+
+    def set(self, assoc):
+        ServerAssocs.set(self, assoc)
+        heapq.heappush(self.by_issued,
+                       (-assoc.issued, next(self._counter), assoc))
+
+    def _isCurrent(self, assoc):
+        return self.assocs.get(assoc.handle) is assoc
+
+    def remove(self, handle):
+        removed = ServerAssocs.remove(self, handle)
+        # Rebuild the heap once it is mostly made of stale entries, so
+        # that removals cannot make it grow without bound.
+        if removed and len(self.by_issued) > 2 * len(self.assocs) + 16:
+            self.by_issued = [
+                entry for entry in self.by_issued if self._isCurrent(entry[2])
+            ]
+            heapq.heapify(self.by_issued)
+        return removed
+
+    def best(self):
+        """Returns association with the latest issued date.
+
+        or None if there are no associations.
+        """
+        while self.by_issued:
+            assoc = self.by_issued[0][2]
+            if self._isCurrent(assoc):
+                return assoc
+            heapq.heappop(self.by_issued)
+        return None
+
+
 class MemoryStore(object):
     """In-process memory store.
 
     Use for single long-running processes.  No persistence supplied.
+
+    If C{indexed} is true, the associations for each server URL are
+    kept in issued order and all associations are kept in a heap
+    ordered by expiration time.  Getting the best association for a
+    server then takes constant time no matter how many associations
+    are stored, and L{cleanupAssociations} only looks at associations
+    that have actually expired.  Associations are also copied shallowly
+    rather than deeply when stored.
+
+    Nonces are kept in buckets of C{nonce_bucket_size} seconds, keyed
+    on their timestamps, so that L{cleanupNonces} can drop whole
+    buckets of expired nonces instead of checking every nonce.  If
+    C{nonce_sweep_interval} is given, expired nonces are also cleaned
+    up on every C{nonce_sweep_interval}th call to L{useNonce}.
     """
 
-    def __init__(self):
+    def __init__(self, indexed=False, nonce_bucket_size=60,
+                 nonce_sweep_interval=None):
         self.server_assocs = {}
+        # bucket number -> set of (server_url, timestamp, salt)
         self.nonces = {}
+        self.nonce_bucket_size = nonce_bucket_size
+        self.nonce_sweep_interval = nonce_sweep_interval
+        self._nonce_uses = 0
+        self.indexed = indexed
+        if indexed:
+            self._server_assocs_class = IndexedServerAssocs
+        else:
+            self._server_assocs_class = ServerAssocs
+        # (expiration time, counter, server_url, association)
+        self.expiry_heap = []
+        self._counter = itertools.count()
 
     def _getServerAssocs(self, server_url):
         try:
             return self.server_assocs[server_url]
         except KeyError:
-            assocs = self.server_assocs[server_url] = ServerAssocs()
+            assocs = self.server_assocs[server_url] = \
+                self._server_assocs_class()
             return assocs
 
     def storeAssociation(self, server_url, assoc):
         assocs = self._getServerAssocs(server_url)
-        assocs.set(copy.deepcopy(assoc))
+        if self.indexed:
+            # Associations have no mutable state, so a shallow copy is
+            # enough to keep callers from sharing our object.
+            assoc = copy.copy(assoc)
+            heapq.heappush(self.expiry_heap,
+                           (assoc.issued + assoc.lifetime,
+                            next(self._counter), server_url, assoc))
+        else:
+            assoc = copy.deepcopy(assoc)
+        assocs.set(assoc)
 
     def getAssociation(self, server_url, handle=None):
         assocs = self._getServerAssocs(server_url)
@@ -82,29 +168,58 @@ class MemoryStore(object):
         return assocs.remove(handle)
 
     def useNonce(self, server_url, timestamp, salt):
+        if self.nonce_sweep_interval:
+            self._nonce_uses += 1
+            if self._nonce_uses >= self.nonce_sweep_interval:
+                self._nonce_uses = 0
+                self.cleanupNonces()
+
         if abs(timestamp - time.time()) > nonce.SKEW:
             return False
 
         anonce = (str(server_url), int(timestamp), str(salt))
-        if anonce in self.nonces:
+        bucket = anonce[1] // self.nonce_bucket_size
+        try:
+            anonces = self.nonces[bucket]
+        except KeyError:
+            anonces = self.nonces[bucket] = set()
+
+        if anonce in anonces:
             return False
         else:
-            self.nonces[anonce] = None
+            anonces.add(anonce)
             return True
 
     def cleanupNonces(self):
         now = time.time()
-        expired = []
-        for anonce in self.nonces.keys():
-            if abs(anonce[1] - now) > nonce.SKEW:
-                # removing items while iterating over the set could be bad.
-                expired.append(anonce)
-
-        for anonce in expired:
-            del self.nonces[anonce]
-        return len(expired)
+        oldest = now - nonce.SKEW
+        newest = now + nonce.SKEW
+        expired = 0
+        # removing items while iterating over the dict could be bad.
+        for bucket in list(self.nonces.keys()):
+            anonces = self.nonces[bucket]
+            first = bucket * self.nonce_bucket_size
+            last = first + self.nonce_bucket_size - 1
+            if last < oldest or first > newest:
+                # Every nonce in this bucket has expired
+                expired += len(anonces)
+                del self.nonces[bucket]
+            elif first < oldest or last > newest:
+                # Only some of them may have expired
+                stale = [
+                    anonce for anonce in anonces
+                    if abs(anonce[1] - now) > nonce.SKEW
+                ]
+                anonces.difference_update(stale)
+                expired += len(stale)
+                if not anonces:
+                    del self.nonces[bucket]
+        return expired
 
     def cleanupAssociations(self):
+        if self.indexed:
+            return self._cleanupIndexedAssociations()
+
         remove_urls = []
         removed_assocs = 0
         for server_url, assocs in self.server_assocs.items():
@@ -118,9 +233,87 @@ class MemoryStore(object):
             del self.server_assocs[server_url]
         return removed_assocs
 
+    def _cleanupIndexedAssociations(self):
+        now = int(time.time())
+        removed_assocs = 0
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            _, _, server_url, assoc = heapq.heappop(self.expiry_heap)
+            assocs = self.server_assocs.get(server_url)
+            if assocs is None or assocs.get(assoc.handle) is not assoc:
+                # Already removed or replaced
+                continue
+
+            assocs.remove(assoc.handle)
+            removed_assocs += 1
+            if not assocs.assocs:
+                del self.server_assocs[server_url]
+        return removed_assocs
+
+    def countNonces(self):
+        return sum(len(anonces) for anonces in self.nonces.values())
+
+    def countAssociations(self):
+        return sum(len(assocs.assocs)
+                   for assocs in self.server_assocs.values())
+
     def __eq__(self, other):
         return ((self.server_assocs == other.server_assocs) and
                 (self.nonces == other.nonces))
 
     def __ne__(self, other):
         return not (self == other)
+
+
+class ShardedMemoryStore(object):
+    """In-process memory store that is safe to share between threads.
+
+    Associations and nonces are spread over a number of
+    C{L{MemoryStore}} shards by the hash of their server URL, and each
+    shard has its own lock, so threads working with different servers
+    rarely wait for each other.  Nonces are sharded on their salt as
+    well, so that the nonces the consumer generates for itself (which
+    all have an empty server URL) do not all end up in the same shard.
+
+    Any extra keyword arguments are passed on to each C{L{MemoryStore}}.
+    """
+
+    def __init__(self, shards=16, **kwargs):
+        self.shards = [MemoryStore(**kwargs) for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    def _shardIndex(self, key):
+        return hash(key) % len(self.shards)
+
+    def _call(self, key, method_name, *args):
+        index = self._shardIndex(key)
+        with self.locks[index]:
+            return getattr(self.shards[index], method_name)(*args)
+
+    def storeAssociation(self, server_url, assoc):
+        return self._call(server_url, 'storeAssociation', server_url, assoc)
+
+    def getAssociation(self, server_url, handle=None):
+        return self._call(server_url, 'getAssociation', server_url, handle)
+
+    def removeAssociation(self, server_url, handle):
+        return self._call(server_url, 'removeAssociation', server_url, handle)
+
+    def useNonce(self, server_url, timestamp, salt):
+        return self._call((server_url, salt), 'useNonce', server_url,
+                          timestamp, salt)
+
+    def _callAll(self, method_name):
+        total = 0
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                total += getattr(shard, method_name)()
+        return total
+
+    def cleanupNonces(self):
+        return self._callAll('cleanupNonces')
+
+    def cleanupAssociations(self):
+        return self._callAll('cleanupAssociations')
+
+    def cleanup(self):
+        return self.cleanupNonces(), self.cleanupAssociations()
@@ -0,0 +1,296 @@
+"""
+This module contains an C{L{OpenIDStore}} that checks nonces against
+in-memory Bloom filters and writes new nonces to another store in
+batches.
+
+Example of how to use it in a consumer that is the only user of its
+store::
+
+    store = noncebatch.BatchingNonceStore(sqlstore.SQLiteStore(conn),
+                                          trusted_since=time.time())
+    ...
+    store.close()
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from openid.store.interface import OpenIDStore
+from openid.store import nonce
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """A Bloom filter over strings.
+
+    @ivar bits: The bit array.
+    @ivar num_hashes: The number of bits set for each item.
+    """
+
+    def __init__(self, capacity, error_rate):
+        """Make a filter that gives false positives for about
+        C{error_rate} of lookups once it holds C{capacity} items.
+        """
+        num_bits = int(-capacity * math.log(error_rate) / math.log(2)**2)
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(
+            int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.sha256(item.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        for position in self._positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class BatchingNonceStore(OpenIDStore):
+    """
+    This store keeps a Bloom filter of the nonces it has accepted, one
+    for each C{bucket_size} seconds of nonce timestamps, and uses them
+    to avoid a synchronous write to the backing store for each nonce.
+
+    When the filter says that a nonce has not been seen, it is
+    accepted at once and queued.  The queue is written to the backing
+    store by the L{useNonce} call that finds it holding C{batch_size}
+    nonces or its oldest nonce waiting C{max_delay} seconds, unless
+    another thread is writing a batch already, and L{flush} writes it
+    at once.  There is no background thread, so the backing store is
+    only used from the threads that call this store, and needs no more
+    thread safety than it would without it.  Each batch is written
+    with the backing store's C{useNonces} method if it has one, as the
+    SQL and Redis stores do, so that it costs one statement or round
+    trip, and with C{useNonce} for each nonce otherwise.  When the filter says that the nonce may
+    have been seen, it is checked against the queue and then against
+    the backing store, so that this store never accepts a nonce twice.
+
+    The filters only know about nonces that went through this store.
+    So a filter answer is only trusted for nonces whose timestamps are
+    recent enough that any earlier use of them must have happened after
+    C{trusted_since}; older ones are checked against the backing store
+    directly.  When other stores have used the backing store before,
+    C{trusted_since} has to be about when this store was created, and
+    then every nonce goes straight to the backing store for the first
+    C{L{nonce.SKEW<openid.store.nonce.SKEW>}} seconds.  A process that
+    is restarted more often than that never batches at all.
+
+    This trades durability for speed:
+
+      - A nonce is accepted before it is in the backing store.  Another
+        process using the same backing store can accept the same nonce
+        until the batch is written, so this store must be the only one
+        writing nonces to it.  A nonce that turns out to be there
+        already when the batch is written is only logged.
+
+      - Queued nonces are lost if the process dies before they are
+        written.  A new store started after that cannot tell that they
+        were used, so they can be replayed against it.  Call L{close}
+        on shutdown to write the queue out.
+
+      - A queue that stops growing is only written by the next call
+        to L{useNonce}, L{flush}, L{cleanupNonces} or L{close}, so
+        C{max_delay} is not a bound when no nonces are coming in.
+
+    Associations are passed straight through to the backing store.
+    """
+
+    def __init__(self, store, trusted_since, batch_size=100,
+                 max_delay=1.0, bucket_size=600, capacity=100000,
+                 error_rate=0.001):
+        """
+        Create a new BatchingNonceStore.
+
+        @param store: The store to keep nonces and associations in.
+
+        @type store: C{L{OpenIDStore}}
+
+        @param trusted_since: The time since which every nonce has been
+            used through this store.  Pass C{0} if the backing store has
+            never held any nonces, so that batching starts at once.
+            Otherwise pass the time this store is created, plus the
+            C{max_delay} of a store it replaces, so that every nonce
+            that could have been used before is checked against the
+            backing store.  See the class documentation for the cost.
+
+        @param batch_size: The number of queued nonces at which the
+            queue is written out.
+
+        @param max_delay: The longest time, in seconds, that a nonce
+            may wait in the queue before it is written out.
+
+        @param bucket_size: The number of seconds of nonce timestamps
+            covered by each Bloom filter.
+
+        @param capacity: The number of nonces each Bloom filter is
+            sized for.
+
+        @param error_rate: The false positive rate each Bloom filter
+            is sized for.  False positives cost a read of the backing
+            store but never a wrongly rejected nonce.
+        """
+        self.store = store
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.bucket_size = bucket_size
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.trusted_since = trusted_since
+
+        # bucket number -> BloomFilter
+        self.filters = {}
+        # (server_url, timestamp, salt) -> None, in the order queued
+        self.pending = {}
+        # The batch being written, which still counts as seen
+        self._writing = {}
+        self._pending_since = None
+        self._lock = threading.RLock()
+        # Only one batch is written at a time
+        self._flush_lock = threading.Lock()
+
+    def storeAssociation(self, server_url, association):
+        return self.store.storeAssociation(server_url, association)
+
+    def getAssociation(self, server_url, handle=None):
+        return self.store.getAssociation(server_url, handle)
+
+    def removeAssociation(self, server_url, handle):
+        return self.store.removeAssociation(server_url, handle)
+
+    def _getFilter(self, timestamp):
+        bucket = timestamp // self.bucket_size
+        try:
+            return self.filters[bucket]
+        except KeyError:
+            bloom = self.filters[bucket] = BloomFilter(self.capacity,
+                                                       self.error_rate)
+            return bloom
+
+    def useNonce(self, server_url, timestamp, salt):
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
+            return False
+
+        anonce = (str(server_url), int(timestamp), str(salt))
+        item = '%s\0%d\0%s' % anonce
+        with self._lock:
+            bloom = self._getFilter(anonce[1])
+            if item in bloom or timestamp - nonce.SKEW < self.trusted_since:
+                # Maybe seen; ask the authoritative stores
+                if anonce in self.pending or anonce in self._writing:
+                    return False
+                if not self.store.useNonce(server_url, timestamp, salt):
+                    return False
+                due = False
+            else:
+                if not self.pending:
+                    self._pending_since = now
+                self.pending[anonce] = None
+                due = (len(self.pending) >= self.batch_size or
+                       now - self._pending_since >= self.max_delay)
+
+            bloom.add(item)
+
+        if due and self._flush_lock.acquire(False):
+            # The nonce is accepted whether or not its batch can be
+            # written now; a failed batch stays queued for the next try
+            try:
+                self._flush()
+            except Exception:
+                logger.exception('Could not write nonces to the backing '
+                                 'store; will retry')
+            finally:
+                self._flush_lock.release()
+        return True
+
+    def flush(self):
+        """Write the queued nonces to the backing store.  Nonces can
+        still be used while the batch is being written.
+
+        @return: the number of nonces written.
+        @returntype: int
+        """
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        """Write the queued nonces out, with C{_flush_lock} held."""
+        with self._lock:
+            batch = self._writing = self.pending
+            self.pending = {}
+            self._pending_since = None
+
+        if not batch:
+            return 0
+
+        try:
+            self._writeBatch(list(batch))
+        except:
+            # Keep the batch for next time, ahead of anything queued
+            # since
+            with self._lock:
+                batch.update(self.pending)
+                self.pending = batch
+                self._pending_since = time.time()
+            raise
+        finally:
+            with self._lock:
+                self._writing = {}
+        return len(batch)
+
+    def _writeBatch(self, batch):
+        now = time.time()
+        live = [anonce for anonce in batch
+                if abs(anonce[1] - now) <= nonce.SKEW]
+        use_nonces = getattr(self.store, 'useNonces', None)
+        if use_nonces is not None:
+            added = use_nonces(live)
+        else:
+            added = 0
+            for anonce in live:
+                if self.store.useNonce(*anonce):
+                    added += 1
+
+        if added < len(live):
+            logger.warning(
+                '%d of %d nonces were already in the backing store; is '
+                'another process using it?', len(live) - added, len(live))
+
+    def close(self):
+        """Write out the queue."""
+        self.flush()
+
+    def cleanupNonces(self):
+        with self._lock:
+            now = time.time()
+            expired = [
+                anonce for anonce in self.pending
+                if abs(anonce[1] - now) > nonce.SKEW
+            ]
+            for anonce in expired:
+                del self.pending[anonce]
+        self.flush()
+
+        with self._lock:
+            oldest = now - nonce.SKEW
+            for bucket in list(self.filters):
+                if (bucket + 1) * self.bucket_size <= oldest:
+                    del self.filters[bucket]
+        return len(expired) + self.store.cleanupNonces()
+
+    def cleanupAssociations(self):
+        return self.store.cleanupAssociations()
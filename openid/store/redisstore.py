@@ -0,0 +1,272 @@
+"""
+This module contains an C{L{OpenIDStore}} implementation for
+key-value servers that speak the Redis protocol, such as Redis or
+Valkey.
+
+Example of how to create a store::
+
+    import redis
+    store = redisstore.RedisStore(redis.Redis())
+
+Associations, nonces and the indexes of associations are all given
+native expiration times, so the server drops them by itself once they
+are no longer useful, and the store stays bounded without a cleanup
+job.
+"""
+
+import binascii
+import itertools
+import time
+
+from openid.association import Association
+from openid.store.interface import OpenIDStore
+from openid.store import nonce
+from openid import cryptutil, oidutil
+
+
+def _hashKey(s):
+    return binascii.hexlify(cryptutil.sha1(s)).decode('ascii')
+
+
+def _globEscape(s):
+    return ''.join('\\' + c if c in '*?[]\\' else c for c in s)
+
+
+def _toStr(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+class RedisStore(OpenIDStore):
+    """
+    This is a store for OpenID associations and nonces kept in a
+    Redis-protocol key-value server.
+
+    Each association is a hash whose expiration time is that of the
+    association.  The associations for each server URL are indexed by
+    a sorted set ordered by issued date, so that the newest one can be
+    found without looking at the rest, and a second sorted set, ordered
+    by expiration time, lets C{L{cleanupAssociations}} prune the
+    indexes.  Both indexes expire C{index_grace} seconds after the last
+    association in them, are trimmed of entries that expired longer ago
+    than that whenever an association is stored, and the index for a
+    server URL keeps at most C{max_server_index} entries.
+
+    Each nonce is a key set with C{SET NX EX}, so checking a nonce is a
+    single command.  The key holds the nonce's timestamp, so that
+    C{L{cleanupNonces}} can find and remove nonces early when
+    L{nonce.SKEW<openid.store.nonce.SKEW>} is lowered.
+
+    Any client object with the C{redis-py} interface for the commands
+    this store uses will do, including pipelines.
+
+    @cvar index_grace: How many seconds entries are kept in the
+        indexes after their association expires.
+
+    @cvar max_server_index: How many of the newest associations for a
+        server URL are kept in its index.  Older ones can still be
+        found by handle.
+
+    @cvar scan_batch_size: How many nonce keys C{L{cleanupNonces}}
+        reads and deletes at a time.
+    """
+
+    index_grace = 24 * 60 * 60
+    max_server_index = 64
+    scan_batch_size = 500
+
+    def __init__(self, client, prefix='openid:'):
+        """
+        Create a new RedisStore.
+
+        @param client: The client to use to talk to the server,
+            such as a C{redis.Redis} instance.
+
+        @param prefix: A string to start the names of all of the keys
+            the store uses with.
+
+        @type prefix: C{str}
+        """
+        self.client = client
+        self.prefix = prefix
+        self.assoc_expiry_key = prefix + 'assoc-expiry'
+
+    def _assocKey(self, member):
+        return '%sassoc:%s' % (self.prefix, member)
+
+    def _assocMember(self, server_url, handle):
+        return '%s:%s' % (_hashKey(server_url), _hashKey(handle))
+
+    def _serverKey(self, url_hash):
+        return '%sassocs:%s' % (self.prefix, url_hash)
+
+    def _nonceKey(self, server_url, timestamp, salt):
+        return '%snonce:%s' % (self.prefix, _hashKey(
+            '%s\0%d\0%s' % (server_url, timestamp, salt)))
+
+    def _indexExpiry(self, keys, expires):
+        """Return the time at which each index key should expire so
+        that it outlives both the association expiring at C{expires}
+        and whatever is in it already.
+
+        This reads the current expiration times before they are set,
+        so a concurrent store can shorten an index to the expiration of
+        its own association; the next store extends it again.
+
+        ([str], int) -> [int]
+        """
+        now = int(time.time())
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.ttl(key)
+        expiries = []
+        for ttl in pipe.execute():
+            # -2 is a missing key, and -1 one without an expiration
+            current = now + ttl if ttl >= 0 else 0
+            expiries.append(max(int(expires) + self.index_grace, current))
+        return expiries
+
+    def storeAssociation(self, server_url, association):
+        member = self._assocMember(server_url, association.handle)
+        key = self._assocKey(member)
+        server_key = self._serverKey(_hashKey(server_url))
+        expires = association.issued + association.lifetime
+        server_expiry, index_expiry = self._indexExpiry(
+            [server_key, self.assoc_expiry_key], expires)
+
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.hset(key, mapping={
+            'handle': association.handle,
+            'secret': oidutil.toBase64(association.secret),
+            'issued': int(association.issued),
+            'lifetime': int(association.lifetime),
+            'assoc_type': association.assoc_type,
+        })
+        pipe.expireat(key, int(expires))
+        pipe.zadd(server_key, {member: association.issued})
+        pipe.zremrangebyrank(server_key, 0, -self.max_server_index - 1)
+        pipe.expireat(server_key, server_expiry)
+        pipe.zadd(self.assoc_expiry_key, {member: expires})
+        pipe.zremrangebyscore(self.assoc_expiry_key, '-inf',
+                              '(%d' % (time.time() - self.index_grace, ))
+        pipe.expireat(self.assoc_expiry_key, index_expiry)
+        pipe.execute()
+
+    def _loadAssociation(self, member):
+        values = self.client.hgetall(self._assocKey(member))
+        if not values:
+            return None
+
+        values = dict((_toStr(k), _toStr(v)) for k, v in values.items())
+        association = Association(values['handle'],
+                                  oidutil.fromBase64(values['secret']),
+                                  int(values['issued']),
+                                  int(values['lifetime']),
+                                  values['assoc_type'])
+        if association.expiresIn == 0:
+            return None
+        return association
+
+    def getAssociation(self, server_url, handle=None):
+        if handle is not None:
+            return self._loadAssociation(
+                self._assocMember(server_url, handle))
+
+        server_key = self._serverKey(_hashKey(server_url))
+        while True:
+            members = self.client.zrevrange(server_key, 0, 0)
+            if not members:
+                return None
+
+            member = _toStr(members[0])
+            association = self._loadAssociation(member)
+            if association is not None:
+                return association
+
+            # Expired; drop it from the index and try the next one
+            self.client.zrem(server_key, member)
+
+    def removeAssociation(self, server_url, handle):
+        member = self._assocMember(server_url, handle)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(self._assocKey(member))
+        pipe.zrem(self._serverKey(_hashKey(server_url)), member)
+        pipe.zrem(self.assoc_expiry_key, member)
+        removed = pipe.execute()[0]
+        return removed > 0
+
+    def useNonce(self, server_url, timestamp, salt):
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
+            return False
+
+        return bool(self._setNonce(self.client, now, server_url, timestamp,
+                                   salt))
+
+    def useNonces(self, nonces):
+        """Add many nonces in one round trip, returning how many of them
+        were not there before.  Nonces outside of the allowed clock
+        skew are left out.
+
+        [(str, int, str)] -> int
+        """
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for server_url, timestamp, salt in nonces:
+            if abs(timestamp - now) <= nonce.SKEW:
+                self._setNonce(pipe, now, server_url, timestamp, salt)
+        return sum(1 for added in pipe.execute() if added)
+
+    def _setNonce(self, client, now, server_url, timestamp, salt):
+        key = self._nonceKey(server_url, timestamp, salt)
+        # Remember the nonce for as long as it would pass the
+        # timestamp check
+        ttl = max(int(timestamp + nonce.SKEW - now) + 1, 1)
+        return client.set(key, int(timestamp), ex=ttl, nx=True)
+
+    def cleanupNonces(self):
+        """Remove nonces that have expired from the store.  The server
+        expires them by itself, so this only has work to do if
+        L{nonce.SKEW<openid.store.nonce.SKEW>} has been lowered since
+        they were stored.  It scans the keys of all of the store's
+        nonces to find them, C{scan_batch_size} at a time.
+        """
+        now = time.time()
+        keys = self.client.scan_iter(
+            match=_globEscape(self.prefix) + 'nonce:*',
+            count=self.scan_batch_size)
+        removed = 0
+        while True:
+            batch = list(itertools.islice(keys, self.scan_batch_size))
+            if not batch:
+                return removed
+
+            expired = []
+            for key, timestamp in zip(batch, self.client.mget(batch)):
+                if (timestamp is not None and
+                        abs(int(timestamp) - now) > nonce.SKEW):
+                    expired.append(key)
+            if expired:
+                removed += self.client.delete(*expired)
+
+    def cleanupAssociations(self):
+        """Remove expired associations from the store's indexes.  The
+        server expires the associations themselves by itself; they are
+        counted here when they are dropped from the indexes.
+        """
+        members = self.client.zrangebyscore(self.assoc_expiry_key, '-inf',
+                                            int(time.time()))
+        if not members:
+            return 0
+
+        pipe = self.client.pipeline(transaction=True)
+        for member in members:
+            member = _toStr(member)
+            url_hash = member.split(':', 1)[0]
+            pipe.delete(self._assocKey(member))
+            pipe.zrem(self._serverKey(url_hash), member)
+        pipe.zrem(self.assoc_expiry_key, *members)
+        removed = pipe.execute()[-1]
+        return removed
@@ -0,0 +1,260 @@
+"""
+This module contains a scheduler that periodically removes expired
+data from a store, off the request path.
+
+Example of how to clean up a store every ten minutes on a daemon
+thread::
+
+    store = sqlstore.PooledSQLiteStore(connect)
+    cleaner = scheduler.CleanupScheduler(store, interval=600)
+    cleaner.start()
+
+or on an asyncio event loop::
+
+    task = cleaner.startTask()
+
+Either way the cleanup runs on another thread than the requests, so
+the store has to be safe to use from several threads at once, like the
+L{pooled SQL stores<openid.store.sqlstore.PooledSQLStore>},
+L{ShardedMemoryStore<openid.store.memstore.ShardedMemoryStore>} and
+L{RedisStore<openid.store.redisstore.RedisStore>}.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from openid.store.sqlstore import SQLStore, PooledSQLStore
+
+logger = logging.getLogger(__name__)
+
+
+class CleanupScheduler(object):
+    """
+    Runs C{cleanupNonces} and C{cleanupAssociations} on a store every
+    C{interval} seconds, give or take a random C{jitter} fraction of
+    the interval so that several processes sharing a store do not all
+    clean it up at once.
+
+    If C{time_budget} is given, a run stops starting new cleanup steps
+    once it has taken that many seconds, and the steps it did not get
+    to run first on the next run.  Stores whose cleanup is done in
+    bounded batches, such as the L{SQL stores<openid.store.sqlstore>},
+    are given the end of the budget as a C{deadline} and stop starting
+    batches after it; a step cut short that way also runs first on the
+    next run.  Other stores' steps are not interrupted, so for them the
+    budget is only checked between steps.
+
+    After each run, the number of entries left in the store is counted
+    with its C{countNonces} and C{countAssociations} methods, for the
+    stores that have them, such as the SQL stores and
+    L{MemoryStore<openid.store.memstore.MemoryStore>}.
+
+    L{start} and L{startTask} run the cleanups on another thread, so
+    they need a store that is safe to use from several threads at once.
+    They refuse the SQL stores that are not pooled, which share one
+    connection and cursor between all of their callers.
+    L{MemoryStore<openid.store.memstore.MemoryStore>} is not safe
+    either; use
+    L{ShardedMemoryStore<openid.store.memstore.ShardedMemoryStore>}.
+    L{runOnce} can be called from the thread that uses the store.
+
+    @ivar runs: The number of runs so far.
+    @ivar removed_nonces: The total number of nonces removed.
+    @ivar removed_associations: The total number of associations
+        removed.
+    @ivar last_removed: A dict of the number of entries removed by
+        the last run, by kind, C{'nonces'} and C{'associations'}.
+    @ivar last_remaining: A dict of the number of entries left in the
+        store after the last run, by kind, with C{None} for the kinds
+        the store cannot count.
+    @ivar deferred: The names of the steps left for the next run by a
+        run that went over its time budget.
+    @ivar errors: The number of steps that raised an exception.
+    @ivar last_duration: How long the last run took, in seconds.
+    """
+
+    def __init__(self, store, interval=3600, jitter=0.1, time_budget=None):
+        """
+        Create a new CleanupScheduler.
+
+        @param store: The store to clean up.
+
+        @type store: C{L{OpenIDStore<openid.store.interface.OpenIDStore>}}
+
+        @param interval: The time between runs, in seconds.
+
+        @param jitter: The largest fraction of C{interval} by which to
+            move each run earlier or later at random.
+
+        @param time_budget: The time in seconds after which a run
+            stops starting new steps, or C{None} for no limit.
+        """
+        self.store = store
+        self.interval = interval
+        self.jitter = jitter
+        self.time_budget = time_budget
+
+        self.runs = 0
+        self.removed_nonces = 0
+        self.removed_associations = 0
+        self.last_removed = {}
+        self.last_remaining = {}
+        self.deferred = []
+        self.errors = 0
+        self.last_duration = None
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def nextDelay(self):
+        """Return the time to wait before the next run.
+
+        () -> float
+        """
+        spread = self.interval * self.jitter
+        return max(self.interval + random.uniform(-spread, spread), 0)
+
+    def runOnce(self):
+        """Clean up the store now.
+
+        @return: The number of entries removed, by kind.
+        @returntype: dict
+        """
+        steps = {
+            'nonces': self.store.cleanupNonces,
+            'associations': self.store.cleanupAssociations,
+        }
+        counters = {
+            'nonces': 'countNonces',
+            'associations': 'countAssociations',
+        }
+        # The stores that clean up in batches can stop at a deadline
+        batched = hasattr(self.store, 'cleanup_batch_size')
+        with self._lock:
+            start = time.time()
+            deadline = None
+            if self.time_budget is not None:
+                deadline = start + self.time_budget
+            order = self.deferred + [
+                name for name in sorted(steps) if name not in self.deferred
+            ]
+            self.deferred = []
+            removed = {}
+            for i, name in enumerate(order):
+                if deadline is not None and time.time() >= deadline:
+                    self.deferred = order[i:]
+                    break
+
+                try:
+                    if deadline is not None and batched:
+                        removed[name] = steps[name](deadline=deadline)
+                    else:
+                        removed[name] = steps[name]()
+                except Exception:
+                    self.errors += 1
+                    logger.exception('Error cleaning up %s in %r', name,
+                                     self.store)
+                    continue
+
+                if (deadline is not None and batched and
+                        time.time() >= deadline):
+                    # The step may have stopped before it was done
+                    self.deferred = order[i:]
+                    break
+
+            remaining = {}
+            for name in sorted(steps):
+                counter = getattr(self.store, counters[name], None)
+                remaining[name] = None
+                if counter is not None:
+                    try:
+                        remaining[name] = counter()
+                    except Exception:
+                        self.errors += 1
+                        logger.exception('Error counting %s in %r', name,
+                                         self.store)
+
+            self.runs += 1
+            self.removed_nonces += removed.get('nonces') or 0
+            self.removed_associations += removed.get('associations') or 0
+            self.last_removed = removed
+            self.last_remaining = remaining
+            self.last_duration = time.time() - start
+            return removed
+
+    def getStats(self):
+        """Return the scheduler's counters.
+
+        () -> dict
+        """
+        return {
+            'runs': self.runs,
+            'removed_nonces': self.removed_nonces,
+            'removed_associations': self.removed_associations,
+            'last_removed': dict(self.last_removed),
+            'last_remaining': dict(self.last_remaining),
+            'deferred': list(self.deferred),
+            'errors': self.errors,
+            'last_duration': self.last_duration,
+        }
+
+    def _checkThreadSafe(self):
+        if (isinstance(self.store, SQLStore) and
+                not isinstance(self.store, PooledSQLStore)):
+            raise ValueError(
+                '%r shares one connection between threads, so it can not '
+                'be cleaned up in the background; use a pooled SQL store '
+                'or call runOnce' % (self.store, ))
+
+    def start(self):
+        """Start running cleanups on a daemon thread.
+
+        @raises ValueError: If the store is an SQL store that is not
+            pooled.
+        """
+        self._checkThreadSafe()
+        if self._thread is not None:
+            raise RuntimeError('Cleanup scheduler already started')
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._runThread,
+                                        name='openid-store-cleanup')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the daemon thread started by L{start}, waiting up to
+        C{timeout} seconds for a run in progress to finish."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _runThread(self):
+        while not self._stopped.wait(self.nextDelay()):
+            self.runOnce()
+
+    async def runForever(self):
+        """Run cleanups until cancelled, waiting on the event loop and
+        running each cleanup in the loop's default executor so that it
+        does not block the loop."""
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.nextDelay())
+            await loop.run_in_executor(None, self.runOnce)
+
+    def startTask(self):
+        """Start running cleanups as a task on the running event loop.
+
+        @return: The task; cancel it to stop.
+        @returntype: C{asyncio.Task}
+
+        @raises ValueError: If the store is an SQL store that is not
+            pooled.
+        """
+        self._checkThreadSafe()
+        return asyncio.ensure_future(self.runForever())
@@ -0,0 +1,547 @@
+"""
+This module contains an C{L{OpenIDStore}} implementation backed by a
+memory-mapped file, which all of the processes on one host can share.
+
+Example of how to share a store between the workers of a pre-fork
+server::
+
+    store = shmstore.SharedMemoryStore('/dev/shm/openid-store')
+
+The file holds fixed-size hash tables for associations and nonces.
+Lookups and insertions take a POSIX record lock on the file (shared
+for reads, exclusive for writes), so this store only works on
+platforms with C{fcntl.lockf}, and this module is not imported by
+C{from openid.store import *}.  Those locks belong to the process
+rather than to the file descriptor, so a store created before the
+server forks its workers may safely be used in all of them.  Within
+one process, every store on the same file shares a thread lock
+instead.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from openid.association import Association
+from openid.store.interface import OpenIDStore
+from openid.store import nonce
+from openid import cryptutil
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'OIDSHM02'
+
+# magic, number of association slots, number of nonce slots
+_header = struct.Struct('<8sII')
+
+_EMPTY = 0
+_USED = 1
+_DELETED = 2
+
+# state, server URL hash, handle hash, issued, lifetime, data length
+_assoc_record = struct.Struct('<B20s20sqqH')
+
+# Room for the serialized association in each association slot
+ASSOC_DATA_SIZE = 1024
+
+_ASSOC_SLOT_SIZE = _assoc_record.size + ASSOC_DATA_SIZE
+
+# state, server URL hash, handle hash, issued of the newest association
+# stored for the server
+_latest_record = struct.Struct('<B20s20sq')
+
+_LATEST_SLOT_SIZE = _latest_record.size
+
+# state, nonce hash, timestamp
+_nonce_record = struct.Struct('<B20sq')
+
+_NONCE_SLOT_SIZE = _nonce_record.size
+
+# (st_dev, st_ino) -> the threading.Lock that every store on the file
+# in this process shares.  Record locks do not exclude the threads of
+# one process, nor two stores that it has open on the same file, and
+# closing any descriptor for the file releases all of them.
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+def _fileLock(fd):
+    st = os.fstat(fd)
+    with _file_locks_lock:
+        return _file_locks.setdefault((st.st_dev, st.st_ino),
+                                      threading.Lock())
+
+
+def _slotFor(key, slots):
+    return int.from_bytes(key[:8], 'little') % slots
+
+
+def _assocSlotFor(url_key, handle_key, slots):
+    return ((int.from_bytes(url_key[:8], 'little') ^
+             int.from_bytes(handle_key[:8], 'little')) % slots)
+
+
+def _nonceKey(server_url, timestamp, salt):
+    return cryptutil.sha1('%s\0%d\0%s' % (server_url, timestamp, salt))
+
+
+class SharedMemoryStore(OpenIDStore):
+    """
+    This is a store for OpenID associations and nonces kept in a
+    memory-mapped file, so that every process that opens the same
+    file sees the same data.
+
+    The tables use open addressing with linear probing, keyed on the
+    hashes of the server URL and handle for associations and on the
+    hash of the whole nonce for nonces.  A third table, keyed on the
+    server URL, points to the newest association stored for each
+    server, so that L{getAssociation} without a handle does not have
+    to search.  The sizes of the tables are fixed when the file is
+    created.  Expired entries are reused when inserting, but if the
+    nonce table fills up with current nonces, L{useNonce} rejects new
+    nonces rather than forgetting old ones, and if the association
+    table is full, L{storeAssociation} raises C{ValueError}.
+
+    Most of the methods of this class are implementation details.
+    People wishing to just use this store need only pay attention to
+    the C{L{__init__}} method.
+    """
+
+    def __init__(self, filename, assoc_slots=4096, nonce_slots=65536):
+        """
+        Open the store in C{filename}, creating it if it does not
+        exist yet.
+
+        @param filename: The file to keep the store in.  It should be
+            on a memory-backed filesystem such as C{/dev/shm} if
+            possible.
+
+        @type filename: C{str}
+
+        @param assoc_slots: The number of associations the store can
+            hold.  Ignored if the file already exists.
+
+        @type assoc_slots: C{int}
+
+        @param nonce_slots: The number of nonces the store can hold.
+            Ignored if the file already exists.
+
+        @type nonce_slots: C{int}
+        """
+        self.filename = filename
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._thread_lock = _fileLock(self._fd)
+        except:
+            os.close(self._fd)
+            raise
+
+        try:
+            self._lock(fcntl.LOCK_EX)
+            try:
+                self._setup(assoc_slots, nonce_slots)
+            finally:
+                self._unlock()
+        except:
+            self._closeFile()
+            raise
+
+    def _setup(self, assoc_slots, nonce_slots):
+        """Read the table sizes from the file, initializing it first
+        if it is empty, and map it into memory.
+
+        (int, int) -> NoneType
+        """
+        if os.fstat(self._fd).st_size == 0:
+            size = (_header.size + assoc_slots *
+                    (_ASSOC_SLOT_SIZE + _LATEST_SLOT_SIZE) +
+                    nonce_slots * _NONCE_SLOT_SIZE)
+            os.ftruncate(self._fd, size)
+            os.pwrite(self._fd, _header.pack(_MAGIC, assoc_slots,
+                                             nonce_slots), 0)
+
+        header = os.pread(self._fd, _header.size, 0)
+        if len(header) != _header.size:
+            raise ValueError('%r is not an OpenID store' % (self.filename, ))
+
+        magic, self.assoc_slots, self.nonce_slots = _header.unpack(header)
+        if magic != _MAGIC:
+            raise ValueError('%r is not an OpenID store' % (self.filename, ))
+
+        self._assoc_offset = _header.size
+        self._latest_offset = (self._assoc_offset +
+                               self.assoc_slots * _ASSOC_SLOT_SIZE)
+        self._nonce_offset = (self._latest_offset +
+                              self.assoc_slots * _LATEST_SLOT_SIZE)
+        self._map = mmap.mmap(self._fd, 0)
+
+    def close(self):
+        """Unmap and close the store file. The store cannot be used
+        afterwards.
+        """
+        self._map.close()
+        self._closeFile()
+
+    def _closeFile(self):
+        # Closing the file releases the record locks of the other stores
+        # on it in this process, so wait until none of them holds one
+        with self._thread_lock:
+            os.close(self._fd)
+
+    def _lock(self, operation):
+        self._thread_lock.acquire()
+        try:
+            fcntl.lockf(self._fd, operation)
+        except:
+            self._thread_lock.release()
+            raise
+
+    def _unlock(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def _readAssoc(self, slot):
+        offset = self._assoc_offset + slot * _ASSOC_SLOT_SIZE
+        return _assoc_record.unpack_from(self._map, offset)
+
+    def _writeAssoc(self, slot, *fields):
+        offset = self._assoc_offset + slot * _ASSOC_SLOT_SIZE
+        _assoc_record.pack_into(self._map, offset, *fields)
+
+    def _readAssocData(self, slot, length):
+        offset = (self._assoc_offset + slot * _ASSOC_SLOT_SIZE +
+                  _assoc_record.size)
+        return self._map[offset:offset + length]
+
+    def _assocProbe(self, start):
+        """Yield the association slots in probing order from C{start},
+        along with their records.  The last slot yielded is empty
+        unless the table has no empty slots.
+        """
+        for i in range(self.assoc_slots):
+            slot = (start + i) % self.assoc_slots
+            record = self._readAssoc(slot)
+            yield slot, record
+            if record[0] == _EMPTY:
+                return
+
+    def _findAssoc(self, url_key, handle_key):
+        """Return the slot and record of an association, or None."""
+        start = _assocSlotFor(url_key, handle_key, self.assoc_slots)
+        for slot, record in self._assocProbe(start):
+            if record[0] == _USED and record[1:3] == (url_key, handle_key):
+                return slot, record
+        return None
+
+    def _readLatest(self, slot):
+        offset = self._latest_offset + slot * _LATEST_SLOT_SIZE
+        return _latest_record.unpack_from(self._map, offset)
+
+    def _writeLatest(self, slot, *fields):
+        offset = self._latest_offset + slot * _LATEST_SLOT_SIZE
+        _latest_record.pack_into(self._map, offset, *fields)
+
+    def _latestProbe(self, url_key):
+        start = _slotFor(url_key, self.assoc_slots)
+        for i in range(self.assoc_slots):
+            slot = (start + i) % self.assoc_slots
+            record = self._readLatest(slot)
+            yield slot, record
+            if record[0] == _EMPTY:
+                return
+
+    def _findLatest(self, url_key):
+        """Return the record of the newest association stored for a
+        server, or None if no associations for it are stored.
+        """
+        for slot, record in self._latestProbe(url_key):
+            if record[0] == _USED and record[1] == url_key:
+                return record
+        return None
+
+    def _setLatest(self, url_key, handle_key, issued):
+        """Point the server's entry in the newest-association table at
+        an association, if it is newer than the one it points at.
+
+        Every server with associations in the association table has an
+        entry, so there is room for one for each association slot.
+        Entries for servers whose associations have all gone are
+        reclaimed when the table fills up, and by
+        L{cleanupAssociations}.
+
+        Must be called with the exclusive lock held.
+        """
+        free_slot = None
+        for slot, record in self._latestProbe(url_key):
+            state, r_url, r_handle, r_issued = record
+            if state == _USED and r_url == url_key:
+                if (issued >= r_issued or
+                        self._liveAssoc(r_url, r_handle) is None):
+                    self._writeLatest(slot, _USED, url_key, handle_key,
+                                      issued)
+                return
+            elif state != _USED and free_slot is None:
+                free_slot = slot
+
+        if free_slot is None:
+            for slot, record in self._latestProbe(url_key):
+                if not self._hasAssocs(record[1]):
+                    free_slot = slot
+                    break
+            else:
+                raise ValueError('Association table in %r is full' %
+                                 (self.filename, ))
+
+        self._writeLatest(free_slot, _USED, url_key, handle_key, issued)
+
+    def _liveAssoc(self, url_key, handle_key):
+        """Return the slot and record of an unexpired association, or
+        None."""
+        found = self._findAssoc(url_key, handle_key)
+        if found is not None:
+            _, record = found
+            if record[3] + record[4] > int(time.time()):
+                return found
+        return None
+
+    def _hasAssocs(self, url_key):
+        for slot in range(self.assoc_slots):
+            record = self._readAssoc(slot)
+            if record[0] == _USED and record[1] == url_key:
+                return True
+        return False
+
+    def storeAssociation(self, server_url, association):
+        """Store an association in the association table.
+
+        (str, Association) -> NoneType
+        """
+        data = association.serialize()
+        if len(data) > ASSOC_DATA_SIZE:
+            raise ValueError('Association too large to store: %r' %
+                             (association.handle, ))
+
+        url_key = cryptutil.sha1(server_url)
+        handle_key = cryptutil.sha1(association.handle)
+        now = int(time.time())
+        start = _assocSlotFor(url_key, handle_key, self.assoc_slots)
+
+        self._lock(fcntl.LOCK_EX)
+        try:
+            target = None
+            expired = None
+            for slot, record in self._assocProbe(start):
+                state, r_url, r_handle, issued, lifetime, _ = record
+                if state == _USED and (r_url, r_handle) == (url_key,
+                                                            handle_key):
+                    # Replace the stored copy
+                    target = slot
+                    break
+                elif target is None and state != _USED:
+                    target = slot
+                elif (state == _USED and expired is None and
+                      issued + lifetime <= now):
+                    expired = slot
+
+            # Only write over an expired association when the table is
+            # full, so that cleanupAssociations still counts it
+            if target is None:
+                target = expired
+
+            if target is None:
+                raise ValueError('Association table in %r is full' %
+                                 (self.filename, ))
+
+            self._setLatest(url_key, handle_key, int(association.issued))
+
+            offset = (self._assoc_offset + target * _ASSOC_SLOT_SIZE +
+                      _assoc_record.size)
+            self._map[offset:offset + len(data)] = data
+            self._writeAssoc(target, _USED, url_key, handle_key,
+                             int(association.issued),
+                             int(association.lifetime), len(data))
+        finally:
+            self._unlock()
+
+    def getAssociation(self, server_url, handle=None):
+        """Retrieve an association. If no handle is specified, return
+        the association with the latest issued date.
+
+        (str, str or NoneType) -> Association or NoneType
+        """
+        url_key = cryptutil.sha1(server_url)
+
+        self._lock(fcntl.LOCK_SH)
+        try:
+            if handle is not None:
+                found = self._liveAssoc(url_key, cryptutil.sha1(handle))
+            else:
+                found = self._getLatestAssoc(url_key)
+
+            if found is None:
+                return None
+
+            slot, record = found
+            data = self._readAssocData(slot, record[5])
+        finally:
+            self._unlock()
+
+        return Association.deserialize(data)
+
+    def _getLatestAssoc(self, url_key):
+        """Return the slot and record of the unexpired association for
+        a server with the latest issued date, or None.
+        """
+        latest = self._findLatest(url_key)
+        if latest is None:
+            return None
+
+        found = self._liveAssoc(url_key, latest[2])
+        if found is not None:
+            return found
+
+        # The newest association has expired or been removed, so
+        # search for the newest one left
+        now = int(time.time())
+        best = None
+        for slot in range(self.assoc_slots):
+            record = self._readAssoc(slot)
+            state, r_url, _, issued, lifetime, _ = record
+            if (state == _USED and r_url == url_key and
+                    issued + lifetime > now and
+                    (best is None or issued > best[1][3])):
+                best = (slot, record)
+        return best
+
+    def removeAssociation(self, server_url, handle):
+        """Remove an association if it exists. Do nothing if it does not.
+
+        (str, str) -> bool
+        """
+        url_key = cryptutil.sha1(server_url)
+        handle_key = cryptutil.sha1(handle)
+
+        self._lock(fcntl.LOCK_EX)
+        try:
+            found = self._findAssoc(url_key, handle_key)
+            if found is None:
+                return False
+
+            slot, record = found
+            self._writeAssoc(slot, _DELETED, *record[1:])
+            return True
+        finally:
+            self._unlock()
+
+    def _readNonce(self, slot):
+        offset = self._nonce_offset + slot * _NONCE_SLOT_SIZE
+        return _nonce_record.unpack_from(self._map, offset)
+
+    def _writeNonce(self, slot, *fields):
+        offset = self._nonce_offset + slot * _NONCE_SLOT_SIZE
+        _nonce_record.pack_into(self._map, offset, *fields)
+
+    def useNonce(self, server_url, timestamp, salt):
+        """Return whether this nonce is valid.
+
+        str -> bool
+        """
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
+            return False
+
+        key = _nonceKey(server_url, timestamp, salt)
+        start = _slotFor(key, self.nonce_slots)
+
+        self._lock(fcntl.LOCK_EX)
+        try:
+            free_slot = None
+            for i in range(self.nonce_slots):
+                slot = (start + i) % self.nonce_slots
+                state, r_key, r_timestamp = self._readNonce(slot)
+                if state == _EMPTY:
+                    if free_slot is None:
+                        free_slot = slot
+                    break
+                elif state == _USED and r_key == key:
+                    return False
+                elif free_slot is None and (
+                        state == _DELETED or
+                        abs(r_timestamp - now) > nonce.SKEW):
+                    free_slot = slot
+
+            if free_slot is None:
+                logger.error('Nonce table in %r is full; rejecting nonce',
+                             self.filename)
+                return False
+
+            self._writeNonce(free_slot, _USED, key, int(timestamp))
+            return True
+        finally:
+            self._unlock()
+
+    def cleanupNonces(self):
+        now = time.time()
+        removed = 0
+        self._lock(fcntl.LOCK_EX)
+        try:
+            for slot in range(self.nonce_slots):
+                state, key, timestamp = self._readNonce(slot)
+                if state == _USED and abs(timestamp - now) > nonce.SKEW:
+                    self._writeNonce(slot, _DELETED, key, timestamp)
+                    removed += 1
+            self._compact(self.nonce_slots, self._readNonce,
+                          self._writeNonce)
+        finally:
+            self._unlock()
+        return removed
+
+    def cleanupAssociations(self):
+        now = int(time.time())
+        removed = 0
+        self._lock(fcntl.LOCK_EX)
+        try:
+            for slot in range(self.assoc_slots):
+                record = self._readAssoc(slot)
+                state, _, _, issued, lifetime, _ = record
+                if state == _USED and issued + lifetime <= now:
+                    self._writeAssoc(slot, _DELETED, *record[1:])
+                    removed += 1
+            self._compact(self.assoc_slots, self._readAssoc,
+                          self._writeAssoc)
+            self._rebuildLatest()
+        finally:
+            self._unlock()
+        return removed
+
+    def _rebuildLatest(self):
+        """Rebuild the newest-association table from the associations
+        left, dropping the entries of servers that have none.
+
+        Must be called with the exclusive lock held.
+        """
+        empty = (_EMPTY, b'', b'', 0)
+        for slot in range(self.assoc_slots):
+            self._writeLatest(slot, *empty)
+        for slot in range(self.assoc_slots):
+            state, url_key, handle_key, issued, _, _ = self._readAssoc(slot)
+            if state == _USED:
+                self._setLatest(url_key, handle_key, issued)
+
+    def _compact(self, slots, read, write):
+        """Turn deleted slots back into empty ones wherever no probe
+        sequence needs to pass through them, that is, where they are
+        followed by an empty slot.  This keeps lookups from getting
+        slower as entries come and go.
+
+        Must be called with the exclusive lock held.
+        """
+        for slot in range(slots - 1, -1, -1):
+            record = read(slot)
+            if (record[0] == _DELETED and
+                    read((slot + 1) % slots)[0] == _EMPTY):
+                write(slot, _EMPTY, *record[1:])
@@ -7,7 +7,7 @@ Example of how to initialize a store database::
 python -c 'from openid.store import sqlstore; import pysqlite2.dbapi2;'
   'sqlstore.SQLiteStore(pysqlite2.dbapi2.connect("cstore.db")).createTables()'
 """
-import re
+import threading
 import time
 
 from openid.association import Association
@@ -58,12 +58,21 @@ class SQLStore(OpenIDStore):
     @cvar nonces_table: This is the default name of the table to keep
         nonces in.
 
+    @cvar cleanup_batch_size: The largest number of rows that
+        C{L{cleanupNonces}} and C{L{cleanupAssociations}} delete in
+        one transaction, so that cleaning up a large table does not
+        keep it locked for long.
+
 
     @sort: __init__, createTables
     """
 
     associations_table = 'oid_associations'
     nonces_table = 'oid_nonces'
+    cleanup_batch_size = 1000
+
+    count_nonce_sql = 'SELECT COUNT(*) FROM %(nonces)s;'
+    count_assoc_sql = 'SELECT COUNT(*) FROM %(associations)s;'
 
     def __init__(self, conn, associations_table=None, nonces_table=None):
         """
@@ -195,7 +204,9 @@ class SQLStore(OpenIDStore):
         exist.
         """
         self.db_create_nonce()
+        self.db_create_nonce_index()
         self.db_create_assoc()
+        self.db_create_assoc_index()
 
     createTables = _inTxn(txn_createTables)
 
@@ -207,7 +218,7 @@ class SQLStore(OpenIDStore):
         a = association
         self.db_set_assoc(server_url, a.handle,
                           self.blobEncode(a.secret), a.issued, a.lifetime,
-                          a.assoc_type)
+                          a.assoc_type, a.issued + a.lifetime)
 
     storeAssociation = _inTxn(txn_storeAssociation)
 
@@ -268,28 +279,114 @@ class SQLStore(OpenIDStore):
         except self.exceptions.IntegrityError:
             # The key uniqueness check failed
             return False
-        else:
-            # The nonce was successfully added
-            return True
+
+        # The add_nonce_sql of the stores in this module ignores
+        # duplicate nonces instead of failing, so that a replayed nonce
+        # does not cost an exception and a rollback; nothing is
+        # inserted for them.  A driver that cannot count the rows
+        # (-1 is undefined) gets the nonce rejected rather than let a
+        # replay through.
+        return self.cur.rowcount > 0
 
     useNonce = _inTxn(txn_useNonce)
 
-    def txn_cleanupNonces(self):
-        self.db_clean_nonce(int(time.time()) - nonce.SKEW)
+    def txn_useNonces(self, nonces):
+        """Add many nonces in one statement, returning how many of them
+        were not there before.  Nonces outside of the allowed clock
+        skew are left out.
+
+        [(str, int, str)] -> int
+        """
+        now = time.time()
+        rows = [[server_url, timestamp, salt]
+                for server_url, timestamp, salt in nonces
+                if abs(timestamp - now) <= nonce.SKEW]
+        if not rows:
+            return 0
+
+        self.cur.executemany(self._getSQL('add_nonce_sql'), rows)
+        return max(self.cur.rowcount, 0)  # -1 is undefined
+
+    useNonces = _inTxn(txn_useNonces)
+
+    def txn_cleanupNonces(self, batch_size):
+        """Remove at most batch_size expired nonces, returning how
+        many were removed.
+
+        int -> int
+        """
+        self.db_clean_nonce(int(time.time()) - nonce.SKEW, batch_size)
         return self.cur.rowcount
 
-    cleanupNonces = _inTxn(txn_cleanupNonces)
+    _cleanupNoncesBatch = _inTxn(txn_cleanupNonces)
+
+    def txn_cleanupAssociations(self, batch_size):
+        """Remove at most batch_size expired associations, returning
+        how many were removed.
 
-    def txn_cleanupAssociations(self):
-        self.db_clean_assoc(int(time.time()))
+        int -> int
+        """
+        self.db_clean_assoc(int(time.time()), batch_size)
         return self.cur.rowcount
 
-    cleanupAssociations = _inTxn(txn_cleanupAssociations)
+    _cleanupAssociationsBatch = _inTxn(txn_cleanupAssociations)
+
+    def _cleanupInBatches(self, clean_batch, deadline):
+        removed = 0
+        while True:
+            count = clean_batch(self.cleanup_batch_size)
+            if count > 0:
+                removed += count
+            if count < self.cleanup_batch_size:
+                return removed
+            if deadline is not None and time.time() >= deadline:
+                return removed
+
+    def cleanupNonces(self, deadline=None):
+        """Remove expired nonces, a batch at a time.  If C{deadline} is
+        given, no batch is started after that time, so some expired
+        nonces may be left.
+
+        (float or NoneType) -> int
+        """
+        return self._cleanupInBatches(self._cleanupNoncesBatch, deadline)
+
+    def cleanupAssociations(self, deadline=None):
+        """Remove expired associations, a batch at a time.  If
+        C{deadline} is given, no batch is started after that time, so
+        some expired associations may be left.
+
+        (float or NoneType) -> int
+        """
+        return self._cleanupInBatches(self._cleanupAssociationsBatch,
+                                      deadline)
+
+    def txn_countNonces(self):
+        """Return the number of nonces in the store.
+
+        () -> int
+        """
+        self.db_count_nonce()
+        return self.cur.fetchone()[0]
+
+    countNonces = _inTxn(txn_countNonces)
+
+    def txn_countAssociations(self):
+        """Return the number of associations in the store, including
+        expired ones that have not been cleaned up yet.
+
+        () -> int
+        """
+        self.db_count_assoc()
+        return self.cur.fetchone()[0]
+
+    countAssociations = _inTxn(txn_countAssociations)
 
 
 class SQLiteStore(SQLStore):
     """
-    This is an SQLite-based specialization of C{L{SQLStore}}.
+    This is an SQLite-based specialization of C{L{SQLStore}}.  It
+    needs SQLite 3.24 or later.
 
     To create an instance, see C{L{SQLStore.__init__}}.  To create the
     tables it will use, see C{L{SQLStore.createTables}}.
@@ -306,6 +403,10 @@ class SQLiteStore(SQLStore):
     );
     """
 
+    create_nonce_index_sql = """
+    CREATE INDEX %(nonces)s_timestamp ON %(nonces)s (timestamp);
+    """
+
     create_assoc_sql = """
     CREATE TABLE %(associations)s
     (
@@ -315,14 +416,20 @@ class SQLiteStore(SQLStore):
         issued INTEGER,
         lifetime INTEGER,
         assoc_type VARCHAR(64),
+        expires_at INTEGER,
         PRIMARY KEY (server_url, handle)
     );
     """
 
+    create_assoc_index_sql = """
+    CREATE INDEX %(associations)s_expires_at
+    ON %(associations)s (expires_at);
+    """
+
     set_assoc_sql = ('INSERT OR REPLACE INTO %(associations)s '
                      '(server_url, handle, secret, issued, '
-                     'lifetime, assoc_type) '
-                     'VALUES (?, ?, ?, ?, ?, ?);')
+                     'lifetime, assoc_type, expires_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?);')
     get_assocs_sql = ('SELECT handle, secret, issued, lifetime, assoc_type '
                       'FROM %(associations)s WHERE server_url = ?;')
     get_assoc_sql = (
@@ -330,32 +437,27 @@ class SQLiteStore(SQLStore):
         'FROM %(associations)s WHERE server_url = ? AND handle = ?;')
 
     get_expired_sql = ('SELECT server_url '
-                       'FROM %(associations)s WHERE issued + lifetime < ?;')
+                       'FROM %(associations)s WHERE expires_at < ?;')
 
     remove_assoc_sql = ('DELETE FROM %(associations)s '
                         'WHERE server_url = ? AND handle = ?;')
 
-    clean_assoc_sql = 'DELETE FROM %(associations)s WHERE issued + lifetime < ?;'
+    clean_assoc_sql = ('DELETE FROM %(associations)s WHERE rowid IN '
+                       '(SELECT rowid FROM %(associations)s '
+                       'WHERE expires_at < ? LIMIT ?);')
 
-    add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (?, ?, ?);'
+    # INSERT OR IGNORE would also ignore violations of other
+    # constraints than the nonce's uniqueness
+    add_nonce_sql = ('INSERT INTO %(nonces)s VALUES (?, ?, ?) '
+                     'ON CONFLICT (server_url, timestamp, salt) DO NOTHING;')
 
-    clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < ?;'
+    clean_nonce_sql = ('DELETE FROM %(nonces)s WHERE rowid IN '
+                       '(SELECT rowid FROM %(nonces)s '
+                       'WHERE timestamp < ? LIMIT ?);')
 
     def blobEncode(self, s):
         return memoryview(s)
 
-    def useNonce(self, *args, **kwargs):
-        # Older versions of the sqlite wrapper do not raise
-        # IntegrityError as they should, so we have to detect the
-        # message from the OperationalError.
-        try:
-            return super(SQLiteStore, self).useNonce(*args, **kwargs)
-        except self.exceptions.OperationalError as why:
-            if re.match('^columns .* are not unique$', str(why)):
-                return False
-            else:
-                raise
-
 
 class MySQLStore(SQLStore):
     """
@@ -384,6 +486,10 @@ class MySQLStore(SQLStore):
     ENGINE=InnoDB;
     """
 
+    create_nonce_index_sql = """
+    CREATE INDEX %(nonces)s_timestamp ON %(nonces)s (timestamp);
+    """
+
     create_assoc_sql = """
     CREATE TABLE %(associations)s
     (
@@ -393,17 +499,25 @@ class MySQLStore(SQLStore):
         issued INTEGER NOT NULL,
         lifetime INTEGER NOT NULL,
         assoc_type VARCHAR(64) NOT NULL,
+        expires_at INTEGER NOT NULL,
         PRIMARY KEY (server_url(255), handle)
     )
     ENGINE=InnoDB;
     """
 
+    create_assoc_index_sql = """
+    CREATE INDEX %(associations)s_expires_at
+    ON %(associations)s (expires_at);
+    """
+
     set_assoc_sql = ('REPLACE INTO %(associations)s '
-                     'VALUES (%%s, %%s, %%s, %%s, %%s, %%s);')
+                     '(server_url, handle, secret, issued, '
+                     'lifetime, assoc_type, expires_at) '
+                     'VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s);')
     get_assocs_sql = ('SELECT handle, secret, issued, lifetime, assoc_type'
                       ' FROM %(associations)s WHERE server_url = %%s;')
     get_expired_sql = ('SELECT server_url '
-                       'FROM %(associations)s WHERE issued + lifetime < %%s;')
+                       'FROM %(associations)s WHERE expires_at < %%s;')
 
     get_assoc_sql = (
         'SELECT handle, secret, issued, lifetime, assoc_type'
@@ -411,11 +525,27 @@ class MySQLStore(SQLStore):
     remove_assoc_sql = ('DELETE FROM %(associations)s '
                         'WHERE server_url = %%s AND handle = %%s;')
 
-    clean_assoc_sql = 'DELETE FROM %(associations)s WHERE issued + lifetime < %%s;'
+    clean_assoc_sql = ('DELETE FROM %(associations)s '
+                       'WHERE expires_at < %%s LIMIT %%s;')
 
+    # MySQL has no way to skip just duplicate keys whose row count can
+    # be relied on: INSERT IGNORE also ignores other errors, and an ON
+    # DUPLICATE KEY UPDATE that changes nothing counts as a row on
+    # connections with the CLIENT.FOUND_ROWS flag.  So duplicates fail
+    # with IntegrityError, which txn_useNonce catches.
     add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s);'
 
-    clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s;'
+    clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s LIMIT %%s;'
+
+    def txn_useNonces(self, nonces):
+        # A duplicate fails the whole statement, so add the nonces one
+        # at a time when there is one
+        try:
+            return SQLStore.txn_useNonces(self, nonces)
+        except self.exceptions.IntegrityError:
+            return sum(1 for anonce in nonces if self.txn_useNonce(*anonce))
+
+    useNonces = _inTxn(txn_useNonces)
 
 
 class PostgreSQLStore(SQLStore):
@@ -445,6 +575,10 @@ class PostgreSQLStore(SQLStore):
     );
     """
 
+    create_nonce_index_sql = """
+    CREATE INDEX %(nonces)s_timestamp ON %(nonces)s (timestamp);
+    """
+
     create_assoc_sql = """
     CREATE TABLE %(associations)s
     (
@@ -454,13 +588,19 @@ class PostgreSQLStore(SQLStore):
         issued INTEGER NOT NULL,
         lifetime INTEGER NOT NULL,
         assoc_type VARCHAR(64) NOT NULL,
+        expires_at INTEGER NOT NULL,
         PRIMARY KEY (server_url, handle),
         CONSTRAINT secret_length_constraint CHECK (LENGTH(secret) <= 128)
     );
     """
 
+    create_assoc_index_sql = """
+    CREATE INDEX %(associations)s_expires_at
+    ON %(associations)s (expires_at);
+    """
+
     def db_set_assoc(self, server_url, handle, secret, issued, lifetime,
-                     assoc_type):
+                     assoc_type, expires_at):
         """
         Set an association.  This is implemented as a method because
         REPLACE INTO is not supported by PostgreSQL (and is not
@@ -471,23 +611,25 @@ class PostgreSQLStore(SQLStore):
         if len(rows):
             # Update the table since this associations already exists.
             return self.db_update_assoc(secret, issued, lifetime, assoc_type,
-                                        server_url, handle)
+                                        expires_at, server_url, handle)
         else:
             # Insert a new record because this association wasn't
             # found.
             return self.db_new_assoc(server_url, handle, secret, issued,
-                                     lifetime, assoc_type)
+                                     lifetime, assoc_type, expires_at)
 
     new_assoc_sql = ('INSERT INTO %(associations)s '
-                     'VALUES (%%s, %%s, %%s, %%s, %%s, %%s);')
+                     '(server_url, handle, secret, issued, '
+                     'lifetime, assoc_type, expires_at) '
+                     'VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s);')
     update_assoc_sql = ('UPDATE %(associations)s SET '
                         'secret = %%s, issued = %%s, '
-                        'lifetime = %%s, assoc_type = %%s '
+                        'lifetime = %%s, assoc_type = %%s, expires_at = %%s '
                         'WHERE server_url = %%s AND handle = %%s;')
     get_assocs_sql = ('SELECT handle, secret, issued, lifetime, assoc_type'
                       ' FROM %(associations)s WHERE server_url = %%s;')
     get_expired_sql = ('SELECT server_url '
-                       'FROM %(associations)s WHERE issued + lifetime < %%s;')
+                       'FROM %(associations)s WHERE expires_at < %%s;')
 
     get_assoc_sql = (
         'SELECT handle, secret, issued, lifetime, assoc_type'
@@ -495,11 +637,16 @@ class PostgreSQLStore(SQLStore):
     remove_assoc_sql = ('DELETE FROM %(associations)s '
                         'WHERE server_url = %%s AND handle = %%s;')
 
-    clean_assoc_sql = 'DELETE FROM %(associations)s WHERE issued + lifetime < %%s;'
+    clean_assoc_sql = ('DELETE FROM %(associations)s WHERE ctid IN '
+                       '(SELECT ctid FROM %(associations)s '
+                       'WHERE expires_at < %%s LIMIT %%s);')
 
-    add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s);'
+    add_nonce_sql = ('INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s) '
+                     'ON CONFLICT DO NOTHING;')
 
-    clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s;'
+    clean_nonce_sql = ('DELETE FROM %(nonces)s WHERE ctid IN '
+                       '(SELECT ctid FROM %(nonces)s '
+                       'WHERE timestamp < %%s LIMIT %%s);')
 
     def blobEncode(self, blob):
         from psycopg2 import Binary
@@ -508,3 +655,174 @@ class PostgreSQLStore(SQLStore):
 
     def blobDecode(self, blob):
         return blob.tobytes()
+
+
+class ConnectionPool(object):
+    """
+    A minimal thread-safe pool of database connections, for use with
+    C{L{PooledSQLStore}} when no other pool is available.
+
+    Connections are made on demand by calling C{connect}, and up to
+    C{max_idle} of them are kept around for reuse once they are
+    returned.  The interface is a subset of the one offered by the
+    C{psycopg2.pool} classes.
+    """
+
+    def __init__(self, connect, max_idle=None):
+        self.connect = connect
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def getconn(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self.connect()
+
+    def putconn(self, conn, close=False):
+        if not close:
+            with self._lock:
+                if self.max_idle is None or len(self._idle) < self.max_idle:
+                    self._idle.append(conn)
+                    return
+        conn.close()
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class PooledSQLStore(SQLStore):
+    """
+    This is the parent class for SQL stores that check out a
+    connection from a pool for each call, so that a single store can
+    be shared between threads.  Use it by mixing it in ahead of one of
+    the other SQL stores, as C{L{PooledSQLiteStore}},
+    C{L{PooledMySQLStore}} and C{L{PooledPostgreSQLStore}} do.
+
+    The connection and cursor in use are kept per thread, so the rest
+    of the C{L{SQLStore}} code works unchanged.
+    """
+
+    def __init__(self, pool, associations_table=None, nonces_table=None,
+                 rollback_on_checkout=None):
+        """
+        This creates a new pooled SQL store.
+
+
+        @param pool: Either a callable that returns a new database
+            connection, in which case the store keeps its own
+            C{L{ConnectionPool}} of them, or a pool object with
+            C{getconn} and C{putconn} methods, such as one of the
+            C{psycopg2.pool} classes.
+
+        @type pool: callable or pool object
+
+
+        @param associations_table: see C{L{SQLStore.__init__}}
+
+        @param nonces_table: see C{L{SQLStore.__init__}}
+
+
+        @param rollback_on_checkout: Whether to roll back each
+            connection before using it, in case it was left in the
+            middle of a transaction.  By default this is only done for
+            pools that were not made by this store, since connections
+            returned to our own pool are always committed or rolled
+            back first.
+
+        @type rollback_on_checkout: C{bool}
+        """
+        self._local = threading.local()
+        if not hasattr(pool, 'getconn'):
+            pool = ConnectionPool(pool)
+            if rollback_on_checkout is None:
+                rollback_on_checkout = False
+        elif rollback_on_checkout is None:
+            rollback_on_checkout = True
+
+        self.pool = pool
+        self.rollback_on_checkout = rollback_on_checkout
+
+        # Check out a connection so that SQLStore can find the
+        # database exceptions on it.
+        conn = pool.getconn()
+        try:
+            SQLStore.__init__(self, conn, associations_table, nonces_table)
+        finally:
+            self.conn = None
+            pool.putconn(conn)
+
+    def _getConn(self):
+        return getattr(self._local, 'conn', None)
+
+    def _setConn(self, conn):
+        self._local.conn = conn
+
+    conn = property(_getConn, _setConn)
+
+    def _getCur(self):
+        return getattr(self._local, 'cur', None)
+
+    def _setCur(self, cur):
+        self._local.cur = cur
+
+    cur = property(_getCur, _setCur)
+
+    def _callInTransaction(self, func, *args, **kwargs):
+        """Execute the given function inside of a transaction on a
+        connection checked out from the pool, with an open cursor. If
+        no exception is raised, the transaction is comitted, otherwise
+        it is rolled back. The connection is returned to the pool
+        either way."""
+        conn = self.pool.getconn()
+        broken = False
+        self.conn = conn
+        try:
+            if self.rollback_on_checkout:
+                conn.rollback()
+
+            self.cur = conn.cursor()
+            try:
+                ret = func(*args, **kwargs)
+            finally:
+                self.cur.close()
+                self.cur = None
+
+            conn.commit()
+        except:
+            try:
+                conn.rollback()
+            except Exception:
+                # Don't hand a connection we can't clean up to anyone
+                # else
+                broken = True
+            raise
+        finally:
+            self.conn = None
+            self.pool.putconn(conn, close=broken)
+
+        return ret
+
+
+class PooledSQLiteStore(PooledSQLStore, SQLiteStore):
+    """
+    A C{L{PooledSQLStore}} for SQLite. The connections must be made
+    with C{check_same_thread=False} if the store is shared between
+    threads.
+    """
+
+
+class PooledMySQLStore(PooledSQLStore, MySQLStore):
+    """
+    A C{L{PooledSQLStore}} for MySQL.
+    """
+
+
+class PooledPostgreSQLStore(PooledSQLStore, PostgreSQLStore):
+    """
+    A C{L{PooledSQLStore}} for PostgreSQL.
+    """
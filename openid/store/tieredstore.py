@@ -0,0 +1,86 @@
+"""
+This module contains an C{L{OpenIDStore}} that combines a fast local
+store with a durable store shared between processes or hosts.
+
+Example of how to create one::
+
+    store = tieredstore.TieredStore(memstore.MemoryStore(),
+                                    sqlstore.MySQLStore(conn))
+"""
+
+from openid.store.interface import OpenIDStore
+
+
+class TieredStore(OpenIDStore):
+    """
+    This store reads from a local store first and falls back to a
+    shared store, and writes to both.
+
+    Associations found in the shared store are copied into the local
+    one.  When no handle is given, the newest association in the local
+    store is returned if there is one, even if another process has
+    since stored a newer one in the shared store; any valid association
+    will do for signing.  An association that has expired in the local
+    store is looked up in the shared store again.
+
+    Nonces are left to the shared store alone, so that a nonce used
+    through another process is rejected.  Recording accepted nonces in
+    the local store as well would let a replay to the same process be
+    rejected without a round trip to the shared store, but only
+    replays would gain from it, while every accepted nonce would cost
+    a local write and the memory to hold it until it expires.  A nonce
+    must not be recorded locally before the shared store accepts it,
+    or it would be rejected later even if the shared store failed.
+
+    The cleanup methods clean up both stores, and return the number of
+    entries removed from the shared store.
+    """
+
+    def __init__(self, local, shared):
+        """
+        Create a new TieredStore.
+
+        @param local: The fast store, such as a
+            C{L{MemoryStore<openid.store.memstore.MemoryStore>}}.
+
+        @type local: C{L{OpenIDStore}}
+
+        @param shared: The durable store that all of the processes
+            share, such as an C{L{SQLStore<openid.store.sqlstore.SQLStore>}}.
+
+        @type shared: C{L{OpenIDStore}}
+        """
+        self.local = local
+        self.shared = shared
+
+    def storeAssociation(self, server_url, association):
+        self.shared.storeAssociation(server_url, association)
+        self.local.storeAssociation(server_url, association)
+
+    def getAssociation(self, server_url, handle=None):
+        association = self.local.getAssociation(server_url, handle)
+        if association is not None and association.expiresIn <= 0:
+            self.local.removeAssociation(server_url, association.handle)
+            association = None
+
+        if association is None:
+            association = self.shared.getAssociation(server_url, handle)
+            if association is not None:
+                self.local.storeAssociation(server_url, association)
+        return association
+
+    def removeAssociation(self, server_url, handle):
+        removed_local = self.local.removeAssociation(server_url, handle)
+        removed_shared = self.shared.removeAssociation(server_url, handle)
+        return bool(removed_local or removed_shared)
+
+    def useNonce(self, server_url, timestamp, salt):
+        return self.shared.useNonce(server_url, timestamp, salt)
+
+    def cleanupNonces(self):
+        self.local.cleanupNonces()
+        return self.shared.cleanupNonces()
+
+    def cleanupAssociations(self):
+        self.local.cleanupAssociations()
+        return self.shared.cleanupAssociations()
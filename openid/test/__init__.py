@@ -49,7 +49,11 @@ def pyUnitTests():
     """
     test_module_names = [
         'server',
+        'asyncserver',
         'consumer',
+        'asyncconsumer',
+        'discoverycache',
+        'failurecache',
         'message',
         'symbol',
         'etxrd',
@@ -88,6 +92,7 @@ def pyUnitTests():
     # to build the test suite -- the module-level pyUnitTests function should
     # return an appropriate test suite
     custom_module_names = [
+        'asyncstoretest',
         'kvform',
         'linkparse',
         'oidutil',
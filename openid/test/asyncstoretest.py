@@ -0,0 +1,301 @@
+import asyncio
+import sys
+import time
+import unittest
+
+from openid.association import Association
+from openid.store.nonce import mkNonce, split
+from openid.test.storetest import generateHandle, generateSecret
+
+requires_asyncio_run = unittest.skipIf(sys.version_info < (3, 7),
+                                       "asyncio.run needs Python 3.7")
+
+
+async def testAsyncStore(store):
+    """Make sure a given asyncio store has a minimum of API compliance.
+    Call this function with an empty store.
+
+    Raises AssertionError if the store does not work as expected.
+
+    AsyncOpenIDStore -> NoneType
+    """
+    ### Association functions
+    now = int(time.time())
+
+    server_url = "http://www.myopenid.com/openid"
+
+    def genAssoc(issued, lifetime=600):
+        sec = generateSecret(20)
+        hdl = generateHandle(128)
+        return Association(hdl, sec, now + issued, lifetime, "HMAC-SHA1")
+
+    async def checkRetrieve(url, handle=None, expected=None):
+        retrieved_assoc = await store.getAssociation(url, handle)
+        assert retrieved_assoc == expected, (retrieved_assoc, expected)
+        if expected is not None:
+            assert retrieved_assoc.handle == expected.handle
+            assert retrieved_assoc.secret == expected.secret
+
+    async def checkRemove(url, handle, expected):
+        present = await store.removeAssociation(url, handle)
+        assert bool(expected) == bool(present)
+
+    assoc = genAssoc(issued=0)
+
+    # Make sure that a missing association returns no result
+    await checkRetrieve(server_url)
+
+    # Check that after storage, getting returns the same result
+    await store.storeAssociation(server_url, assoc)
+    await checkRetrieve(server_url, None, assoc)
+
+    # Storing more than once has no ill effect
+    await store.storeAssociation(server_url, assoc)
+    await checkRetrieve(server_url, None, assoc)
+
+    # Removing an association that does not exist returns not present
+    await checkRemove(server_url, assoc.handle + "x", False)
+    await checkRemove(server_url + "x", assoc.handle, False)
+
+    # Removing an association that is present returns present, but
+    # not present on subsequent calls
+    await checkRemove(server_url, assoc.handle, True)
+    await checkRemove(server_url, assoc.handle, False)
+
+    # The handle with the later issue date is returned, regardless of
+    # expiration, and the others can still be retrieved by handle
+    await store.storeAssociation(server_url, assoc)
+    assoc2 = genAssoc(issued=1)
+    await store.storeAssociation(server_url, assoc2)
+    assoc3 = genAssoc(issued=2, lifetime=100)
+    await store.storeAssociation(server_url, assoc3)
+
+    await checkRetrieve(server_url, None, assoc3)
+    await checkRetrieve(server_url, assoc.handle, assoc)
+    await checkRetrieve(server_url, assoc2.handle, assoc2)
+    await checkRetrieve(server_url, assoc3.handle, assoc3)
+
+    await checkRemove(server_url, assoc2.handle, True)
+    await checkRemove(server_url, assoc3.handle, True)
+
+    await checkRetrieve(server_url, None, assoc)
+    await checkRetrieve(server_url, assoc2.handle, None)
+    await checkRetrieve(server_url, assoc3.handle, None)
+
+    await checkRemove(server_url, assoc.handle, True)
+    await checkRetrieve(server_url, None, None)
+
+    ### test expired associations
+    assocValid1 = genAssoc(issued=-3600, lifetime=7200)
+    assocValid2 = genAssoc(issued=-5)
+    assocExpired1 = genAssoc(issued=-7200, lifetime=3600)
+    assocExpired2 = genAssoc(issued=-7200, lifetime=3600)
+
+    await store.cleanupAssociations()
+    await store.storeAssociation(server_url + "1", assocValid1)
+    await store.storeAssociation(server_url + "1", assocExpired1)
+    await store.storeAssociation(server_url + "2", assocExpired2)
+    await store.storeAssociation(server_url + "3", assocValid2)
+
+    cleaned = await store.cleanupAssociations()
+    assert cleaned == 2, cleaned
+
+    ### Nonce functions
+
+    async def checkUseNonce(nonce, expected, server_url, msg=""):
+        stamp, salt = split(nonce)
+        actual = await store.useNonce(server_url, stamp, salt)
+        assert bool(actual) == bool(expected), "%r != %r: %s" % (
+            actual, expected, msg)
+
+    for url in [server_url, ""]:
+        nonce1 = mkNonce()
+        await checkUseNonce(nonce1, True, url)
+        await checkUseNonce(nonce1, False, url)
+
+        old_nonce = mkNonce(3600)
+        await checkUseNonce(old_nonce, False, url,
+                            "Old nonce (%r) passed." % (old_nonce, ))
+
+    old_nonce1 = mkNonce(now - 20000)
+    old_nonce2 = mkNonce(now - 10000)
+    recent_nonce = mkNonce(now - 600)
+
+    from openid.store import nonce as nonceModule
+
+    orig_skew = nonceModule.SKEW
+    try:
+        nonceModule.SKEW = 0
+        await store.cleanupNonces()
+        # Set SKEW high so stores will keep our nonces.
+        nonceModule.SKEW = 100000
+        assert await store.useNonce(server_url, *split(old_nonce1))
+        assert await store.useNonce(server_url, *split(old_nonce2))
+        assert await store.useNonce(server_url, *split(recent_nonce))
+
+        nonceModule.SKEW = 3600
+        cleaned = await store.cleanupNonces()
+        assert cleaned == 2, "Cleaned %r nonces." % (cleaned, )
+
+        nonceModule.SKEW = 100000
+        assert await store.useNonce(server_url, *split(old_nonce1))
+        assert await store.useNonce(server_url, *split(old_nonce2))
+        assert not await store.useNonce(server_url, *split(recent_nonce))
+    finally:
+        nonceModule.SKEW = orig_skew
+
+
+@requires_asyncio_run
+def test_async_memstore():
+    from openid.store import asyncmemstore
+
+    asyncio.run(testAsyncStore(asyncmemstore.AsyncMemoryStore()))
+    asyncio.run(
+        testAsyncStore(asyncmemstore.AsyncMemoryStore(indexed=True)))
+
+
+@requires_asyncio_run
+def test_async_sqlite():
+    from openid.store import asyncsqlstore
+    import sqlite3
+
+    async def run(batch_size):
+        conn = asyncsqlstore.AsyncDBAPIConnection(
+            sqlite3.connect(":memory:", check_same_thread=False))
+        store = asyncsqlstore.AsyncSQLiteStore(conn)
+        store.cleanup_batch_size = batch_size
+        await store.createTables()
+        try:
+            await testAsyncStore(store)
+        finally:
+            await conn.close()
+
+    asyncio.run(run(1000))
+    asyncio.run(run(1))
+
+
+@requires_asyncio_run
+def test_async_sqlite_concurrent():
+    from openid.store import asyncsqlstore
+    import sqlite3
+
+    async def run():
+        conn = asyncsqlstore.AsyncDBAPIConnection(
+            sqlite3.connect(":memory:", check_same_thread=False))
+        store = asyncsqlstore.AsyncSQLiteStore(conn)
+        await store.createTables()
+        try:
+            # Only one task may use each nonce
+            stamp, salt = split(mkNonce())
+            results = await asyncio.gather(*[
+                store.useNonce("http://example.com/", stamp, salt)
+                for _ in range(20)
+            ])
+            assert results.count(True) == 1, results
+        finally:
+            await conn.close()
+
+    asyncio.run(run())
+
+
+@requires_asyncio_run
+def test_async_sqlite_loops():
+    from openid.store import asyncsqlstore
+    import sqlite3
+
+    # A store made outside of any event loop can be used from one loop
+    # after another
+    conn = asyncsqlstore.AsyncDBAPIConnection(
+        sqlite3.connect(":memory:", check_same_thread=False))
+    store = asyncsqlstore.AsyncSQLiteStore(conn)
+
+    async def useNonces():
+        results = await asyncio.gather(*[
+            store.useNonce("http://example.com/", *split(mkNonce()))
+            for _ in range(5)
+        ])
+        assert all(results), results
+
+    asyncio.run(store.createTables())
+    asyncio.run(useNonces())
+    asyncio.run(useNonces())
+    asyncio.run(conn.close())
+
+
+@requires_asyncio_run
+def test_async_sqlite_undefined_rowcount():
+    from openid.store import asyncsqlstore
+    import sqlite3
+
+    class UncountedConnection(asyncsqlstore.AsyncDBAPIConnection):
+        """Reports no row counts, like asyncpg does for some statuses."""
+
+        async def execute(self, sql, args=()):
+            result = await asyncsqlstore.AsyncDBAPIConnection.execute(
+                self, sql, args)
+            if not sql.lstrip().upper().startswith("SELECT"):
+                result.rowcount = -1
+            return result
+
+    async def run():
+        conn = UncountedConnection(
+            sqlite3.connect(":memory:", check_same_thread=False))
+        store = asyncsqlstore.AsyncSQLiteStore(conn)
+        await store.createTables()
+        try:
+            # A nonce is only accepted when the insert is known to
+            # have added it
+            stamp, salt = split(mkNonce())
+            assert not await store.useNonce("http://example.com/", stamp,
+                                            salt)
+        finally:
+            await conn.close()
+
+    asyncio.run(run())
+
+
+@requires_asyncio_run
+def test_sync_to_async():
+    from openid.store import asyncinterface, memstore
+
+    store = asyncinterface.SyncToAsyncStore(memstore.MemoryStore())
+    asyncio.run(testAsyncStore(store))
+
+
+def test_async_to_sync():
+    from openid.store import asyncinterface, asyncmemstore
+    from openid.test.storetest import testStore
+
+    store = asyncinterface.AsyncToSyncStore(asyncmemstore.AsyncMemoryStore())
+    try:
+        testStore(store)
+    finally:
+        store.close()
+
+
+test_functions = [
+    test_async_memstore,
+    test_async_sqlite,
+    test_async_sqlite_concurrent,
+    test_async_sqlite_loops,
+    test_async_sqlite_undefined_rowcount,
+    test_sync_to_async,
+    test_async_to_sync,
+]
+
+
+def pyUnitTests():
+    tests = list(map(unittest.FunctionTestCase, test_functions))
+    return unittest.TestSuite(tests)
+
+
+if __name__ == "__main__":
+    import sys
+
+    suite = pyUnitTests()
+    runner = unittest.TextTestRunner()
+    result = runner.run(suite)
+    if result.wasSuccessful():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -1,5 +1,6 @@
 import unittest
 import string
+import sys
 import time
 import os
 import uuid
@@ -246,6 +247,107 @@ def test_filestore():
     shutil.rmtree(temp_dir)
 
 
+def test_filestore_sharded():
+    from openid.store import filestore
+    import tempfile
+    import shutil
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        store = filestore.FileOpenIDStore(temp_dir, sharded=True)
+        testStore(store)
+        store.cleanup()
+
+        # Associations stored by an unsharded store can be migrated
+        now = int(time.time())
+        server_url = "http://www.myopenid.com/openid"
+        old_assoc = Association(
+            generateHandle(128), generateSecret(20), now, 600, "HMAC-SHA1"
+        )
+        new_assoc = Association(
+            generateHandle(128), generateSecret(20), now + 1, 600, "HMAC-SHA1"
+        )
+        unsharded = filestore.FileOpenIDStore(temp_dir)
+        unsharded.storeAssociation(server_url, old_assoc)
+        unsharded.storeAssociation(server_url, new_assoc)
+
+        assert store.migrateAssociations() == 2
+        assert store.migrateAssociations() == 0
+        assert store.getAssociation(server_url) == new_assoc
+        assert store.getAssociation(server_url, old_assoc.handle) == old_assoc
+
+        # A stale index is rebuilt
+        assert store.removeAssociation(server_url, new_assoc.handle)
+        assert store.getAssociation(server_url) == old_assoc
+
+        # Sharded names are plain safe64 hashes, not the repr of bytes
+        for name in os.listdir(store.association_dir):
+            assert "'" not in name
+            for shard_name in os.listdir(
+                    os.path.join(store.association_dir, name)):
+                assert "'" not in shard_name
+
+        # Unmigrated flat files that are not associations are skipped,
+        # then cleaned up along with the rest
+        with open(unsharded.getAssociationFilename(server_url, ''), 'w'):
+            pass
+        expired_assoc = Association(
+            generateHandle(128), generateSecret(20), now - 700, 600,
+            "HMAC-SHA1")
+        unsharded.storeAssociation(server_url, expired_assoc)
+        assert store.migrateAssociations() == 1
+        unsharded.storeAssociation(server_url, expired_assoc)
+        assert store.cleanupAssociations() == 2
+        server_dir = store.getServerDirname(server_url)
+        assert all(os.path.isdir(os.path.join(store.association_dir, name))
+                   for name in os.listdir(store.association_dir))
+
+        # Server directories left empty are removed
+        assert store.removeAssociation(server_url, old_assoc.handle)
+        store.cleanupAssociations()
+        assert not os.path.exists(server_dir)
+        store.storeAssociation(server_url, old_assoc)
+        assert store.getAssociation(server_url) == old_assoc
+
+        # Nonces used through an unsharded store are still honoured
+        stamp, salt = split(mkNonce())
+        assert unsharded.useNonce(server_url, stamp, salt)
+        store = filestore.FileOpenIDStore(temp_dir, sharded=True)
+        assert not store.useNonce(server_url, stamp, salt)
+
+        # Expired nonces are removed a directory at a time
+        from openid.store import nonce as nonceModule
+
+        orig_skew = nonceModule.SKEW
+        try:
+            nonceModule.SKEW = 3600
+            store.cleanupNonces()
+            nonceModule.SKEW = 100000
+            assert store.useNonce(server_url, *split(mkNonce(now - 20000)))
+            assert store.useNonce(server_url, *split(mkNonce(now - 20000)))
+            nonceModule.SKEW = 3600
+            buckets = len(os.listdir(store.nonce_dir))
+            assert store.cleanupNonces() == 2
+            assert len(os.listdir(store.nonce_dir)) <= buckets - 1
+
+            # Empty buckets are removed
+            empty_bucket = store._getNonceBucketDirname(now)
+            shutil.rmtree(empty_bucket, ignore_errors=True)
+            os.mkdir(empty_bucket)
+            store.cleanupNonces()
+            assert not os.path.exists(empty_bucket)
+
+            # An unsharded store cleans up the buckets too
+            nonceModule.SKEW = 100000
+            assert store.useNonce(server_url, *split(mkNonce(now - 20000)))
+            nonceModule.SKEW = 3600
+            assert unsharded.cleanupNonces() == 1
+        finally:
+            nonceModule.SKEW = orig_skew
+    finally:
+        shutil.rmtree(temp_dir)
+
+
 def test_sqlite():
     from openid.store import sqlstore
     import sqlite3
@@ -255,6 +357,127 @@ def test_sqlite():
     store.createTables()
     testStore(store)
 
+    # Expired rows are removed in batches with the same result
+    conn = sqlite3.connect(":memory:")
+    store = sqlstore.SQLiteStore(conn)
+    store.cleanup_batch_size = 1
+    store.createTables()
+    testStore(store)
+
+    # Nonces can be added in one statement
+    server_url = "http://www.myopenid.com/openid"
+    nonces = [(server_url,) + split(mkNonce()) for _ in range(3)]
+    assert store.useNonce(*nonces[0])
+    assert store.useNonces(nonces + [(server_url, 0, "old")]) == 2
+    assert not any(store.useNonce(*anonce) for anonce in nonces)
+
+    # Only duplicate nonces are skipped, not other constraint failures
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        "CREATE TABLE oid_nonces (server_url VARCHAR NOT NULL, "
+        "timestamp INTEGER NOT NULL, salt CHAR(40) NOT NULL, "
+        "UNIQUE(server_url, timestamp, salt));"
+    )
+    store = sqlstore.SQLiteStore(conn)
+    try:
+        store.useNonces([(server_url, int(time.time()), None)])
+    except sqlite3.IntegrityError:
+        pass
+    else:
+        assert False, "a NULL salt was ignored"
+
+
+def test_sqlite_upgrade():
+    from importlib.machinery import SourceFileLoader
+    import importlib.util
+    from openid.store import sqlstore
+    import sqlite3
+
+    script = os.path.join(
+        os.path.dirname(__file__), '..', '..', 'contrib',
+        'upgrade-store-3.2-to-3.3')
+    if not os.path.exists(script):
+        raise unittest.SkipTest('contrib is not installed')
+    loader = SourceFileLoader('upgrade_store', script)
+    upgrade = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(upgrade)
+
+    # The tables as the 3.2 SQLiteStore made them
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        'CREATE TABLE oid_nonces (server_url VARCHAR, timestamp INTEGER, '
+        'salt CHAR(40), UNIQUE(server_url, timestamp, salt));')
+    conn.execute(
+        'CREATE TABLE oid_associations (server_url VARCHAR(2047), '
+        'handle VARCHAR(255), secret BLOB(128), issued INTEGER, '
+        'lifetime INTEGER, assoc_type VARCHAR(64), '
+        'PRIMARY KEY (server_url, handle));')
+    now = int(time.time())
+    server_url = "http://www.myopenid.com/openid"
+    valid = Association(
+        generateHandle(128), generateSecret(20), now - 10, 600, "HMAC-SHA1")
+    expired = Association(
+        generateHandle(128), generateSecret(20), now - 700, 600, "HMAC-SHA1")
+    for assoc in [valid, expired]:
+        conn.execute(
+            'INSERT INTO oid_associations VALUES (?, ?, ?, ?, ?, ?);',
+            (server_url, assoc.handle, sqlite3.Binary(assoc.secret),
+             assoc.issued, assoc.lifetime, assoc.assoc_type))
+    conn.commit()
+
+    upgrade.doSQLiteUpgrade(conn, 'oid_associations', 'oid_nonces')
+
+    store = sqlstore.SQLiteStore(conn)
+    assert store.cleanupAssociations() == 1
+    assert store.getAssociation(server_url) == valid
+    assert store.getAssociation(server_url, expired.handle) is None
+
+
+def test_sqlite_pooled():
+    from openid.store import sqlstore
+    import sqlite3
+    import tempfile
+    import shutil
+    import threading
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        db_name = os.path.join(temp_dir, "store.db")
+
+        def connect():
+            return sqlite3.connect(db_name, timeout=30, check_same_thread=False)
+
+        store = sqlstore.PooledSQLiteStore(connect)
+        store.createTables()
+        testStore(store)
+
+        # Many threads can share the store, and a nonce is only ever
+        # accepted once.
+        stamp, salt = split(mkNonce())
+        accepted = []
+        errors = []
+
+        def worker():
+            try:
+                if store.useNonce("http://example.com/", stamp, salt):
+                    accepted.append(True)
+                assert store.getAssociation("http://example.com/") is None
+            except Exception as why:
+                errors.append(why)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors, errors
+        assert len(accepted) == 1, accepted
+        store.pool.closeall()
+    finally:
+        shutil.rmtree(temp_dir)
+
 
 def test_mysql():
     from openid.store import sqlstore
@@ -297,6 +520,13 @@ def test_mysql():
 
             # At last, we get to run the test.
             testStore(store)
+
+            # A batch with a nonce that was used already adds the rest
+            server_url = "http://www.myopenid.com/openid"
+            nonces = [(server_url,) + split(mkNonce()) for _ in range(3)]
+            assert store.useNonce(*nonces[0])
+            assert store.useNonces(nonces) == 2
+            assert not any(store.useNonce(*anonce) for anonce in nonces)
         finally:
             # Remove the database. If you want to do post-mortem on a
             # failing test, comment out this line.
@@ -390,18 +620,854 @@ def test_postgresql():
         conn_remove.close()
 
 
+class FakeRedis(object):
+    """An in-process stand-in for a C{redis.Redis} client, covering
+    the commands that L{openid.store.redisstore.RedisStore} uses.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _key(self, key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return key
+
+    def _get(self, key):
+        key = self._key(key)
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    def _value(self, value):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode('utf-8')
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and self._get(key) is not None:
+            return None
+        key = self._key(key)
+        self.data[key] = self._value(value)
+        self.expires.pop(key, None)
+        if ex is not None:
+            self.expires[key] = time.time() + ex
+        return True
+
+    def mget(self, keys):
+        return [self._get(key) for key in keys]
+
+    def scan_iter(self, match, count=None):
+        import fnmatch
+
+        for key in list(self.data):
+            if (self._get(key) is not None and
+                    fnmatch.fnmatchcase(key.decode('utf-8'), match)):
+                yield key
+
+    def ttl(self, key):
+        if self._get(key) is None:
+            return -2
+        expires = self.expires.get(self._key(key))
+        if expires is None:
+            return -1
+        return int(expires - time.time())
+
+    def delete(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._get(key) is not None:
+                del self.data[self._key(key)]
+                self.expires.pop(self._key(key), None)
+                removed += 1
+        return removed
+
+    def expireat(self, key, when):
+        if self._get(key) is None:
+            return False
+        self.expires[self._key(key)] = when
+        return True
+
+    def hset(self, key, mapping):
+        value = self._get(key)
+        if value is None:
+            value = self.data[self._key(key)] = {}
+        for field, field_value in mapping.items():
+            value[self._key(field)] = self._value(field_value)
+        return len(mapping)
+
+    def hgetall(self, key):
+        return dict(self._get(key) or {})
+
+    def zadd(self, key, mapping):
+        value = self._get(key)
+        if value is None:
+            value = self.data[self._key(key)] = {}
+        for member, score in mapping.items():
+            value[self._key(member)] = float(score)
+        return len(mapping)
+
+    def zrem(self, key, *members):
+        value = self._get(key) or {}
+        removed = 0
+        for member in members:
+            if value.pop(self._key(member), None) is not None:
+                removed += 1
+        if not value:
+            self.data.pop(self._key(key), None)
+        return removed
+
+    def zremrangebyrank(self, key, start, end):
+        members = self._sorted(key)
+        if end < 0:
+            end += len(members)
+        return self.zrem(key, *members[start:end + 1])
+
+    def zremrangebyscore(self, key, low, high):
+        return self.zrem(key, *self.zrangebyscore(key, low, high))
+
+    def _sorted(self, key):
+        value = self._get(key) or {}
+        return sorted(value, key=lambda member: (value[member], member))
+
+    def zrevrange(self, key, start, end):
+        members = list(reversed(self._sorted(key)))
+        if end == -1:
+            return members[start:]
+        return members[start:end + 1]
+
+    def zrangebyscore(self, key, low, high):
+        def inRange(score, bound, above):
+            bound = str(bound)
+            exclusive = bound.startswith('(')
+            bound = float(bound.lstrip('('))
+            if above:
+                return score > bound if exclusive else score >= bound
+            else:
+                return score < bound if exclusive else score <= bound
+
+        value = self._get(key) or {}
+        return [
+            member for member in self._sorted(key)
+            if inRange(value[member], low, True) and
+            inRange(value[member], high, False)
+        ]
+
+
+class FakeRedisPipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((getattr(self.client, name), args, kwargs))
+
+        return queue
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+def test_redisstore():
+    from openid.store import redisstore
+    from openid.store import nonce as nonceModule
+
+    testStore(redisstore.RedisStore(FakeRedis()))
+
+    # The newest association is found even if newer ones have expired
+    client = FakeRedis()
+    store = redisstore.RedisStore(client, prefix='test:')
+    server_url = 'http://www.myopenid.com/openid'
+    now = int(time.time())
+    valid = Association(generateHandle(128), generateSecret(20), now, 600,
+                        'HMAC-SHA1')
+    expired = Association(generateHandle(128), generateSecret(20), now + 10,
+                          -20, 'HMAC-SHA1')
+    store.storeAssociation(server_url, valid)
+    store.storeAssociation(server_url, expired)
+    assert store.getAssociation(server_url) == valid
+    assert all(key.startswith(b'test:') for key in client.data)
+
+    # Nonces can be added in one round trip
+    nonces = [(server_url, ) + split(mkNonce()) for _ in range(3)]
+    assert store.useNonce(*nonces[0])
+    assert store.useNonces(nonces + [(server_url, 0, 'old')]) == 2
+    assert not any(store.useNonce(*anonce) for anonce in nonces)
+
+    # Every key the store uses expires by itself
+    now = int(time.time())
+    store.useNonce(server_url, *split(mkNonce()))
+    assert all(client.ttl(key) >= 0 for key in client.data)
+
+    # The indexes outlive their longest lived association
+    older = Association(generateHandle(128), generateSecret(20), now - 1,
+                        7200, 'HMAC-SHA1')
+    store.storeAssociation(server_url, older)
+    store.storeAssociation(server_url, valid)
+    server_key = store._serverKey(redisstore._hashKey(server_url))
+    for key in [server_key, store.assoc_expiry_key]:
+        assert client.ttl(key) >= 7200 + store.index_grace - 5
+
+    # and are trimmed when associations are stored
+    store.max_server_index = 2
+    for issued in range(3):
+        store.storeAssociation(
+            server_url,
+            Association(generateHandle(128), generateSecret(20),
+                        now - store.index_grace - 1000 + issued, 600,
+                        'HMAC-SHA1'))
+    assert len(client.zrangebyscore(server_key, '-inf', '+inf')) == 2
+    assert store.getAssociation(server_url) == valid
+    assert not client.zrangebyscore(store.assoc_expiry_key, '-inf',
+                                    now - store.index_grace)
+
+    # Nonces are cleaned up a batch of keys at a time
+    class BatchRecordingRedis(FakeRedis):
+        def __init__(self):
+            FakeRedis.__init__(self)
+            self.batches = []
+
+        def mget(self, keys):
+            self.batches.append(len(keys))
+            return FakeRedis.mget(self, keys)
+
+    client = BatchRecordingRedis()
+    store = redisstore.RedisStore(client)
+    store.scan_batch_size = 2
+    orig_skew = nonceModule.SKEW
+    try:
+        for _ in range(5):
+            assert store.useNonce(server_url, *split(mkNonce(now - 600)))
+        assert store.useNonce(server_url, *split(mkNonce()))
+        nonceModule.SKEW = 300
+        assert store.cleanupNonces() == 5
+    finally:
+        nonceModule.SKEW = orig_skew
+    assert client.batches == [2, 2, 2], client.batches
+    assert len(client.data) == 1
+
+
+def test_cachestore():
+    from openid.store import cachestore, memstore
+
+    testStore(cachestore.CachingStore(memstore.MemoryStore()))
+
+    class CountingStore(memstore.MemoryStore):
+        gets = 0
+
+        def getAssociation(self, server_url, handle=None):
+            self.gets += 1
+            return memstore.MemoryStore.getAssociation(self, server_url, handle)
+
+    backing = CountingStore()
+    store = cachestore.CachingStore(backing, max_entries=2)
+    server_url = "http://www.myopenid.com/openid"
+    now = int(time.time())
+    assoc = Association(generateHandle(128), generateSecret(20), now, 600, "HMAC-SHA1")
+    backing.storeAssociation(server_url, assoc)
+
+    # Repeated lookups are answered from the cache
+    for _ in range(3):
+        assert store.getAssociation(server_url, assoc.handle) == assoc
+        assert store.getAssociation(server_url) == assoc
+    assert backing.gets == 2, backing.gets
+
+    # The least recently used entry is evicted
+    store.getAssociation(server_url + "x")
+    store.getAssociation(server_url + "y")
+    assert len(store._cache) == 2
+
+    # Removing an association invalidates it
+    assert store.removeAssociation(server_url, assoc.handle)
+    assert store.getAssociation(server_url, assoc.handle) is None
+    assert store.getAssociation(server_url) is None
+
+
+def test_noncebatch():
+    from openid.store import memstore, noncebatch
+
+    testStore(
+        noncebatch.BatchingNonceStore(
+            memstore.MemoryStore(), trusted_since=time.time()
+        )
+    )
+
+    backing = memstore.MemoryStore()
+    store = noncebatch.BatchingNonceStore(
+        backing, batch_size=1000, max_delay=3600, trusted_since=0
+    )
+    testStore(store)
+    store.flush()
+
+    # New nonces are queued instead of written, but still only
+    # accepted once
+    server_url = "http://www.myopenid.com/openid"
+    nonces = [split(mkNonce()) for _ in range(10)]
+    for stamp, salt in nonces:
+        assert store.useNonce(server_url, stamp, salt)
+        assert not store.useNonce(server_url, stamp, salt)
+    assert len(store.pending) == 10
+
+    assert store.flush() == 10
+    assert not store.pending
+    for stamp, salt in nonces:
+        assert not backing.useNonce(server_url, stamp, salt)
+        assert not store.useNonce(server_url, stamp, salt)
+
+    # Nonces older than the store's history are checked in the backing
+    # store
+    backing.useNonce(server_url, *nonces[0])
+    store = noncebatch.BatchingNonceStore(backing, trusted_since=time.time())
+    assert not store.useNonce(server_url, *nonces[0])
+
+    # Full batches are written by the call that fills them, in one call
+    # to the backing store, and close writes out what is left
+    class RecordingStore(memstore.MemoryStore):
+        def __init__(self):
+            memstore.MemoryStore.__init__(self)
+            self.batches = []
+
+        def useNonces(self, nonces):
+            self.batches.append(list(nonces))
+            return sum(1 for anonce in nonces if self.useNonce(*anonce))
+
+    backing = RecordingStore()
+    store = noncebatch.BatchingNonceStore(
+        backing, batch_size=5, max_delay=3600, trusted_since=0
+    )
+    nonces = [split(mkNonce()) for _ in range(7)]
+    for stamp, salt in nonces[:4]:
+        assert store.useNonce(server_url, stamp, salt)
+    assert not backing.batches
+    assert store.useNonce(server_url, *nonces[4])
+    assert [len(batch) for batch in backing.batches] == [5]
+    for stamp, salt in nonces[5:]:
+        assert store.useNonce(server_url, stamp, salt)
+    store.close()
+    assert [len(batch) for batch in backing.batches] == [5, 2]
+    assert not store.pending
+    for stamp, salt in nonces:
+        assert not store.useNonce(server_url, stamp, salt)
+
+    # A batch is also written once its oldest nonce has waited
+    # max_delay seconds
+    store = noncebatch.BatchingNonceStore(
+        backing, max_delay=0.01, trusted_since=0
+    )
+    assert store.useNonce(server_url, *split(mkNonce()))
+    time.sleep(0.02)
+    assert store.useNonce(server_url, *split(mkNonce()))
+    assert [len(batch) for batch in backing.batches] == [5, 2, 2]
+    store.close()
+
+    # A batch that can not be written stays queued
+    class FailingStore(RecordingStore):
+        def useNonces(self, nonces):
+            raise RuntimeError("down")
+
+    store = noncebatch.BatchingNonceStore(
+        FailingStore(), batch_size=1, trusted_since=0
+    )
+    assert store.useNonce(server_url, *split(mkNonce()))
+    assert len(store.pending) == 1
+    store.store = backing
+    assert store.flush() == 1
+    assert [len(batch) for batch in backing.batches] == [5, 2, 2, 1]
+
+    # The backing store is only used from the calling thread, so a
+    # plain SQLite store works
+    import sqlite3
+    from openid.store import sqlstore
+
+    conn = sqlite3.connect(":memory:")
+    sqlite = sqlstore.SQLiteStore(conn)
+    sqlite.createTables()
+    store = noncebatch.BatchingNonceStore(sqlite, batch_size=2, trusted_since=0)
+    nonces = [split(mkNonce()) for _ in range(3)]
+    for stamp, salt in nonces:
+        assert store.useNonce(server_url, stamp, salt)
+    count_sql = "SELECT COUNT(*) FROM oid_nonces"
+    assert conn.execute(count_sql).fetchone()[0] == 2
+    store.close()
+    assert conn.execute(count_sql).fetchone()[0] == 3
+    for stamp, salt in nonces:
+        assert not sqlite.useNonce(server_url, stamp, salt)
+
+    bloom = noncebatch.BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(str(i))
+    assert all(str(i) in bloom for i in range(1000))
+    false_positives = sum(1 for i in range(1000, 11000) if str(i) in bloom)
+    assert false_positives < 300, false_positives
+
+
+def test_tieredstore():
+    from openid.store import memstore, tieredstore
+
+    testStore(tieredstore.TieredStore(memstore.MemoryStore(), memstore.MemoryStore()))
+
+    # Two processes sharing a store see each other's associations and
+    # nonces
+    shared = memstore.MemoryStore()
+    store1 = tieredstore.TieredStore(memstore.MemoryStore(), shared)
+    store2 = tieredstore.TieredStore(memstore.MemoryStore(), shared)
+    server_url = "http://www.myopenid.com/openid"
+    now = int(time.time())
+    assoc = Association(generateHandle(128), generateSecret(20), now, 600, "HMAC-SHA1")
+
+    store1.storeAssociation(server_url, assoc)
+    assert store2.getAssociation(server_url) == assoc
+    assert store2.local.getAssociation(server_url) == assoc
+
+    stamp, salt = split(mkNonce())
+    assert store1.useNonce(server_url, stamp, salt)
+    assert not store2.useNonce(server_url, stamp, salt)
+    assert not store1.useNonce(server_url, stamp, salt)
+
+    # A nonce is not marked as used if the shared store fails
+    class FailingStore(memstore.MemoryStore):
+        def useNonce(self, server_url, timestamp, salt):
+            raise RuntimeError("down")
+
+    stamp, salt = split(mkNonce())
+    store1.shared = FailingStore()
+    try:
+        store1.useNonce(server_url, stamp, salt)
+    except RuntimeError:
+        pass
+    else:
+        assert False, "the shared store's error was not raised"
+    store1.shared = shared
+    assert store1.useNonce(server_url, stamp, salt)
+
+    # Associations that expired in the local store are looked up again
+    expired = Association(
+        generateHandle(128), generateSecret(20), now - 700, 600, "HMAC-SHA1"
+    )
+
+    class StaleStore(memstore.MemoryStore):
+        def getAssociation(self, server_url, handle=None):
+            return expired
+
+    store = tieredstore.TieredStore(StaleStore(), shared)
+    assert store.getAssociation(server_url) == assoc
+
+
+def test_cleanup_scheduler():
+    import asyncio
+    from openid.store import memstore
+    from openid.store.scheduler import CleanupScheduler
+
+    store = memstore.MemoryStore()
+    server_url = "http://www.myopenid.com/openid"
+    now = int(time.time())
+    for _ in range(3):
+        store.storeAssociation(
+            server_url,
+            Association(
+                generateHandle(128), generateSecret(20), now - 700, 600, "HMAC-SHA1"
+            ),
+        )
+
+    scheduler = CleanupScheduler(store, interval=10, jitter=0.5)
+    assert all(5 <= scheduler.nextDelay() <= 15 for _ in range(100))
+    assert scheduler.runOnce() == {"nonces": 0, "associations": 3}
+    stats = scheduler.getStats()
+    assert stats["runs"] == 1
+    assert stats["removed_associations"] == 3
+    assert stats["last_remaining"] == {"nonces": 0, "associations": 0}
+
+    # Stores that cannot count report None
+    class UncountedStore(object):
+        def cleanupNonces(self):
+            return 0
+
+        def cleanupAssociations(self):
+            return 0
+
+    scheduler = CleanupScheduler(UncountedStore())
+    scheduler.runOnce()
+    assert scheduler.last_remaining == {"nonces": None, "associations": None}
+
+    # Batched cleanups stop at the end of the budget
+    from openid.store import sqlstore
+    import sqlite3
+
+    class SlowSQLiteStore(sqlstore.SQLiteStore):
+        cleanup_batch_size = 1
+
+        def _cleanupAssociationsBatch(self, batch_size):
+            time.sleep(0.01)
+            return sqlstore.SQLiteStore._cleanupAssociationsBatch(self, batch_size)
+
+    sql_store = SlowSQLiteStore(sqlite3.connect(":memory:"))
+    sql_store.createTables()
+    for _ in range(20):
+        sql_store.storeAssociation(
+            server_url,
+            Association(
+                generateHandle(128), generateSecret(20), now - 700, 600, "HMAC-SHA1"
+            ),
+        )
+    scheduler = CleanupScheduler(sql_store, time_budget=0.05)
+    removed = scheduler.runOnce()
+    assert 0 < removed["associations"] < 20, removed
+    assert scheduler.deferred[0] == "associations"
+    assert scheduler.last_remaining["associations"] == 20 - removed["associations"]
+    while scheduler.deferred:
+        scheduler.runOnce()
+    assert scheduler.removed_associations == 20
+    assert scheduler.last_remaining == {"nonces": 0, "associations": 0}
+
+    # A run that goes over its budget leaves the rest for next time
+    class SlowStore(memstore.MemoryStore):
+        def cleanupAssociations(self):
+            time.sleep(0.02)
+            return memstore.MemoryStore.cleanupAssociations(self)
+
+    scheduler = CleanupScheduler(SlowStore(), time_budget=0.01)
+    assert scheduler.runOnce() == {"associations": 0}
+    assert scheduler.deferred == ["nonces"]
+    assert scheduler.runOnce() == {"nonces": 0, "associations": 0}
+    assert scheduler.deferred == []
+
+    # Errors are counted and do not stop the scheduler
+    class BrokenStore(memstore.MemoryStore):
+        def cleanupNonces(self):
+            raise IOError("broken")
+
+    scheduler = CleanupScheduler(BrokenStore(), interval=0.001, jitter=0)
+    scheduler.start()
+    try:
+        deadline = time.time() + 5
+        while scheduler.runs < 2 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        scheduler.stop()
+    assert scheduler.runs >= 2
+    assert scheduler.errors == scheduler.runs
+
+    async def runTask():
+        scheduler = CleanupScheduler(store, interval=0.001, jitter=0)
+        task = scheduler.startTask()
+        while scheduler.runs < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        return scheduler.runs
+
+    if sys.version_info >= (3, 7):
+        assert asyncio.run(asyncio.wait_for(runTask(), 5)) >= 2
+
+    # A store that shares one connection between threads can not be
+    # cleaned up in the background, but a pooled one can
+    import sqlite3
+    import tempfile
+    import shutil
+    from openid.store import sqlstore
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        db_name = os.path.join(temp_dir, "openid.db")
+        store = sqlstore.SQLiteStore(sqlite3.connect(db_name))
+        store.createTables()
+        scheduler = CleanupScheduler(store, interval=0.001, jitter=0)
+        for start in [scheduler.start, scheduler.startTask]:
+            try:
+                start()
+            except ValueError:
+                pass
+            else:
+                assert False, "a plain SQLiteStore was accepted"
+        assert scheduler.runOnce() == {"nonces": 0, "associations": 0}
+        store.conn.close()
+
+        store = sqlstore.PooledSQLiteStore(
+            lambda: sqlite3.connect(db_name, check_same_thread=False)
+        )
+        store.storeAssociation(
+            server_url,
+            Association(
+                generateHandle(128), generateSecret(20), now - 700, 600, "HMAC-SHA1"
+            ),
+        )
+        scheduler = CleanupScheduler(store, interval=0.001, jitter=0)
+        scheduler.start()
+        try:
+            deadline = time.time() + 5
+            while scheduler.runs < 1 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            scheduler.stop()
+        assert scheduler.errors == 0
+        assert scheduler.removed_associations == 1
+        store.pool.closeall()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
 def test_memstore():
     from openid.store import memstore
 
     testStore(memstore.MemoryStore())
 
 
+def test_memstore_indexed():
+    from openid.store import memstore
+
+    testStore(memstore.MemoryStore(indexed=True))
+
+    # The issued-date index must survive many replaced and removed
+    # associations for the same server.
+    store = memstore.MemoryStore(indexed=True)
+    server_url = "http://www.myopenid.com/openid"
+    now = int(time.time())
+    assocs = [
+        Association(generateHandle(16), generateSecret(20), now + i, 600, "HMAC-SHA1")
+        for i in range(100)
+    ]
+    for assoc in assocs:
+        store.storeAssociation(server_url, assoc)
+
+    for assoc in reversed(assocs[1:]):
+        assert store.getAssociation(server_url) == assoc
+        assert store.removeAssociation(server_url, assoc.handle)
+
+    assert store.getAssociation(server_url) == assocs[0]
+    assert store.cleanupAssociations() == 0
+
+
+def test_memstore_nonce_buckets():
+    from openid.store import memstore
+    from openid.store import nonce as nonceModule
+
+    for bucket_size in [1, 60, 3600]:
+        testStore(memstore.MemoryStore(nonce_bucket_size=bucket_size))
+
+    # Expired nonces are swept from useNonce when asked to
+    store = memstore.MemoryStore(nonce_sweep_interval=3)
+    server_url = "http://www.myopenid.com/openid"
+    now = int(time.time())
+    orig_skew = nonceModule.SKEW
+    try:
+        nonceModule.SKEW = 100000
+        assert store.useNonce(server_url, *split(mkNonce(now - 20000)))
+        assert store.useNonce(server_url, *split(mkNonce(now - 600)))
+
+        nonceModule.SKEW = 3600
+        assert store.useNonce(server_url, *split(mkNonce()))
+        remaining = sum(len(anonces) for anonces in store.nonces.values())
+        assert remaining == 2, remaining
+    finally:
+        nonceModule.SKEW = orig_skew
+
+
+def test_memstore_sharded():
+    from openid.store import memstore
+
+    testStore(memstore.ShardedMemoryStore())
+    testStore(memstore.ShardedMemoryStore(shards=1, indexed=True))
+
+
+def test_memstore_sharded_threads():
+    """Hammer a single store from many threads and make sure every
+    nonce is accepted exactly once and no association goes missing.
+    """
+    import threading
+    from openid.store import memstore
+
+    store = memstore.ShardedMemoryStore(shards=4)
+    server_urls = ["http://example.com/%d" % (i,) for i in range(8)] + [""]
+    nonces = [mkNonce() for _ in range(200)]
+    num_threads = 16
+    accepted = []
+    errors = []
+    barrier = threading.Barrier(num_threads)
+
+    def worker(index):
+        try:
+            barrier.wait()
+            now = int(time.time())
+            server_url = server_urls[index % len(server_urls)] or "http://x/"
+            for i in range(50):
+                assoc = Association(
+                    generateHandle(16), generateSecret(20), now + i, 600, "HMAC-SHA1"
+                )
+                store.storeAssociation(server_url, assoc)
+                assert store.getAssociation(server_url, assoc.handle) == assoc
+
+            for url in server_urls:
+                for n in nonces:
+                    if store.useNonce(url, *split(n)):
+                        accepted.append((url, n))
+        except Exception as why:
+            errors.append(why)
+
+    threads = [
+        threading.Thread(target=worker, args=(i,)) for i in range(num_threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors, errors
+    assert len(accepted) == len(server_urls) * len(nonces), len(accepted)
+    assert len(set(accepted)) == len(accepted)
+
+
+def test_shmstore():
+    import tempfile
+    import shutil
+    import threading
+
+    try:
+        from openid.store import shmstore
+    except ImportError:
+        raise unittest.SkipTest(
+            "Skipping shared memory store tests. " "Could not import fcntl."
+        )
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_dir, "store")
+        store = shmstore.SharedMemoryStore(filename, assoc_slots=64, nonce_slots=64)
+        testStore(store)
+
+        # A second store on the same file sees the same data
+        now = int(time.time())
+        assoc = Association(
+            generateHandle(128), generateSecret(20), now, 600, "HMAC-SHA1"
+        )
+        store.storeAssociation("http://example.com/", assoc)
+        other = shmstore.SharedMemoryStore(filename)
+        assert other.nonce_slots == 64
+        assert other.getAssociation("http://example.com/") == assoc
+        assert other.useNonce("http://example.com/", now, "salt")
+        assert not store.useNonce("http://example.com/", now, "salt")
+
+        other.close()
+        store.close()
+
+        # Stores on the same file in one process exclude each other
+        store = shmstore.SharedMemoryStore(
+            os.path.join(temp_dir, "race"), assoc_slots=1, nonce_slots=1024
+        )
+        other = shmstore.SharedMemoryStore(store.filename)
+
+        def useNonces(store, accepted):
+            for i in range(200):
+                if store.useNonce("http://example.com/", now, "race%d" % (i,)):
+                    accepted.append(i)
+
+        accepted = []
+        threads = [
+            threading.Thread(target=useNonces, args=(s, accepted))
+            for s in [store, other, store, other]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(accepted) == list(range(200)), len(accepted)
+
+        other.close()
+        store.close()
+
+        # Many associations for one server
+        store = shmstore.SharedMemoryStore(
+            os.path.join(temp_dir, "server"), assoc_slots=64, nonce_slots=8
+        )
+        server_url = "http://localhost/|normal"
+        assert store.getAssociation(server_url) is None
+        assocs = [
+            Association(generateHandle(16), generateSecret(20), now - i, 600, "HMAC-SHA1")
+            for i in range(48)
+        ]
+        for assoc in assocs:
+            store.storeAssociation(server_url, assoc)
+        for assoc in assocs:
+            assert store.getAssociation(server_url, assoc.handle) == assoc
+        assert store.getAssociation(server_url) == assocs[0]
+
+        # Removing the newest falls back to the next newest
+        assert store.removeAssociation(server_url, assocs[0].handle)
+        assert store.getAssociation(server_url) == assocs[1]
+        expired = Association(
+            generateHandle(16), generateSecret(20), now, -1, "HMAC-SHA1"
+        )
+        store.storeAssociation(server_url, expired)
+        assert store.getAssociation(server_url) == assocs[1]
+
+        assert store.cleanupAssociations() == 1
+        assert store.getAssociation(server_url) == assocs[1]
+        for assoc in assocs[1:]:
+            store.removeAssociation(server_url, assoc.handle)
+        assert store.getAssociation(server_url) is None
+        store.close()
+
+        # A full nonce table rejects new nonces instead of forgetting
+        # current ones
+        store = shmstore.SharedMemoryStore(
+            os.path.join(temp_dir, "small"), assoc_slots=1, nonce_slots=8
+        )
+        for i in range(8):
+            assert store.useNonce("", now, "salt%d" % (i,))
+        assert not store.useNonce("", now, "one too many")
+        assert not store.useNonce("", now, "salt0")
+        store.close()
+
+        # Expired associations are only written over once the table is
+        # full, so that cleanup still finds them
+        store = shmstore.SharedMemoryStore(
+            os.path.join(temp_dir, "expired"), assoc_slots=2, nonce_slots=8
+        )
+        expired = [
+            Association(generateHandle(16), generateSecret(20), now, -1, "HMAC-SHA1")
+            for i in range(2)
+        ]
+        for assoc in expired:
+            store.storeAssociation(server_url, assoc)
+        fresh = Association(
+            generateHandle(16), generateSecret(20), now, 600, "HMAC-SHA1"
+        )
+        store.storeAssociation(server_url, fresh)
+        assert store.getAssociation(server_url) == fresh
+        assert store.cleanupAssociations() == 1
+        for assoc in expired:
+            store.storeAssociation(server_url, assoc)
+        assert store.cleanupAssociations() == 1
+        store.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
 test_functions = [
     test_filestore,
+    test_filestore_sharded,
     test_sqlite,
+    test_sqlite_upgrade,
+    test_sqlite_pooled,
     test_mysql,
     test_postgresql,
     test_memstore,
+    test_memstore_indexed,
+    test_memstore_nonce_buckets,
+    test_memstore_sharded,
+    test_memstore_sharded_threads,
+    test_shmstore,
+    test_redisstore,
+    test_cachestore,
+    test_noncebatch,
+    test_tieredstore,
+    test_cleanup_scheduler,
 ]
 
 
@@ -0,0 +1,169 @@
+import asyncio
+import sys
+import unittest
+import urllib.parse
+
+from openid import fetchers
+from openid.association import Association
+from openid.consumer.asyncconsumer import AsyncConsumer, AsyncGenericConsumer
+from openid.consumer.consumer import SUCCESS, FAILURE, CANCEL
+from openid.consumer.discover import OpenIDServiceEndpoint, OPENID_1_1_TYPE
+from openid.fetchers import HTTPResponse
+from openid.message import Message
+from openid.store import asyncmemstore, memstore
+from openid.store.asyncinterface import SyncToAsyncStore
+
+from .support import CatchLogs
+from .test_consumer import TestFetcher, assocs, parseQuery, \
+     setConsumerSession, http_server_url, consumer_url
+
+server_url = str(http_server_url, encoding="utf-8")
+return_to = str(consumer_url, encoding="utf-8")
+user_url = 'http://www.example.com/user.html'
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "asyncio.run needs Python 3.7")
+class AsyncConsumerTestCase(unittest.TestCase, CatchLogs):
+    def setUp(self):
+        CatchLogs.setUp(self)
+        self.fetcher = TestFetcher(None, None, assocs[0])
+        fetchers.setDefaultAsyncFetcher(
+            fetchers.ExecutorFetcher(self.fetcher), wrap_exceptions=False)
+        self.store = asyncmemstore.AsyncMemoryStore()
+
+    def tearDown(self):
+        CatchLogs.tearDown(self)
+        fetchers.setDefaultAsyncFetcher(None)
+
+    def makeEndpoint(self):
+        endpoint = OpenIDServiceEndpoint()
+        endpoint.claimed_id = user_url
+        endpoint.server_url = server_url
+        endpoint.local_id = user_url
+        endpoint.type_uris = [OPENID_1_1_TYPE]
+        return endpoint
+
+    def makeResponse(self, request):
+        """Make the query of a positive assertion for the request,
+        signed with the association the request was made with."""
+        redirect_url = request.redirectURL(return_to, return_to)
+        q = parseQuery(urllib.parse.urlparse(redirect_url)[4])
+        new_return_to = q['openid.return_to']
+        query = parseQuery(urllib.parse.urlparse(new_return_to)[4])
+        query.update({
+            'openid.mode': 'id_res',
+            'openid.return_to': new_return_to,
+            'openid.identity': user_url,
+            'openid.assoc_handle': self.fetcher.assoc_handle,
+        })
+        message = request.assoc.signMessage(Message.fromPostArgs(query))
+        return message.toPostArgs(), new_return_to
+
+
+class TestAsyncGenericConsumer(AsyncConsumerTestCase):
+    def test_success(self):
+        consumer = AsyncGenericConsumer(self.store)
+        setConsumerSession(consumer)
+        endpoint = self.makeEndpoint()
+
+        async def run():
+            request = await consumer.begin(endpoint)
+            query, new_return_to = self.makeResponse(request)
+            return await consumer.complete(
+                Message.fromPostArgs(query), request.endpoint, new_return_to)
+
+        self.assertEqual(self.fetcher.num_assocs, 0)
+        response = asyncio.run(run())
+        self.assertEqual(response.status, SUCCESS, response)
+        self.assertEqual(response.identity_url, user_url)
+        self.assertEqual(self.fetcher.num_assocs, 1)
+
+        # The association is reused
+        response = asyncio.run(run())
+        self.assertEqual(response.status, SUCCESS, response)
+        self.assertEqual(self.fetcher.num_assocs, 1)
+
+    def test_replayedNonce(self):
+        consumer = AsyncGenericConsumer(self.store)
+        setConsumerSession(consumer)
+        endpoint = self.makeEndpoint()
+
+        async def run():
+            request = await consumer.begin(endpoint)
+            query, new_return_to = self.makeResponse(request)
+            message = Message.fromPostArgs(query)
+            first = await consumer.complete(message, request.endpoint,
+                                            new_return_to)
+            second = await consumer.complete(message, request.endpoint,
+                                             new_return_to)
+            return first, second
+
+        first, second = asyncio.run(run())
+        self.assertEqual(first.status, SUCCESS, first)
+        self.assertEqual(second.status, FAILURE, second)
+
+    def test_checkAuth(self):
+        responses = []
+
+        def fetch(url, body=None, headers=None):
+            self.assertIn('openid.mode=check_authentication', body)
+            return responses.pop(0)
+
+        self.fetcher.fetch = fetch
+        consumer = AsyncGenericConsumer(self.store)
+        message = Message.fromOpenIDArgs({
+            'mode': 'id_res',
+            'assoc_handle': 'unknown',
+            'signed': 'mode',
+        })
+
+        stale = Association.fromExpiresIn(600, 'stale', b'x' * 20,
+                                          'HMAC-SHA1')
+        responses.append(
+            HTTPResponse(server_url, 200, {},
+                         'is_valid:true\ninvalidate_handle:stale\n'))
+
+        async def run():
+            await self.store.storeAssociation(server_url, stale)
+            return await consumer._idResCheckSignature(message, server_url)
+
+        asyncio.run(run())
+        self.assertIsNone(
+            asyncio.run(self.store.getAssociation(server_url, 'stale')))
+
+    def test_syncStore(self):
+        consumer = AsyncGenericConsumer(memstore.MemoryStore())
+        self.assertIsInstance(consumer.store, SyncToAsyncStore)
+
+
+class TestAsyncConsumer(AsyncConsumerTestCase):
+    def test_beginAndComplete(self):
+        self.fetcher.get_responses[user_url] = self.fetcher.response(
+            user_url, 200,
+            '<html><head><link rel="openid.server" href="%s" /></head>'
+            '</html>' % (server_url, ))
+        session = {}
+        consumer = AsyncConsumer(session, self.store)
+        setConsumerSession(consumer.consumer)
+
+        async def run():
+            request = await consumer.begin(user_url)
+            query, new_return_to = self.makeResponse(request)
+            return await consumer.complete(query, new_return_to)
+
+        response = asyncio.run(run())
+        self.assertEqual(response.status, SUCCESS, response)
+        self.assertEqual(response.identity_url, user_url)
+        self.assertNotIn(consumer._token_key, session)
+
+    def test_cancel(self):
+        session = {}
+        consumer = AsyncConsumer(session, self.store)
+        session[consumer._token_key] = self.makeEndpoint()
+        response = asyncio.run(
+            consumer.complete({'openid.mode': 'cancel'}, return_to))
+        self.assertEqual(response.status, CANCEL)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+import asyncio
+import sys
+import unittest
+
+from openid import association
+from openid.consumer.consumer import DiffieHellmanSHA1ConsumerSession
+from openid.message import Message, OPENID_NS, OPENID1_NS, OPENID2_NS
+from openid.server import server
+from openid.server.asyncserver import AsyncServer, AsyncSignatory
+from openid.store import asyncmemstore, memstore
+from openid.store.asyncinterface import SyncToAsyncStore
+
+from .support import CatchLogs
+
+requires_asyncio_run = unittest.skipIf(sys.version_info < (3, 7),
+                                       "asyncio.run needs Python 3.7")
+
+
+@requires_asyncio_run
+class TestAsyncSignatory(unittest.TestCase, CatchLogs):
+    def setUp(self):
+        CatchLogs.setUp(self)
+        self.store = asyncmemstore.AsyncMemoryStore()
+        self.signatory = AsyncSignatory(self.store)
+        self._dumb_key = self.signatory._dumb_key
+        self._normal_key = self.signatory._normal_key
+
+    def tearDown(self):
+        CatchLogs.tearDown(self)
+
+    def makeResponse(self, assoc_handle, namespace=OPENID2_NS):
+        request = server.OpenIDRequest()
+        request.assoc_handle = assoc_handle
+        request.namespace = namespace
+        response = server.OpenIDResponse(request)
+        response.fields = Message.fromOpenIDArgs({
+            'foo': 'amsigned',
+            'bar': 'notsigned',
+            'azu': 'alsosigned',
+            'ns': namespace,
+        })
+        return response
+
+    def test_sign(self):
+        assoc_handle = '{assoc}{lookatme}'
+        assoc = association.Association.fromExpiresIn(60, assoc_handle,
+                                                      'sekrit', 'HMAC-SHA1')
+        asyncio.run(self.store.storeAssociation(self._normal_key, assoc))
+
+        sresponse = asyncio.run(
+            self.signatory.sign(self.makeResponse(assoc_handle, OPENID1_NS)))
+        self.assertEqual(
+            sresponse.fields.getArg(OPENID_NS, 'assoc_handle'), assoc_handle)
+        self.assertTrue(assoc.checkMessageSignature(sresponse.fields))
+
+    def test_signDumb(self):
+        async def run():
+            sresponse = await self.signatory.sign(self.makeResponse(None))
+            assoc_handle = sresponse.fields.getArg(OPENID_NS, 'assoc_handle')
+            self.assertTrue(
+                await self.signatory.verify(assoc_handle, sresponse.fields))
+            return sresponse
+
+        sresponse = asyncio.run(run())
+        self.assertTrue(sresponse.fields.getArg(OPENID_NS, 'sig'))
+
+    def test_signExpired(self):
+        assoc_handle = '{assoc}{lookatme}'
+        expired = association.Association.fromExpiresIn(
+            -10, assoc_handle, 'sekrit', 'HMAC-SHA1')
+
+        async def run():
+            await self.store.storeAssociation(self._normal_key, expired)
+            sresponse = await self.signatory.sign(
+                self.makeResponse(assoc_handle))
+            self.assertIsNone(await self.store.getAssociation(
+                self._normal_key, assoc_handle))
+            new_handle = sresponse.fields.getArg(OPENID_NS, 'assoc_handle')
+            self.assertIsNotNone(await self.signatory.getAssociation(
+                new_handle, dumb=True))
+            return sresponse
+
+        sresponse = asyncio.run(run())
+        self.assertEqual(
+            sresponse.fields.getArg(OPENID_NS, 'invalidate_handle'),
+            assoc_handle)
+        self.assertNotEqual(
+            sresponse.fields.getArg(OPENID_NS, 'assoc_handle'), assoc_handle)
+
+
+@requires_asyncio_run
+class TestAsyncServer(unittest.TestCase, CatchLogs):
+    op_endpoint = 'http://server.unittest/endpoint'
+
+    def setUp(self):
+        CatchLogs.setUp(self)
+        self.store = asyncmemstore.AsyncMemoryStore()
+        self.server = AsyncServer(self.store, self.op_endpoint)
+
+    def tearDown(self):
+        CatchLogs.tearDown(self)
+
+    def test_syncStore(self):
+        oserver = AsyncServer(memstore.MemoryStore(), self.op_endpoint)
+        self.assertIsInstance(oserver.store, SyncToAsyncStore)
+
+    def test_associate(self):
+        session = DiffieHellmanSHA1ConsumerSession()
+        query = {
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'associate',
+            'openid.assoc_type': 'HMAC-SHA1',
+            'openid.session_type': 'DH-SHA1',
+        }
+        for key, value in session.getRequest().items():
+            query['openid.' + key] = value
+
+        async def run():
+            request = await self.server.decodeRequest(query)
+            response = await self.server.handleRequest(request)
+            secret = session.extractSecret(response.fields)
+            handle = response.fields.getArg(OPENID_NS, 'assoc_handle')
+            assoc = await self.server.signatory.getAssociation(handle,
+                                                               dumb=False)
+            return secret, assoc
+
+        secret, assoc = asyncio.run(run())
+        self.assertIsNotNone(assoc)
+        self.assertEqual(secret, assoc.secret)
+
+    def test_associateUnsupported(self):
+        self.server.negotiator.setAllowedTypes([('HMAC-SHA256', 'DH-SHA256')])
+        query = {
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'associate',
+            'openid.assoc_type': 'HMAC-SHA1',
+            'openid.session_type': 'no-encryption',
+        }
+
+        async def run():
+            request = await self.server.decodeRequest(query)
+            return await self.server.handleRequest(request)
+
+        response = asyncio.run(run())
+        self.assertEqual(
+            response.fields.getArg(OPENID_NS, 'error_code'),
+            'unsupported-type')
+        self.assertEqual(
+            response.fields.getArg(OPENID_NS, 'assoc_type'), 'HMAC-SHA256')
+
+    def checkAuth(self, tamper=False, invalidate_handle=None):
+        """Sign a positive assertion in dumb mode and check it with
+        check_authentication, returning the response."""
+
+        async def run():
+            request = server.OpenIDRequest()
+            request.assoc_handle = None
+            request.namespace = OPENID2_NS
+            response = server.OpenIDResponse(request)
+            response.fields = Message.fromOpenIDArgs({
+                'ns': OPENID2_NS,
+                'mode': 'id_res',
+                'identity': 'http://example.com/',
+                'return_to': 'http://rp.unittest/',
+                'response_nonce': '2008-01-01T00:00:00Zxyz',
+            })
+            sresponse = await self.server.signatory.sign(response)
+
+            query = sresponse.fields.toPostArgs()
+            query['openid.mode'] = 'check_authentication'
+            if tamper:
+                query['openid.identity'] = 'http://evil.example.com/'
+            if invalidate_handle:
+                query['openid.invalidate_handle'] = invalidate_handle
+
+            request = await self.server.decodeRequest(query)
+            first = await self.server.handleRequest(request)
+            # Replays are refused
+            second = await self.server.handleRequest(request)
+            return first, second
+
+        return asyncio.run(run())
+
+    def test_checkAuth(self):
+        first, second = self.checkAuth()
+        self.assertEqual(first.fields.getArg(OPENID_NS, 'is_valid'), 'true')
+        self.assertEqual(second.fields.getArg(OPENID_NS, 'is_valid'), 'false')
+
+    def test_checkAuthTampered(self):
+        first, _ = self.checkAuth(tamper=True)
+        self.assertEqual(first.fields.getArg(OPENID_NS, 'is_valid'), 'false')
+
+    def test_checkAuthInvalidateHandle(self):
+        first, _ = self.checkAuth(invalidate_handle='{unknown}')
+        self.assertEqual(
+            first.fields.getArg(OPENID_NS, 'invalidate_handle'), '{unknown}')
+
+    def test_encodeResponse(self):
+        request = server.CheckIDRequest(
+            identity='http://example.com/',
+            return_to='http://rp.unittest/',
+            trust_root='http://rp.unittest/',
+            immediate=False,
+            assoc_handle=None,
+            op_endpoint=self.op_endpoint)
+        request.message = Message(OPENID2_NS)
+        response = request.answer(True)
+
+        webresponse = asyncio.run(self.server.encodeResponse(response))
+        self.assertEqual(webresponse.code, server.HTTP_REDIRECT)
+        self.assertIn('openid.sig=', webresponse.headers['location'])
+
+    def test_checkidNotHandled(self):
+        request = server.CheckIDRequest(
+            identity='http://example.com/',
+            return_to='http://rp.unittest/',
+            trust_root='http://rp.unittest/',
+            immediate=False,
+            assoc_handle=None,
+            op_endpoint=self.op_endpoint)
+        self.assertRaises(NotImplementedError, asyncio.run,
+                          self.server.handleRequest(request))
+
+
+if __name__ == '__main__':
+    unittest.main()
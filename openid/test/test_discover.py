@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import sys
+import threading
+import time
 import unittest
 import os.path
 from urllib.parse import urlsplit
@@ -752,6 +755,173 @@ class TestDiscoverFunction(unittest.TestCase):
         self.assertEqual('XRI', discover.discover('=something'))
 
 
+class BlockingFetcher(object):
+    """Serves an OpenID 1 HTML page once it is released."""
+
+    page = """<html><head>
+<link rel="openid.server" href="http://www.myopenid.com/server" />
+</head></html>"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.fetches = 0
+
+    def fetch(self, url, body=None, headers=None):
+        self.fetches += 1
+        self.release.wait(5)
+        return HTTPResponse(url, 200, {'content-type': 'text/html'},
+                            self.page)
+
+
+class TestSingleFlight(unittest.TestCase):
+    url = 'http://unittest.example.com/'
+
+    def setUp(self):
+        self.fetcher = BlockingFetcher()
+        fetchers.setDefaultFetcher(self.fetcher, wrap_exceptions=False)
+        fetchers.setDefaultAsyncFetcher(
+            fetchers.ExecutorFetcher(self.fetcher), wrap_exceptions=False)
+
+    def tearDown(self):
+        fetchers.setDefaultFetcher(None)
+        fetchers.setDefaultAsyncFetcher(None)
+
+    def waitForWaiters(self, key, count):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            call = discover._in_flight._calls.get(key)
+            if call is not None and call.waiters == count:
+                return
+            time.sleep(0.001)
+        self.fail('%d callers did not wait for %r' % (count, key))
+
+    def test_threads(self):
+        results = []
+
+        def run(identifier):
+            results.append(discover.discover(identifier))
+
+        # Identifiers that normalize to the same URL coalesce
+        threads = [
+            threading.Thread(target=run, args=(identifier, ))
+            for identifier in [self.url, 'unittest.example.com'] * 3
+        ]
+        for thread in threads:
+            thread.start()
+        self.waitForWaiters(('discover', self.url), len(threads) - 1)
+        self.fetcher.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fetcher.fetches, 1)
+        self.assertEqual(len(results), len(threads))
+        services = [result[1][0] for result in results]
+        for (claimed_id, _) in results:
+            self.assertEqual(claimed_id, self.url)
+        self.assertEqual(len(set(map(id, services))), len(services))
+        self.assertEqual(discover._in_flight._calls, {})
+
+    def test_threadsShareFailure(self):
+        errors = []
+
+        def run():
+            try:
+                discover.discover(self.url)
+            except ValueError as why:
+                errors.append(why)
+
+        self.fetcher.fetch = self.failingFetch
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        self.waitForWaiters(('discover', self.url), 2)
+        self.fetcher.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(self.fetcher.fetches, 1)
+        self.assertDistinctErrors(errors)
+
+    def assertDistinctErrors(self, errors):
+        """The leader raises the exception, and each waiter a copy of
+        it chained to it."""
+        self.assertEqual(len(set(map(id, errors))), len(errors))
+        leaders = [why for why in errors if why.__cause__ is None]
+        self.assertEqual(len(leaders), 1)
+        for why in errors:
+            self.assertEqual(str(why), 'boom')
+            if why is not leaders[0]:
+                self.assertIs(why.__cause__, leaders[0])
+
+    def test_copyException(self):
+        response = HTTPResponse(self.url, 500, {}, '')
+        original = DiscoveryFailure('boom', response)
+        copied = discover._copyException(original)
+        self.assertIsNot(copied, original)
+        self.assertIsInstance(copied, DiscoveryFailure)
+        self.assertEqual(copied.args, ('boom', ))
+        self.assertIs(copied.http_response, response)
+
+    def failingFetch(self, url, body=None, headers=None):
+        self.fetcher.fetches += 1
+        self.fetcher.release.wait(5)
+        raise ValueError('boom')
+
+    def test_sequential(self):
+        self.fetcher.release.set()
+        discover.discover(self.url)
+        discover.discover(self.url)
+        self.assertEqual(self.fetcher.fetches, 2)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run needs Python 3.7")
+    def test_async(self):
+        self.fetcher.release.set()
+
+        async def run():
+            return await asyncio.gather(
+                *[discover.discoverAsync(self.url) for _ in range(5)],
+                discover.discoverWithExpiryAsync(self.url))
+
+        results = asyncio.run(run())
+        # discoverWithExpiry returns more, so it does its own fetch
+        self.assertEqual(self.fetcher.fetches, 2)
+        self.assertEqual([len(result) for result in results],
+                         [2] * 5 + [3])
+        self.assertEqual(discover._in_flight._tasks, {})
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run needs Python 3.7")
+    def test_asyncShareFailure(self):
+        self.fetcher.fetch = self.failingFetch
+        self.fetcher.release.set()
+
+        async def run():
+            return await asyncio.gather(
+                *[discover.discoverAsync(self.url) for _ in range(3)],
+                return_exceptions=True)
+
+        errors = asyncio.run(run())
+        self.assertEqual([type(why) for why in errors], [ValueError] * 3)
+        self.assertEqual(self.fetcher.fetches, 1)
+        self.assertDistinctErrors(errors)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run needs Python 3.7")
+    def test_asyncCancelled(self):
+        async def run():
+            first = asyncio.ensure_future(discover.discoverAsync(self.url))
+            second = asyncio.ensure_future(discover.discoverAsync(self.url))
+            await asyncio.sleep(0)
+            first.cancel()
+            await asyncio.sleep(0)
+            self.fetcher.release.set()
+            return await second
+
+        claimed_id, services = asyncio.run(run())
+        self.assertEqual(claimed_id, self.url)
+        self.assertEqual(len(services), 1)
+        self.assertEqual(self.fetcher.fetches, 1)
+
+
 class TestEndpointSupportsType(unittest.TestCase):
     def setUp(self):
         self.endpoint = discover.OpenIDServiceEndpoint()
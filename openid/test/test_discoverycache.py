@@ -0,0 +1,270 @@
+import asyncio
+import sys
+import threading
+import time
+import unittest
+
+from openid import fetchers
+from openid.consumer import consumer, discoverycache
+from openid.consumer.asyncconsumer import AsyncConsumer
+from openid.consumer.discover import OpenIDServiceEndpoint, \
+     discoverWithExpiry, OPENID_2_0_TYPE
+from openid.fetchers import HTTPResponse
+from openid.yadis.constants import YADIS_CONTENT_TYPE
+
+XRDS = '''<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+  <XRD>
+    %s
+    <Service priority="0">
+      <Type>http://specs.openid.net/auth/2.0/signon</Type>
+      <URI>http://www.myopenid.com/server</URI>
+    </Service>
+  </XRD>
+</xrds:XRDS>
+'''
+
+requires_asyncio_run = unittest.skipIf(sys.version_info < (3, 7),
+                                       "asyncio.run needs Python 3.7")
+
+HTML = '''<html><head>
+<link rel="openid.server" href="http://www.myopenid.com/server" />
+</head></html>'''
+
+
+class CountingFetcher(object):
+    """Serves documents by URL, counting the fetches."""
+
+    def __init__(self):
+        self.documents = {}
+        self.fetches = 0
+
+    def fetch(self, url, body=None, headers=None):
+        self.fetches += 1
+        try:
+            content_type, headers, body = self.documents[url]
+        except KeyError:
+            return HTTPResponse(url, 404, {}, '')
+        headers = dict(headers, **{'content-type': content_type})
+        return HTTPResponse(url, 200, headers, body)
+
+
+class DiscoveryCacheTestCase(unittest.TestCase):
+    url = 'http://unittest.example.com/'
+
+    def setUp(self):
+        self.fetcher = CountingFetcher()
+        fetchers.setDefaultFetcher(self.fetcher, wrap_exceptions=False)
+        fetchers.setDefaultAsyncFetcher(
+            fetchers.ExecutorFetcher(self.fetcher), wrap_exceptions=False)
+        self.cache = discoverycache.MemoryDiscoveryCache()
+
+    def tearDown(self):
+        fetchers.setDefaultFetcher(None)
+        fetchers.setDefaultAsyncFetcher(None)
+
+    def serveXRDS(self, headers=None, xrd_expires=None):
+        if xrd_expires is None:
+            expires_element = ''
+        else:
+            expires_element = '<Expires>%s</Expires>' % (time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime(xrd_expires)), )
+        self.fetcher.documents[self.url] = (YADIS_CONTENT_TYPE, headers or {},
+                                            XRDS % (expires_element, ))
+
+
+class TestDiscoverWithExpiry(DiscoveryCacheTestCase):
+    def test_noExpiry(self):
+        self.serveXRDS()
+        claimed_id, services, expires = discoverWithExpiry(self.url)
+        self.assertEqual(claimed_id, self.url)
+        self.assertEqual(services[0].type_uris, [OPENID_2_0_TYPE])
+        self.assertIsNone(expires)
+
+    def test_xrdExpires(self):
+        xrd_expires = int(time.time()) + 3600
+        self.serveXRDS(xrd_expires=xrd_expires)
+        _, _, expires = discoverWithExpiry(self.url)
+        self.assertEqual(expires, xrd_expires)
+
+    def test_cacheControl(self):
+        self.serveXRDS({'cache-control': 'max-age=60'},
+                       xrd_expires=time.time() + 3600)
+        _, _, expires = discoverWithExpiry(self.url)
+        self.assertAlmostEqual(expires, time.time() + 60, delta=5)
+
+    def test_html(self):
+        self.fetcher.documents[self.url] = ('text/html',
+                                            {'cache-control': 'no-cache'},
+                                            HTML)
+        _, services, expires = discoverWithExpiry(self.url)
+        self.assertEqual(len(services), 1)
+        self.assertLessEqual(expires, time.time())
+
+
+class TestMemoryDiscoveryCache(DiscoveryCacheTestCase):
+    def test_cached(self):
+        self.serveXRDS()
+        first = self.cache.discover(self.url)
+        second = self.cache.discover('unittest.example.com')
+        self.assertEqual(self.fetcher.fetches, 1)
+        self.assertEqual(first[0], second[0])
+        self.assertEqual(first[1][0].server_url, second[1][0].server_url)
+        # Callers get their own endpoints
+        self.assertIsNot(first[1][0], second[1][0])
+
+    def test_expired(self):
+        self.serveXRDS({'cache-control': 'no-cache'})
+        self.cache.discover(self.url)
+        self.cache.discover(self.url)
+        self.assertEqual(self.fetcher.fetches, 2)
+
+    def test_defaultTTL(self):
+        self.cache.default_ttl = 0
+        self.serveXRDS()
+        self.cache.discover(self.url)
+        self.cache.discover(self.url)
+        self.assertEqual(self.fetcher.fetches, 2)
+
+    def test_maxTTL(self):
+        self.cache.max_ttl = 0
+        self.serveXRDS(xrd_expires=time.time() + 3600)
+        self.cache.discover(self.url)
+        self.cache.discover(self.url)
+        self.assertEqual(self.fetcher.fetches, 2)
+
+    def test_defaultTTLCapped(self):
+        self.cache.default_ttl = 600
+        self.cache.max_ttl = 0
+        self.serveXRDS()
+        self.cache.discover(self.url)
+        self.cache.discover(self.url)
+        self.assertEqual(self.fetcher.fetches, 2)
+
+    def test_noServicesNotCached(self):
+        self.fetcher.documents[self.url] = ('text/html', {}, '<html></html>')
+        for _ in range(2):
+            self.assertEqual(self.cache.discover(self.url), (self.url, []))
+        self.assertEqual(self.fetcher.fetches, 2)
+
+    def test_maxEntries(self):
+        self.cache.max_entries = 1
+        other_url = 'http://other.example.com/'
+        self.serveXRDS()
+        self.fetcher.documents[other_url] = self.fetcher.documents[self.url]
+        for url in [self.url, other_url, self.url]:
+            self.cache.discover(url)
+        self.assertEqual(self.fetcher.fetches, 3)
+
+    @requires_asyncio_run
+    def test_async(self):
+        self.serveXRDS()
+
+        async def run():
+            await self.cache.discoverAsync(self.url)
+            return await self.cache.discoverAsync(self.url)
+
+        claimed_id, services = asyncio.run(run())
+        self.assertEqual(claimed_id, self.url)
+        self.assertEqual(len(services), 1)
+        self.assertEqual(self.fetcher.fetches, 1)
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.values = {}
+
+    def get(self, name):
+        return self.values.get(name)
+
+    def set(self, name, value, ex=None):
+        assert ex >= 1
+        self.values[name] = value
+
+
+class RecordingRedis(FakeRedis):
+    """Records the threads it is called from."""
+
+    def __init__(self):
+        FakeRedis.__init__(self)
+        self.threads = []
+
+    def get(self, name):
+        self.threads.append(threading.get_ident())
+        return FakeRedis.get(self, name)
+
+    def set(self, name, value, ex=None):
+        self.threads.append(threading.get_ident())
+        FakeRedis.set(self, name, value, ex)
+
+
+class TestRedisDiscoveryCache(DiscoveryCacheTestCase):
+    def test_shared(self):
+        client = FakeRedis()
+        self.serveXRDS()
+        discoverycache.RedisDiscoveryCache(client).discover(self.url)
+        claimed_id, services = discoverycache.RedisDiscoveryCache(
+            client).discover(self.url)
+        self.assertEqual(self.fetcher.fetches, 1)
+        self.assertEqual(claimed_id, self.url)
+        self.assertIsInstance(services[0], OpenIDServiceEndpoint)
+        self.assertEqual(list(client.values),
+                         ['openid:discovery:' + self.url])
+
+    def test_defaultTTLCapped(self):
+        client = FakeRedis()
+        self.serveXRDS()
+        cache = discoverycache.RedisDiscoveryCache(
+            client, default_ttl=600, max_ttl=0)
+        cache.discover(self.url)
+        self.assertEqual(client.values, {})
+
+    @requires_asyncio_run
+    def test_async(self):
+        client = RecordingRedis()
+        cache = discoverycache.RedisDiscoveryCache(client)
+        self.serveXRDS()
+
+        async def run():
+            for _ in range(2):
+                claimed_id, services = await cache.discoverAsync(self.url)
+            return threading.get_ident()
+
+        loop_thread = asyncio.run(run())
+        self.assertEqual(self.fetcher.fetches, 1)
+        # get, set, then a get that finds it: none on the loop's thread
+        self.assertEqual(len(client.threads), 3)
+        self.assertNotIn(loop_thread, client.threads)
+
+
+class TestConsumer(DiscoveryCacheTestCase):
+    def test_begin(self):
+        self.serveXRDS()
+        for _ in range(2):
+            oidconsumer = consumer.Consumer({}, None,
+                                            discovery_cache=self.cache)
+            request = oidconsumer.begin(self.url)
+            self.assertEqual(request.endpoint.server_url,
+                             'http://www.myopenid.com/server')
+        self.assertEqual(self.fetcher.fetches, 1)
+        self.assertEqual(oidconsumer.consumer._discover, self.cache.discover)
+
+    @requires_asyncio_run
+    def test_asyncBegin(self):
+        self.serveXRDS()
+
+        async def run():
+            for _ in range(2):
+                oidconsumer = AsyncConsumer({}, None,
+                                            discovery_cache=self.cache)
+                await oidconsumer.begin(self.url)
+            return oidconsumer
+
+        oidconsumer = asyncio.run(run())
+        self.assertEqual(self.fetcher.fetches, 1)
+        self.assertEqual(oidconsumer.consumer._discover,
+                         self.cache.discoverAsync)
+
+
+if __name__ == '__main__':
+    unittest.main()
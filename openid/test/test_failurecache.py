@@ -0,0 +1,140 @@
+import asyncio
+import sys
+import time
+import unittest
+
+from openid import fetchers
+from openid.consumer import discover
+from openid.consumer.failurecache import DiscoveryFailureCache, \
+     HostBackedOff
+from openid.fetchers import HTTPResponse
+from openid.yadis.discover import DiscoveryFailure
+
+
+class ScriptedFetcher(object):
+    """Returns queued responses, or raises queued exceptions."""
+
+    def __init__(self):
+        self.outcomes = []
+        self.fetches = 0
+
+    def fetch(self, url, body=None, headers=None):
+        self.fetches += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        status, body = outcome
+        return HTTPResponse(url, status, {'content-type': 'text/html'}, body)
+
+
+class TestDiscoveryFailureCache(unittest.TestCase):
+    url = 'http://unittest.example.com/user'
+
+    def setUp(self):
+        self.fetcher = ScriptedFetcher()
+        fetchers.setDefaultFetcher(self.fetcher)
+        fetchers.setDefaultAsyncFetcher(
+            fetchers.ExecutorFetcher(self.fetcher))
+        self.failure_cache = DiscoveryFailureCache(base_delay=60,
+                                                   max_delay=3600)
+        discover.setFailureCache(self.failure_cache)
+
+    def tearDown(self):
+        discover.setFailureCache(None)
+        fetchers.setDefaultFetcher(None)
+        fetchers.setDefaultAsyncFetcher(None)
+
+    def expireBackoff(self):
+        for entry in self.failure_cache._hosts.values():
+            entry.retry_at = time.time()
+
+    def test_failFast(self):
+        self.fetcher.outcomes.append(IOError('connection refused'))
+        self.assertRaises(fetchers.HTTPFetchingError, discover.discover,
+                          self.url)
+
+        # Another identifier on the same host
+        try:
+            discover.discover('http://unittest.example.com/other')
+        except HostBackedOff as why:
+            self.assertEqual(why.host, 'unittest.example.com')
+            self.assertAlmostEqual(why.retry_at, time.time() + 60, delta=5)
+        else:
+            self.fail('HostBackedOff not raised')
+        self.assertEqual(self.fetcher.fetches, 1)
+
+        state = self.failure_cache.getState()
+        self.assertEqual(list(state), ['unittest.example.com'])
+        self.assertEqual(state['unittest.example.com']['failures'], 1)
+        self.assertIn('connection refused',
+                      state['unittest.example.com']['last_error'])
+
+    def test_backoffGrows(self):
+        for _ in range(3):
+            self.fetcher.outcomes.append((503, ''))
+            self.assertRaises(DiscoveryFailure, discover.discover, self.url)
+            self.expireBackoff()
+
+        self.fetcher.outcomes.append((503, ''))
+        self.assertRaises(DiscoveryFailure, discover.discover, self.url)
+        state = self.failure_cache.getState()['unittest.example.com']
+        self.assertEqual(state['failures'], 4)
+        self.assertAlmostEqual(state['retry_at'], time.time() + 480, delta=5)
+
+    def test_maxDelay(self):
+        self.failure_cache.max_delay = 90
+        for _ in range(3):
+            self.expireBackoff()
+            self.fetcher.outcomes.append((500, ''))
+            self.assertRaises(DiscoveryFailure, discover.discover, self.url)
+        state = self.failure_cache.getState()['unittest.example.com']
+        self.assertAlmostEqual(state['retry_at'], time.time() + 90, delta=5)
+
+    def test_successClears(self):
+        self.fetcher.outcomes.append(IOError('timed out'))
+        self.assertRaises(fetchers.HTTPFetchingError, discover.discover,
+                          self.url)
+        self.expireBackoff()
+
+        self.fetcher.outcomes.append((200, '<html></html>'))
+        self.assertEqual(discover.discover(self.url), (self.url, []))
+        self.assertEqual(self.failure_cache.getState(), {})
+
+    def test_notFoundNotCounted(self):
+        for _ in range(2):
+            self.fetcher.outcomes.append((404, ''))
+            self.assertRaises(DiscoveryFailure, discover.discover, self.url)
+        self.assertEqual(self.fetcher.fetches, 2)
+        self.assertEqual(self.failure_cache.getState(), {})
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run needs Python 3.7")
+    def test_async(self):
+        self.fetcher.outcomes.append(IOError('connection refused'))
+
+        async def run():
+            with self.assertRaises(fetchers.HTTPFetchingError):
+                await discover.discoverAsync(self.url)
+            with self.assertRaises(HostBackedOff):
+                await discover.discoverAsync(self.url)
+
+        asyncio.run(run())
+        self.assertEqual(self.fetcher.fetches, 1)
+
+    def test_maxHosts(self):
+        self.failure_cache.max_hosts = 1
+        for host in ['a.example.com', 'b.example.com']:
+            self.failure_cache.recordFailure(host, IOError())
+        self.assertEqual(list(self.failure_cache.getState()),
+                         ['b.example.com'])
+
+    def test_disabled(self):
+        discover.setFailureCache(None)
+        for _ in range(2):
+            self.fetcher.outcomes.append(IOError('connection refused'))
+            self.assertRaises(fetchers.HTTPFetchingError, discover.discover,
+                              self.url)
+        self.assertEqual(self.fetcher.fetches, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,13 @@
+import asyncio
+import concurrent.futures
+import email.utils
+import http.client
+import io
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import warnings
 import unittest
 import urllib.request
@@ -93,10 +102,59 @@ def test_fetcher(fetcher, should_raise_exc, server):
                                                                      result)
 
 
+async def test_async_fetcher(fetcher, should_raise_exc, server):
+    """Like test_fetcher, for an AsyncHTTPFetcher."""
+
+    def geturl(path):
+        host, port = server.server_address
+        return 'http://%s:%s%s' % (host, port, path)
+
+    expected_headers = {'content-type': 'text/plain'}
+    expect_success = fetchers.HTTPResponse(
+        geturl('/success'), 200, expected_headers, '/success')
+    cases = [
+        ('/success', expect_success),
+        ('/301redirect', expect_success),
+        ('/302redirect', expect_success),
+        ('/303redirect', expect_success),
+        ('/307redirect', expect_success),
+    ]
+    for path, code in [('/notfound', 404), ('/badreq', 400),
+                       ('/forbidden', 403), ('/error', 500),
+                       ('/server_error', 503)]:
+        cases.append((path, fetchers.HTTPResponse(
+            geturl(path), code, expected_headers, path)))
+
+    for path, expected in cases:
+        actual = await fetcher.fetch(geturl(path))
+        failUnlessResponseExpected(expected, actual, extra=locals())
+
+    for err_url in [
+            geturl('/closed'),
+            'http://invalid.janrain.com/',
+            'not:a/url',
+            'ftp://janrain.com/pub/',
+    ]:
+        try:
+            result = await fetcher.fetch(err_url)
+        except fetchers.HTTPError:
+            assert should_raise_exc
+        except fetchers.HTTPFetchingError:
+            assert not should_raise_exc, (fetcher, should_raise_exc, server)
+        except Exception:
+            assert should_raise_exc
+        else:
+            assert False, 'An exception was expected for %r (%r)' % (fetcher,
+                                                                     result)
+
+    await fetcher.close()
+
+
 def run_fetcher_tests(server):
     exc_fetchers = []
     for klass, library_name in [
         (fetchers.Urllib2Fetcher, 'urllib2'),
+        (fetchers.PooledHTTPFetcher, 'http.client'),
         (fetchers.CurlHTTPFetcher, 'pycurl'),
         (fetchers.HTTPLib2Fetcher, 'httplib2'),
     ]:
@@ -127,9 +185,24 @@ def run_fetcher_tests(server):
     for f in non_exc_fetchers:
         test_fetcher(f, False, server)
 
+    if sys.version_info >= (3, 7):
+        async_fetcher = fetchers.AsyncioHTTPFetcher()
+        asyncio.run(test_async_fetcher(async_fetcher, True, server))
+        asyncio.run(test_async_fetcher(
+            fetchers.AsyncExceptionWrappingFetcher(async_fetcher), False,
+            server))
 
+
+import socketserver
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
+requires_asyncio_run = unittest.skipIf(sys.version_info < (3, 7),
+                                       "asyncio.run needs Python 3.7")
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
 
 class FetcherTestHandler(BaseHTTPRequestHandler):
     cases = {
@@ -221,7 +294,6 @@ def test():
 
     server = HTTPServer((host, port), FetcherTestHandler)
 
-    import threading
     server_thread = threading.Thread(target=server.serve_forever)
     if sys.version_info < (3, 10):
         server_thread.setDaemon(True)
@@ -341,9 +413,533 @@ class Urllib2FetcherTests(unittest.TestCase):
             self.assertEqual(self.fetcher._parseHeaderValue(s), p)
 
 
+class KeepAliveTestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    big_body = b'x' * (fetchers.MAX_RESPONSE_KB * 1024 + 10)
+
+    def log_request(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        if self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; charset=utf-8')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in [b'chun', b'ked']:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        elif self.path == '/big':
+            self._respond(200, [], self.big_body)
+        elif self.path == '/redirect':
+            self._respond(302, [('Location', '/hello')], b'')
+        elif self.path == '/goodbye':
+            # Close without saying so, like a server timing out an
+            # idle connection
+            self._respond(200, [], b'goodbye')
+            self.close_connection = True
+        elif self.path == '/drop':
+            self._drop()
+        else:
+            self._respond(200, [], self.path.encode())
+
+    def do_POST(self):
+        content_length = int(self.headers.get('Content-length'))
+        body = self.rfile.read(content_length)
+        if self.path == '/drop':
+            self._drop()
+        else:
+            self._respond(200, [], body)
+
+    def _drop(self):
+        # Close after reading the request, without a response
+        self.server.dropped.append(self.command)
+        self.close_connection = True
+
+    def _respond(self, http_code, extra_headers, body):
+        self.send_response(http_code)
+        for k, v in extra_headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestServerMixin(object):
+    """Runs a KeepAliveTestHandler server for the tests of a TestCase."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('localhost', 0),
+                                          KeepAliveTestHandler)
+        self.server.connections = 0
+        self.server.dropped = []
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def geturl(self, path):
+        host, port = self.server.server_address
+        return 'http://%s:%s%s' % (host, port, path)
+
+
+class KeepAliveFetcherTests(TestServerMixin):
+    """Tests for fetchers that keep connections alive, mixed in to a
+    TestCase that sets self.fetcher and defines fetchAll."""
+
+    def fetchAll(self, *requests):
+        """Make the requests in turn and return the responses."""
+        raise NotImplementedError
+
+    def test_keepAlive(self):
+        responses = self.fetchAll(
+            (self.geturl('/hello'), ),
+            (self.geturl('/chunked'), ),
+            (self.geturl('/echo'), 'posted'),
+            (self.geturl('/hello'), ))
+        self.assertEqual([r.body for r in responses],
+                         ['/hello', 'chunked', 'posted', '/hello'])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_redirect(self):
+        response, = self.fetchAll((self.geturl('/redirect'), ))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.final_url, self.geturl('/hello'))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_maxResponseSize(self):
+        big, hello = self.fetchAll((self.geturl('/big'), ),
+                                   (self.geturl('/hello'), ))
+        self.assertEqual(len(big.body), fetchers.MAX_RESPONSE_KB * 1024)
+        self.assertEqual(hello.body, '/hello')
+        # The rest of the big body was not read, so its connection
+        # could not be reused
+        self.assertEqual(self.server.connections, 2)
+
+    def test_closedByServer(self):
+        goodbye, hello = self.fetchAll((self.geturl('/goodbye'), ),
+                                       (self.geturl('/hello'), ))
+        self.assertEqual(goodbye.body, 'goodbye')
+        self.assertEqual(hello.body, '/hello')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_idleTimeout(self):
+        self.fetcher.idle_timeout = 0
+        self.fetchAll((self.geturl('/hello'), ), (self.geturl('/hello'), ))
+        self.assertEqual(self.server.connections, 2)
+
+
+@requires_asyncio_run
+class AsyncioHTTPFetcherTests(KeepAliveFetcherTests, unittest.TestCase):
+    def setUp(self):
+        KeepAliveFetcherTests.setUp(self)
+        self.fetcher = fetchers.AsyncioHTTPFetcher()
+
+    def fetchAll(self, *requests):
+        async def run():
+            responses = []
+            try:
+                for request in requests:
+                    responses.append(await self.fetcher.fetch(*request))
+            finally:
+                await self.fetcher.close()
+            return responses
+
+        return asyncio.run(run())
+
+    def test_maxIdlePerHost(self):
+        self.fetcher.max_idle_per_host = 0
+        self.fetchAll((self.geturl('/hello'), ), (self.geturl('/hello'), ))
+        self.assertEqual(self.server.connections, 2)
+
+    def test_retryGet(self):
+        # A GET that gets no answer on a pooled connection is sent again
+        # on a new one
+        self.assertRaises(fetchers.HTTPError, self.fetchAll,
+                          (self.geturl('/hello'), ), (self.geturl('/drop'), ))
+        self.assertEqual(self.server.dropped, ['GET', 'GET'])
+
+    def test_noRetryPost(self):
+        # The server may have acted on a POST that got no answer, so it
+        # is not sent again
+        self.assertRaises(fetchers.HTTPError, self.fetchAll,
+                          (self.geturl('/hello'), ),
+                          (self.geturl('/drop'), 'posted'))
+        self.assertEqual(self.server.dropped, ['POST'])
+
+    def test_disallowed(self):
+        self.assertRaises(ValueError, asyncio.run,
+                          self.fetcher.fetch('ftp://server/path'))
+
+
+class PooledHTTPFetcherTests(KeepAliveFetcherTests, unittest.TestCase):
+    def setUp(self):
+        KeepAliveFetcherTests.setUp(self)
+        self.fetcher = fetchers.PooledHTTPFetcher()
+
+    def tearDown(self):
+        self.fetcher.close()
+        KeepAliveFetcherTests.tearDown(self)
+
+    def fetchAll(self, *requests):
+        return [self.fetcher.fetch(*request) for request in requests]
+
+    def test_maxConnectionsPerHost(self):
+        self.fetcher.max_connections_per_host = 1
+        responses = []
+
+        def fetch():
+            responses.append(self.fetcher.fetch(self.geturl('/hello')))
+
+        threads = [threading.Thread(target=fetch) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([r.body for r in responses], ['/hello'] * 4)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_waitForConnection(self):
+        self.fetcher.max_connections_per_host = 0
+        self.fetcher.ALLOWED_TIME = 0
+        self.assertRaises(fetchers.HTTPError, self.fetcher.fetch,
+                          self.geturl('/hello'))
+
+    def test_disallowed(self):
+        self.assertRaises(ValueError, self.fetcher.fetch, 'ftp://server/path')
+
+    def test_retryGet(self):
+        # A GET that gets no answer on a pooled connection is sent again
+        # on a new one
+        self.assertRaises(http.client.RemoteDisconnected, self.fetchAll,
+                          (self.geturl('/hello'), ), (self.geturl('/drop'), ))
+        self.assertEqual(self.server.dropped, ['GET', 'GET'])
+
+    def test_noRetryPost(self):
+        # The server may have acted on a POST that got no answer, so it
+        # is not sent again
+        self.assertRaises(http.client.RemoteDisconnected, self.fetchAll,
+                          (self.geturl('/hello'), ),
+                          (self.geturl('/drop'), 'posted'))
+        self.assertEqual(self.server.dropped, ['POST'])
+
+
+class DefaultAsyncFetcherTest(unittest.TestCase):
+    def setUp(self):
+        fetchers.setDefaultAsyncFetcher(None)
+
+    def tearDown(self):
+        fetchers.setDefaultAsyncFetcher(None)
+
+    def test_getDefault(self):
+        default_fetcher = fetchers.getDefaultAsyncFetcher()
+        self.assertIsInstance(default_fetcher,
+                              fetchers.AsyncExceptionWrappingFetcher)
+        self.assertIsInstance(default_fetcher.fetcher,
+                              fetchers.AsyncioHTTPFetcher)
+
+    @requires_asyncio_run
+    def test_callFetch(self):
+        fetchers.setDefaultAsyncFetcher(
+            fetchers.ExecutorFetcher(FakeFetcher()))
+        actual = asyncio.run(fetchers.fetchAsync('bad://url'))
+        self.assertTrue(actual is FakeFetcher.sentinel)
+
+    @requires_asyncio_run
+    def test_wrapped(self):
+        self.assertRaises(fetchers.HTTPFetchingError, asyncio.run,
+                          fetchers.fetchAsync('bad://url'))
+
+
+class RecordingFetcher(fetchers.HTTPFetcher):
+    """Returns queued responses, recording the requests made."""
+
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+
+    def fetch(self, url, body=None, headers=None):
+        self.requests.append((url, body, headers))
+        status, headers, response_body = self.responses.pop(0)
+        return fetchers.HTTPResponse(url, status, headers, response_body)
+
+
+class StreamingBody(object):
+    def __init__(self, data, error=None):
+        self.data = io.BytesIO(data)
+        self.error = error
+        self.closed = False
+
+    def read(self, size=-1):
+        if self.error is not None:
+            raise self.error
+        return self.data.read(size)
+
+    def close(self):
+        self.closed = True
+
+
+class StreamingFetcher(fetchers.HTTPFetcher):
+    def __init__(self, body):
+        self.body = body
+
+    def fetchStream(self, url, headers=None):
+        return fetchers.HTTPStreamResponse(url, 200, {}, self.body)
+
+
+class FetchStreamTests(TestServerMixin, unittest.TestCase):
+    def tearDown(self):
+        fetchers.setDefaultFetcher(None)
+        TestServerMixin.tearDown(self)
+
+    def test_urllib2(self):
+        fetcher = fetchers.Urllib2Fetcher()
+        with fetcher.fetchStream(self.geturl('/big')) as response:
+            self.assertIsInstance(response, fetchers.HTTPStreamResponse)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.final_url, self.geturl('/big'))
+            self.assertEqual(response.headers['content-length'],
+                             str(len(KeepAliveTestHandler.big_body)))
+            self.assertIsNone(response.body)
+            self.assertEqual(response.read(3), b'xxx')
+
+    def test_urllib2Redirect(self):
+        fetcher = fetchers.Urllib2Fetcher()
+        with fetcher.fetchStream(self.geturl('/redirect')) as response:
+            self.assertEqual(response.final_url, self.geturl('/hello'))
+            self.assertEqual(response.read(), b'/hello')
+
+    def test_fetchOnly(self):
+        class FetchOnlyFetcher(object):
+            def fetch(self, url, body=None, headers=None):
+                return fetchers.HTTPResponse(url, 200, {}, 'body')
+
+        for wrap_exceptions in [False, True]:
+            fetchers.setDefaultFetcher(FetchOnlyFetcher(), wrap_exceptions)
+            response = fetchers.fetchStream('http://unittest/')
+            self.assertNotIsInstance(response, fetchers.HTTPStreamResponse)
+            self.assertEqual(response.body, 'body')
+
+    def test_wrapsReadErrors(self):
+        body = StreamingBody(b'', error=OSError('reset'))
+        fetchers.setDefaultFetcher(StreamingFetcher(body))
+        response = fetchers.fetchStream('http://unittest/')
+        try:
+            response.read(10)
+        except fetchers.HTTPFetchingError as why:
+            self.assertIs(why.why, body.error)
+        else:
+            self.fail('HTTPFetchingError not raised')
+        response.close()
+        self.assertTrue(body.closed)
+
+
+class CachingFetcherTests(unittest.TestCase):
+    url = 'http://unittest/identity'
+
+    def setUp(self):
+        self.fetcher = RecordingFetcher()
+        self.caching_fetcher = fetchers.CachingFetcher(self.fetcher)
+
+    def respond(self, headers, body='body', status=200):
+        self.fetcher.responses.append((status, headers, body))
+
+    def test_maxAge(self):
+        self.respond({'cache-control': 'public, max-age=60'})
+        first = self.caching_fetcher.fetch(self.url)
+        second = self.caching_fetcher.fetch(self.url)
+        self.assertEqual(second.body, 'body')
+        self.assertEqual(second.final_url, first.final_url)
+        self.assertEqual(len(self.fetcher.requests), 1)
+
+    def test_expires(self):
+        self.respond({'expires': email.utils.formatdate(time.time() + 60)})
+        self.caching_fetcher.fetch(self.url)
+        self.caching_fetcher.fetch(self.url)
+        self.assertEqual(len(self.fetcher.requests), 1)
+
+    def test_expired(self):
+        for _ in range(2):
+            self.respond({'expires': email.utils.formatdate(time.time() - 60)})
+            self.caching_fetcher.fetch(self.url)
+        self.assertEqual(len(self.fetcher.requests), 2)
+
+    def test_noStore(self):
+        for _ in range(2):
+            self.respond({'cache-control': 'no-store, max-age=60',
+                          'etag': '"v1"'})
+            self.caching_fetcher.fetch(self.url)
+        self.assertEqual(len(self.fetcher.requests), 2)
+        self.assertNotIn('If-None-Match', self.fetcher.requests[1][2])
+
+    def test_etag(self):
+        self.respond({'cache-control': 'no-cache', 'etag': '"v1"'})
+        self.respond({'cache-control': 'max-age=60'}, None, 304)
+        self.caching_fetcher.fetch(self.url)
+        response = self.caching_fetcher.fetch(self.url)
+        self.assertEqual(self.fetcher.requests[1][2],
+                         {'If-None-Match': '"v1"'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, 'body')
+
+        # The 304 made it fresh for another minute
+        self.caching_fetcher.fetch(self.url)
+        self.assertEqual(len(self.fetcher.requests), 2)
+
+    def test_lastModified(self):
+        last_modified = email.utils.formatdate(time.time() - 3600)
+        self.respond({'last-modified': last_modified})
+        self.respond({}, 'changed')
+        self.caching_fetcher.fetch(self.url)
+        response = self.caching_fetcher.fetch(self.url)
+        self.assertEqual(self.fetcher.requests[1][2],
+                         {'If-Modified-Since': last_modified})
+        self.assertEqual(response.body, 'changed')
+
+    def test_notCachedWithoutFreshnessOrValidators(self):
+        for _ in range(2):
+            self.respond({})
+            self.caching_fetcher.fetch(self.url)
+        self.assertEqual(len(self.fetcher.requests), 2)
+
+    def test_errorsNotCached(self):
+        for _ in range(2):
+            self.respond({'cache-control': 'max-age=60'}, status=404)
+            self.caching_fetcher.fetch(self.url)
+        self.assertEqual(len(self.fetcher.requests), 2)
+
+    def test_postNotCached(self):
+        for _ in range(2):
+            self.respond({'cache-control': 'max-age=60'})
+            self.caching_fetcher.fetch(self.url, 'openid.mode=associate')
+        self.assertEqual(len(self.fetcher.requests), 2)
+
+    def test_requestHeadersInKey(self):
+        for accept in ['text/html', 'application/xrds+xml', 'text/html']:
+            self.respond({'cache-control': 'max-age=60'}, accept)
+            response = self.caching_fetcher.fetch(self.url,
+                                                  headers={'Accept': accept})
+            self.assertEqual(response.body, accept)
+        self.assertEqual(len(self.fetcher.requests), 2)
+
+    def test_maxSize(self):
+        self.caching_fetcher.cache.max_size = 10
+        for path in ['/a', '/b', '/a']:
+            self.respond({'cache-control': 'max-age=60'}, 'x' * 6)
+            self.caching_fetcher.fetch(self.url + path)
+        self.assertEqual(len(self.fetcher.requests), 3)
+
+    def test_diskCache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            self.caching_fetcher.cache = fetchers.HTTPCache(
+                cache_dir=cache_dir)
+            self.respond({'cache-control': 'max-age=60'}, b'\xff')
+            self.caching_fetcher.fetch(self.url)
+
+            other = fetchers.CachingFetcher(
+                self.fetcher, fetchers.HTTPCache(cache_dir=cache_dir))
+            response = other.fetch(self.url)
+            self.assertEqual(response.body, b'\xff')
+            self.assertEqual(len(self.fetcher.requests), 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_age(self):
+        self.respond({'cache-control': 'max-age=60', 'age': '30'})
+        self.caching_fetcher.fetch(self.url)
+        entry = self.caching_fetcher.cache.get(
+            self.caching_fetcher.cache.key(self.url, None))
+        self.assertLessEqual(entry.fresh_until, time.time() + 30)
+        self.assertGreater(entry.fresh_until, time.time() + 20)
+
+    def test_ageExceedsMaxAge(self):
+        for _ in range(2):
+            self.respond({'cache-control': 'max-age=60', 'age': '100'})
+            self.caching_fetcher.fetch(self.url)
+        self.assertEqual(len(self.fetcher.requests), 2)
+
+    def test_apparentAge(self):
+        # Sent two minutes ago, so a one minute max-age is used up
+        for _ in range(2):
+            self.respond({'cache-control': 'max-age=60',
+                          'date': email.utils.formatdate(time.time() - 120)})
+            self.caching_fetcher.fetch(self.url)
+        self.assertEqual(len(self.fetcher.requests), 2)
+
+    @requires_asyncio_run
+    def test_async(self):
+        caching_fetcher = fetchers.AsyncCachingFetcher(
+            fetchers.ExecutorFetcher(self.fetcher))
+        self.respond({'cache-control': 'max-age=60'})
+
+        async def run():
+            responses = []
+            for _ in range(2):
+                responses.append(await caching_fetcher.fetch(self.url))
+            return responses
+
+        responses = asyncio.run(run())
+        self.assertEqual([r.body for r in responses], ['body', 'body'])
+        self.assertEqual(len(self.fetcher.requests), 1)
+
+    @requires_asyncio_run
+    def test_asyncDiskCache(self):
+        cache_dir = tempfile.mkdtemp()
+        loop_threads = []
+        cache_threads = []
+
+        class RecordingCache(fetchers.HTTPCache):
+            def get(self, key):
+                cache_threads.append(threading.get_ident())
+                return fetchers.HTTPCache.get(self, key)
+
+            def update(self, key, entry, response):
+                cache_threads.append(threading.get_ident())
+                return fetchers.HTTPCache.update(self, key, entry, response)
+
+        async def run(caching_fetcher):
+            loop_threads.append(threading.get_ident())
+            for _ in range(2):
+                response = await caching_fetcher.fetch(self.url)
+            return response
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                caching_fetcher = fetchers.AsyncCachingFetcher(
+                    fetchers.ExecutorFetcher(self.fetcher),
+                    RecordingCache(cache_dir=cache_dir), executor)
+                self.respond({'cache-control': 'max-age=60'})
+                response = asyncio.run(run(caching_fetcher))
+        finally:
+            shutil.rmtree(cache_dir)
+
+        self.assertEqual(response.body, 'body')
+        self.assertEqual(len(self.fetcher.requests), 1)
+        # get, update, then a fresh get: none of them on the loop's thread
+        self.assertEqual(len(cache_threads), 3)
+        self.assertNotIn(loop_threads[0], cache_threads)
+
+
 def pyUnitTests():
     case1 = unittest.FunctionTestCase(test)
     loadTests = unittest.defaultTestLoader.loadTestsFromTestCase
     case2 = loadTests(DefaultFetcherTest)
     case3 = loadTests(Urllib2FetcherTests)
-    return unittest.TestSuite([case1, case2, case3])
+    case4 = loadTests(AsyncioHTTPFetcherTests)
+    case5 = loadTests(PooledHTTPFetcherTests)
+    case6 = loadTests(DefaultAsyncFetcherTest)
+    case7 = loadTests(CachingFetcherTests)
+    case8 = loadTests(FetchStreamTests)
+    return unittest.TestSuite(
+        [case1, case2, case3, case4, case5, case6, case7, case8])
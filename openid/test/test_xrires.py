@@ -1,6 +1,32 @@
-from unittest import TestCase
+import asyncio
+import concurrent.futures
+import sys
+import threading
+from unittest import TestCase, skipIf
+from urllib.parse import parse_qs, urlsplit
+
+from openid import fetchers
+from openid.fetchers import HTTPResponse
 from openid.yadis import xrires
 
+XRDS = '''<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+  <XRD>
+    <CanonicalID>=!1000</CanonicalID>
+    %s
+  </XRD>
+</xrds:XRDS>
+'''
+
+SERVICE = '''<Service priority="%d">
+      <Type>%s</Type>
+      <URI>http://www.myopenid.com/server</URI>
+    </Service>'''
+
+SIGNON = 'http://specs.openid.net/auth/2.0/signon'
+SERVER = 'http://specs.openid.net/auth/2.0/server'
+OPENID_1 = 'http://openid.net/signon/1.0'
+
 
 class ProxyQueryTestCase(TestCase):
     def setUp(self):
@@ -35,3 +61,136 @@ class ProxyQueryTestCase(TestCase):
         h = self.proxy_url
         self.assertEqual(h + '=foo/bar??' + args_esc, pqu('=foo/bar?', st))
         self.assertEqual(h + '=foo/bar????' + args_esc, pqu('=foo/bar???', st))
+
+
+class ProxyFetcher(object):
+    """Serves an XRDS document for each service type queried for."""
+
+    def __init__(self, documents, barrier=None):
+        self.documents = documents
+        self.barrier = barrier
+        self.urls = []
+        self.threads = []
+
+    def fetch(self, url, body=None, headers=None):
+        self.urls.append(url)
+        self.threads.append(threading.current_thread())
+        if self.barrier is not None:
+            # Only passes if all of the queries are in flight at once
+            self.barrier.wait()
+        service_type = parse_qs(urlsplit(url).query)['_xrd_t'][0]
+        try:
+            body = self.documents[service_type]
+        except KeyError:
+            return HTTPResponse(url, 404, {}, '')
+        return HTTPResponse(url, 200,
+                            {'content-type': 'application/xrds+xml'}, body)
+
+
+class ProxyResolverQueryTestCase(TestCase):
+    service_types = [SERVER, SIGNON, OPENID_1]
+
+    def setUp(self):
+        both = XRDS % (SERVICE % (20, SIGNON) + SERVICE % (10, OPENID_1))
+        self.documents = {
+            SIGNON: both,
+            OPENID_1: both,
+            SERVER: XRDS % (SERVICE % (15, SERVER), ),
+        }
+        self.proxy = xrires.ProxyResolver('http://xri.example.com/')
+
+    def tearDown(self):
+        fetchers.setDefaultFetcher(None)
+        fetchers.setDefaultAsyncFetcher(None)
+
+    def setFetcher(self, fetcher):
+        fetchers.setDefaultFetcher(fetcher, wrap_exceptions=False)
+        fetchers.setDefaultAsyncFetcher(
+            fetchers.ExecutorFetcher(fetcher), wrap_exceptions=False)
+
+    def assertMerged(self, result):
+        canonicalID, services = result
+        self.assertEqual(canonicalID, 'xri://=!1000')
+        type_tag = '{xri://$xrd*($v*2.0)}Type'
+        self.assertEqual(
+            [(service.get('priority'), service.findtext(type_tag))
+             for service in services],
+            [('10', OPENID_1), ('15', SERVER), ('20', SIGNON)])
+
+    def test_concurrent(self):
+        fetcher = ProxyFetcher(
+            self.documents,
+            threading.Barrier(len(self.service_types), timeout=5))
+        self.setFetcher(fetcher)
+        self.assertMerged(self.proxy.query('=foo', self.service_types))
+        self.assertEqual(len(fetcher.urls), len(self.service_types))
+
+    def test_sharedPool(self):
+        fetcher = ProxyFetcher(self.documents)
+        self.setFetcher(fetcher)
+        for _ in range(2):
+            self.assertMerged(self.proxy.query('=foo', self.service_types))
+            self.assertMerged(
+                xrires.ProxyResolver().query('=foo', self.service_types))
+        # The pool's threads are kept for the next query
+        self.assertTrue(all(thread.is_alive() for thread in fetcher.threads))
+        self.assertLessEqual(len(set(fetcher.threads)), xrires.POOL_SIZE)
+
+    def test_executor(self):
+        self.setFetcher(ProxyFetcher(self.documents))
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            self.proxy.executor = executor
+            self.assertMerged(self.proxy.query('=foo', self.service_types))
+
+    @skipIf(sys.version_info < (3, 7), "asyncio.run needs Python 3.7")
+    def test_async(self):
+        fetcher = ProxyFetcher(
+            self.documents,
+            threading.Barrier(len(self.service_types), timeout=5))
+        self.setFetcher(fetcher)
+        self.assertMerged(
+            asyncio.run(self.proxy.queryAsync('=foo', self.service_types)))
+
+    @skipIf(sys.version_info < (3, 7), "asyncio.run needs Python 3.7")
+    def test_asyncOutOfOrder(self):
+        fetcher = ProxyFetcher(self.documents)
+        service_types = self.service_types
+        started = []
+
+        class SlowAsyncFetcher(fetchers.AsyncHTTPFetcher):
+            async def fetch(self, url, body=None, headers=None):
+                # The first query answers last
+                index = len(started)
+                started.append(url)
+                await asyncio.sleep(0.01 * (len(service_types) - index))
+                return fetcher.fetch(url, body, headers)
+
+        fetchers.setDefaultAsyncFetcher(SlowAsyncFetcher(),
+                                        wrap_exceptions=False)
+        self.assertMerged(
+            asyncio.run(self.proxy.queryAsync('=foo', self.service_types)))
+        # All of the queries were in flight at once, and the answers
+        # are merged the same whatever order they come in
+        self.assertEqual(fetcher.urls, list(reversed(started)))
+
+    def test_notFound(self):
+        del self.documents[SERVER]
+        self.setFetcher(ProxyFetcher(self.documents))
+        canonicalID, services = self.proxy.query('=foo', self.service_types)
+        self.assertEqual(canonicalID, 'xri://=!1000')
+        self.assertEqual([service.get('priority') for service in services],
+                         ['10', '20'])
+
+    def test_nothingFound(self):
+        self.setFetcher(ProxyFetcher({}))
+        self.assertEqual(self.proxy.query('=foo', self.service_types),
+                         (None, []))
+
+    def test_fetchingError(self):
+        class FailingFetcher(object):
+            def fetch(self, url, body=None, headers=None):
+                raise fetchers.HTTPFetchingError(why='down')
+
+        self.setFetcher(FailingFetcher())
+        self.assertRaises(fetchers.HTTPFetchingError, self.proxy.query,
+                          '=foo', self.service_types)
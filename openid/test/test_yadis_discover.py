@@ -5,14 +5,17 @@
    tests with a mock fetcher instead of spawning threads with BaseHTTPServer.
 """
 
+import io
 import unittest
 import urllib.parse
 import re
 import types
 
+from openid.yadis.constants import YADIS_CONTENT_TYPE
 from openid.yadis.discover import discover, DiscoveryFailure
 
 from openid import fetchers
+from openid.consumer import discover as consumer_discover
 
 from . import discoverdata
 
@@ -159,8 +162,116 @@ class _TestCase(unittest.TestCase):
         return "%s (%s)" % (n, self.__class__.__module__)
 
 
+class RecordingStream(io.BytesIO):
+    """A response body that remembers how much of it was read."""
+
+    def read(self, size=-1):
+        data = io.BytesIO.read(self, size)
+        self.bytes_read = self.tell()
+        return data
+
+    bytes_read = 0
+
+
+class StreamingFetcher(object):
+    """Streams the identity page, and serves the XRDS document."""
+
+    xrds = '<xrds:XRDS xmlns:xrds="xri://$xrds"/>'
+
+    def __init__(self, headers, page):
+        self.headers = headers
+        self.body = RecordingStream(page)
+        self.fetched = []
+
+    def fetchStream(self, url, headers=None):
+        self.fetched.append(url)
+        return fetchers.HTTPStreamResponse(url, 200, self.headers, self.body)
+
+    def fetch(self, url, body=None, headers=None):
+        self.fetched.append(url)
+        return fetchers.HTTPResponse(url, 200,
+                                     {'content-type': YADIS_CONTENT_TYPE},
+                                     self.xrds)
+
+
+class TestStreamingDiscovery(unittest.TestCase):
+    uri = 'http://unittest/'
+    xrds_uri = 'http://unittest/xrds'
+    # Far more than discovery should read of any of the pages
+    filler = b'<p>' + b'x' * (512 * 1024) + b'</p>'
+
+    def tearDown(self):
+        fetchers.setDefaultFetcher(None)
+
+    def discover(self, headers, page):
+        fetcher = StreamingFetcher(headers, page)
+        fetchers.setDefaultFetcher(fetcher)
+        result = discover(self.uri)
+        self.assertTrue(fetcher.body.closed)
+        return fetcher, result
+
+    def test_metaTag(self):
+        page = (b'<html><head><meta http-equiv="X-XRDS-Location" content="' +
+                self.xrds_uri.encode() + b'" />' + self.filler +
+                b'</head><body></body></html>')
+        fetcher, result = self.discover({'content-type': 'text/html'}, page)
+        self.assertEqual(result.xrds_uri, self.xrds_uri)
+        self.assertEqual(result.response_text, fetcher.xrds)
+        self.assertEqual(fetcher.fetched, [self.uri, self.xrds_uri])
+        self.assertLess(fetcher.body.bytes_read, 64 * 1024)
+
+    def test_header(self):
+        fetcher, result = self.discover(
+            {
+                'content-type': 'text/html',
+                'x-xrds-location': self.xrds_uri
+            }, self.filler)
+        self.assertEqual(result.xrds_uri, self.xrds_uri)
+        self.assertEqual(fetcher.body.bytes_read, 0)
+
+    def test_noMetaTag(self):
+        # The page itself is used, so all of it is read
+        page = (b'<html><head>'
+                b'<link rel="openid.server" href="http://unittest/server">'
+                b'</head><body>' + self.filler + b'</body></html>')
+        fetcher, result = self.discover(
+            {'content-type': 'text/html; charset=utf-8'}, page)
+        self.assertIsNone(result.xrds_uri)
+        self.assertEqual(fetcher.fetched, [self.uri])
+        self.assertEqual(result.response_text, page.decode())
+        self.assertEqual(fetcher.body.bytes_read, len(page))
+
+    def test_linksAfterLargeHead(self):
+        page = (b'<html><head><title>' + b'x' * (64 * 1024) + b'</title>'
+                b'<link rel="openid.server" href="http://unittest/server">'
+                b'</head><body>' + self.filler + b'</body></html>')
+        fetcher = StreamingFetcher({'content-type': 'text/html'}, page)
+        fetchers.setDefaultFetcher(fetcher)
+        claimed_id, services = consumer_discover.discoverURI(self.uri)
+        self.assertEqual(claimed_id, self.uri)
+        self.assertEqual([service.server_url for service in services],
+                         ['http://unittest/server'])
+        self.assertEqual(fetcher.body.bytes_read, len(page))
+
+    def test_noHead(self):
+        page = b'<p>' * (10 * 1024)
+        fetcher, result = self.discover({'content-type': 'text/html'}, page)
+        self.assertIsNone(result.xrds_uri)
+        self.assertEqual(result.response_text, page.decode())
+
+    def test_xrds(self):
+        page = StreamingFetcher.xrds.encode()
+        fetcher, result = self.discover({'content-type': YADIS_CONTENT_TYPE},
+                                        page)
+        self.assertEqual(result.xrds_uri, self.uri)
+        self.assertEqual(result.response_text, StreamingFetcher.xrds)
+        self.assertEqual(fetcher.fetched, [self.uri])
+
+
 def pyUnitTests():
     s = unittest.TestSuite()
+    s.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestStreamingDiscovery))
     for success, input_name, id_name, result_name in discoverdata.testlist:
         test = _TestCase(input_name, id_name, result_name, success)
         s.addTest(test)
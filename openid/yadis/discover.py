@@ -1,13 +1,19 @@
 # -*- test-case-name: openid.test.test_yadis_discover -*-
-__all__ = ['discover', 'DiscoveryResult', 'DiscoveryFailure']
+__all__ = [
+    'discover', 'discoverAsync', 'DiscoveryResult', 'DiscoveryFailure',
+    'getResponseExpires'
+]
 
+import codecs
+import time
 from io import StringIO
 
 from openid import fetchers
 
 from openid.yadis.constants import \
      YADIS_HEADER_NAME, YADIS_CONTENT_TYPE, YADIS_ACCEPT_HEADER
-from openid.yadis.parsehtml import MetaNotFound, findHTMLMeta
+from openid.yadis.parsehtml import MetaNotFound, findHTMLMeta, \
+     YadisHTMLParser, ParseDone, CHUNK_SIZE
 
 
 class DiscoveryFailure(Exception):
@@ -38,6 +44,10 @@ class DiscoveryResult(object):
     # The document returned from the xrds_uri
     response_text = None
 
+    # When the responses fetched expire according to their HTTP caching
+    # headers, as a time.time() value (set to None if they do not say)
+    expires = None
+
     def __init__(self, request_uri):
         """Initialize the state of the object
 
@@ -60,6 +70,13 @@ class DiscoveryResult(object):
 def discover(uri):
     """Discover services for a given URI.
 
+    If the default fetcher can stream responses, the identity page is
+    only read as far as discovery needs: not at all if its headers
+    point to another XRDS document, and up to the Yadis meta tag if it
+    is HTML with one that does.  Otherwise it is read in full, as the
+    C{response_text} of an HTML page is searched for OpenID link tags,
+    which may come after its head.
+
     @param uri: The identity URI as a well-formed http or https
         URI. The well-formedness and the protocol are not checked, but
         the results of this function are undefined if those properties
@@ -72,7 +89,114 @@ def discover(uri):
     @raises DiscoveryFailure: When the HTTP response does not have a 200 code.
     """
     result = DiscoveryResult(uri)
-    resp = fetchers.fetch(uri, headers={'Accept': YADIS_ACCEPT_HEADER})
+    resp = fetchers.fetchStream(uri, headers={'Accept': YADIS_ACCEPT_HEADER})
+    if isinstance(resp, fetchers.HTTPStreamResponse):
+        resp = _readIdentityResponse(resp)
+    _processIdentityResponse(result, resp)
+
+    if result.xrds_uri and result.usedYadisLocation():
+        resp = fetchers.fetch(result.xrds_uri)
+        _processYadisResponse(result, resp)
+
+    result.response_text = resp.body
+    return result
+
+
+async def discoverAsync(uri):
+    """Like L{discover}, but fetches with
+    L{fetchAsync<openid.fetchers.fetchAsync>} for use in asyncio code.
+    """
+    result = DiscoveryResult(uri)
+    resp = await fetchers.fetchAsync(
+        uri, headers={'Accept': YADIS_ACCEPT_HEADER})
+    _processIdentityResponse(result, resp)
+
+    if result.xrds_uri and result.usedYadisLocation():
+        resp = await fetchers.fetchAsync(result.xrds_uri)
+        _processYadisResponse(result, resp)
+
+    result.response_text = resp.body
+    return result
+
+
+def _readIdentityResponse(resp):
+    """Read as much of the body of a streamed response to fetching the
+    identity URI as discovery needs, and close the response.
+
+    @type resp: L{HTTPStreamResponse<openid.fetchers.HTTPStreamResponse>}
+
+    @returntype: L{HTTPResponse<openid.fetchers.HTTPResponse>}
+    """
+    with resp:
+        content_type = resp.headers.get('content-type') or ''
+        yadis_loc = resp.headers.get(YADIS_HEADER_NAME.lower())
+        limit = fetchers.MAX_RESPONSE_KB * 1024
+        if resp.status not in (200, 206):
+            # Discovery fails on the status alone
+            body = b''
+        elif _isYadisContentType(content_type):
+            body = resp.read(limit)
+        elif yadis_loc and yadis_loc != resp.final_url:
+            body = b''
+        else:
+            body = _readHTML(resp, content_type, limit)
+
+    return fetchers.HTTPResponse(resp.final_url, resp.status, resp.headers,
+                                 fetchers._decodeBody(body, resp.headers))
+
+
+def _readHTML(resp, content_type, limit):
+    """Read an HTML page, feeding it to a L{YadisHTMLParser} as it
+    comes.  Stop at a Yadis meta tag that points to another document,
+    since that document is used instead of the page.
+
+    @returntype: bytes
+    """
+    _, extra = fetchers._parseHeaderValue(content_type)
+    try:
+        decoder = codecs.getincrementaldecoder(
+            extra.get('charset', 'utf-8'))('replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    parser = YadisHTMLParser()
+    parsed = False
+    chunks = []
+    size = 0
+    while size < limit:
+        chunk = resp.read(min(CHUNK_SIZE, limit - size))
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        size += len(chunk)
+        if not parsed:
+            try:
+                parser.feed(decoder.decode(chunk))
+            except ParseDone as why:
+                yadis_loc = why.args[0]
+                if yadis_loc is not None and yadis_loc != resp.final_url:
+                    break
+                # The page itself is used, so read the rest of it for
+                # the OpenID link tags
+                parsed = True
+
+    return b''.join(chunks)
+
+
+def _isYadisContentType(content_type):
+    # According to the spec, the content-type header must be an exact
+    # match, or else we have to look for an indirection.
+    return (content_type and
+            content_type.split(';', 1)[0].lower() == YADIS_CONTENT_TYPE)
+
+
+def _processIdentityResponse(result, resp):
+    """Fill in the DiscoveryResult from the response to fetching the
+    identity URI.
+
+    [non-blocking]
+    """
     if resp.status not in (200, 206):
         raise DiscoveryFailure(
             'HTTP Response status from identity URL host is not 200. '
@@ -86,19 +210,45 @@ def discover(uri):
     result.content_type = resp.headers.get('content-type')
 
     result.xrds_uri = whereIsYadis(resp)
+    result.expires = getResponseExpires(resp)
 
-    if result.xrds_uri and result.usedYadisLocation():
-        resp = fetchers.fetch(result.xrds_uri)
-        if resp.status not in (200, 206):
-            exc = DiscoveryFailure(
-                'HTTP Response status from Yadis host is not 200. '
-                'Got status %r' % (resp.status, ), resp)
-            exc.identity_url = result.normalized_uri
-            raise exc
-        result.content_type = resp.headers.get('content-type')
 
-    result.response_text = resp.body
-    return result
+def _processYadisResponse(result, resp):
+    """Fill in the DiscoveryResult from the response to fetching the
+    Yadis document found through the identity URI.
+
+    [non-blocking]
+    """
+    if resp.status not in (200, 206):
+        exc = DiscoveryFailure(
+            'HTTP Response status from Yadis host is not 200. '
+            'Got status %r' % (resp.status, ), resp)
+        exc.identity_url = result.normalized_uri
+        raise exc
+    result.content_type = resp.headers.get('content-type')
+
+    expires = getResponseExpires(resp)
+    if result.expires is None or (expires is not None and
+                                  expires < result.expires):
+        result.expires = expires
+
+
+def getResponseExpires(resp):
+    """Return when a response expires according to its C{Cache-Control}
+    or C{Expires} header, as a time.time() value, or None if it has
+    neither.
+
+    [non-blocking]
+
+    @returns: float or None
+    """
+    headers = resp.headers or {}
+    if 'cache-control' not in headers and 'expires' not in headers:
+        return None
+
+    now = time.time()
+    # Responses that must not be cached at all expire now
+    return now + (fetchers._freshnessLifetime(headers, now) or 0)
 
 
 def whereIsYadis(resp):
@@ -115,10 +265,7 @@ def whereIsYadis(resp):
     # or if we already have it
     content_type = resp.headers.get('content-type')
 
-    # According to the spec, the content-type header must be an exact
-    # match, or else we have to look for an indirection.
-    if (content_type and
-            content_type.split(';', 1)[0].lower() == YADIS_CONTENT_TYPE):
+    if _isYadisContentType(content_type):
         return resp.final_url
     else:
         # Try the header
@@ -106,6 +106,25 @@ class Discovery(object):
             yadis_url, services = discover(self.url)
             manager = self.createManager(services, yadis_url)
 
+        return self._nextService(manager)
+
+    async def getNextServiceAsync(self, discover):
+        """Like L{getNextService}, for use in asyncio code.
+
+        @param discover: a coroutine function that takes a URL and
+            returns a list of services
+        """
+        manager = self.getManager()
+        if manager is not None and not manager:
+            self.destroyManager()
+
+        if not manager:
+            yadis_url, services = await discover(self.url)
+            manager = self.createManager(services, yadis_url)
+
+        return self._nextService(manager)
+
+    def _nextService(self, manager):
         if manager:
             service = next(manager)
             manager.store(self.session)
@@ -2,6 +2,9 @@
 """XRI resolution.
 """
 
+import asyncio
+import concurrent.futures
+import threading
 from urllib.parse import urlencode
 from openid import fetchers
 from openid.yadis import etxrd
@@ -10,13 +13,40 @@ from openid.yadis.services import iterServices
 
 DEFAULT_PROXY = 'http://proxy.xri.net/'
 
+# The number of threads in the pool that the queries are made in by
+# default, shared by all resolvers
+POOL_SIZE = 8
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _getPool():
+    """Return the thread pool shared by the resolvers that were not
+    given an executor, making it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(POOL_SIZE)
+        return _pool
+
 
 class ProxyResolver(object):
     """Python interface to a remote XRI proxy resolver.
     """
 
-    def __init__(self, proxy_url=DEFAULT_PROXY):
+    def __init__(self, proxy_url=DEFAULT_PROXY, executor=None):
+        """
+        @param proxy_url: The URL of the proxy resolver.
+        @type proxy_url: str
+
+        @param executor: The C{concurrent.futures.Executor} to make the
+            queries of L{query} in.  By default, they are made in a
+            thread pool of C{POOL_SIZE} threads that all resolvers
+            share.
+        """
         self.proxy_url = proxy_url
+        self.executor = executor
 
     def queryURL(self, xri, service_type=None):
         """Build a URL to query the proxy resolver.
@@ -71,30 +101,56 @@ class ProxyResolver(object):
         @returns: tuple of (CanonicalID, Service elements)
         @returntype: (unicode, list of C{ElementTree.Element}s)
         """
-        # FIXME: No test coverage!
-        services = []
         # Make a seperate request to the proxy resolver for each service
         # type, as, if it is following Refs, it could return a different
-        # XRDS for each.
-
+        # XRDS for each.  The requests are made at the same time.
+        urls = [self.queryURL(xri, service_type)
+                for service_type in service_types]
+        if len(urls) <= 1:
+            responses = [fetchers.fetch(url) for url in urls]
+        else:
+            executor = self.executor
+            if executor is None:
+                executor = _getPool()
+            responses = list(executor.map(fetchers.fetch, urls))
+        return self._mergeResponses(xri, responses)
+
+    async def queryAsync(self, xri, service_types):
+        """Like L{query}, for use in asyncio code.  The queries are made
+        with the default asynchronous fetcher."""
+        urls = [self.queryURL(xri, service_type)
+                for service_type in service_types]
+        responses = await asyncio.gather(
+            *[fetchers.fetchAsync(url) for url in urls])
+        return self._mergeResponses(xri, responses)
+
+    def _mergeResponses(self, xri, responses):
+        """Merge the Service elements of the XRDS documents that the
+        queries for each service type returned.
+
+        The same Service is often in more than one of the documents, so
+        each is kept once, and they are sorted by priority across all
+        of them.
+        """
         canonicalID = None
-
-        for service_type in service_types:
-            url = self.queryURL(xri, service_type)
-            response = fetchers.fetch(url)
+        services = []
+        seen = set()
+        for response in responses:
             if response.status not in (200, 206):
                 # XXX: sucks to fail silently.
-                # print "response not OK:", response
                 continue
             et = etxrd.parseXRDS(response.body)
-            canonicalID = etxrd.getCanonicalID(xri, et)
-            some_services = list(iterServices(et))
-            services.extend(some_services)
-        # TODO:
-        #  * If we do get hits for multiple service_types, we're almost
-        #    certainly going to have duplicated service entries and
-        #    broken priority ordering.
-        return canonicalID, services
+            # Check the CanonicalID of every document, but use the
+            # first one found
+            response_canonicalID = etxrd.getCanonicalID(xri, et)
+            if canonicalID is None:
+                canonicalID = response_canonicalID
+            for service in iterServices(et):
+                key = etxrd.ElementTree.tostring(service)
+                if key not in seen:
+                    seen.add(key)
+                    services.append(service)
+        return canonicalID, etxrd.prioSort(services)
 
 
 def _appendArgs(url, args):
@@ -40,6 +40,7 @@ Includes example code and support for a variety of storage back-ends.""",
     extras_require={
         "mysql": ["mysql-connector-python"],
         "postgresql": ["psycopg2"],
+        "redis": ["redis"],
     },
     classifiers=[
         "Development Status :: 5 - Production/Stable",